@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+benchmark resolver strategies against recorded resolution problems
+
+A problem is a JSON file holding the targets of a request along with every
+package the resolver may look at, split into repos:
+
+    {"targets": ["app-misc/foo"],
+     "repos": [{"repo_id": "gentoo", "livefs": false,
+                "pkgs": [{"cpv": "app-misc/foo-1", "slot": "0",
+                          "depend": "", "rdepend": "dev-libs/bar",
+                          "pdepend": ""}, ...]},
+               {"repo_id": "vdb", "livefs": true, "pkgs": [...]}]}
+
+``run`` times each resolver class on the given problems; ``record`` writes
+a problem for the given targets from the configured domain, capturing the
+dependency closure with USE conditionals already evaluated.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+from time import time
+
+try:
+    from snakeoil.lists import iflatten_instance
+
+    from pkgcore.ebuild.atom import atom
+    from pkgcore.ebuild.conditionals import DepSet
+    from pkgcore.ebuild import resolver
+    from pkgcore.resolver import plan, sat
+    from pkgcore.test.misc import FakePkg, FakeRepo
+except ImportError:
+    print('Cannot import pkgcore!', file=sys.stderr)
+    print('Verify it is properly installed and/or PYTHONPATH is set correctly.', file=sys.stderr)
+    sys.exit(1)
+
+
+resolvers = {
+    'merge_plan': plan.merge_plan,
+    'sat': sat.sat_merge_plan,
+}
+
+dep_attrs = (('depend', 'depends'), ('rdepend', 'rdepends'),
+             ('pdepend', 'post_rdepends'))
+
+
+class RecordedPkg(FakePkg):
+
+    __slots__ = ()
+
+    def __init__(self, data, repo):
+        FakePkg.__init__(self, data['cpv'], slot=data.get('slot', '0'),
+                         repo=repo)
+        object.__setattr__(self, 'built', repo.livefs)
+        for key, attr in dep_attrs:
+            object.__setattr__(
+                self, attr, DepSet.parse(data.get(key, ''), atom))
+
+
+def load_problem(path):
+    with open(path) as f:
+        data = json.load(f)
+    repos = []
+    for d in data['repos']:
+        repo = FakeRepo(repo_id=d['repo_id'], livefs=d.get('livefs', False))
+        repo.pkgs = [RecordedPkg(x, repo) for x in d['pkgs']]
+        repos.append(repo)
+    return [atom(x) for x in data['targets']], repos
+
+
+def resolve(resolver_cls, targets, repos, upgrade=False):
+    vdbs = [x for x in repos if x.livefs]
+    dbs = [x for x in repos if not x.livefs]
+    if upgrade:
+        f = resolver.upgrade_resolver
+    else:
+        f = resolver.min_install_resolver
+    resolver_inst = f(vdbs, dbs, resolver_cls=resolver_cls)
+    start = time()
+    ret = resolver_inst.add_atoms(targets, finalize=True)
+    return time() - start, ret, resolver_inst
+
+
+def run(options):
+    for path in options.problems:
+        targets, repos = load_problem(path)
+        npkgs = sum(len(x.pkgs) for x in repos)
+        print("%s: %i target(s), %i package(s)" % (path, len(targets), npkgs))
+        for name in options.resolvers:
+            times = []
+            for x in xrange(options.repeat):
+                elapsed, ret, resolver_inst = resolve(
+                    resolvers[name], targets, repos, options.upgrade)
+                times.append(elapsed)
+            if ret:
+                result = "failed on %s" % (ret[0][0],)
+            else:
+                result = "%i ops" % (len(list(resolver_inst.state.iter_ops())),)
+            line = "  %-12s best %.4fs, mean %.4fs, %s" % (
+                name, min(times), sum(times) / len(times), result)
+            stats = getattr(resolver_inst, 'solver_stats', None)
+            if stats:
+                line += " (%s)" % (", ".join(
+                    "%s %i" % x for x in sorted(stats.iteritems())),)
+            print(line)
+    return 0
+
+
+def _pkg_data(pkg):
+    d = {'cpv': pkg.cpvstr, 'slot': pkg.slot}
+    for key, attr in dep_attrs:
+        deps = str(getattr(pkg, attr))
+        if deps:
+            d[key] = deps
+    return d
+
+
+def record(options):
+    from pkgcore.config import load_config
+    domain = load_config().get_default('domain')
+    groups = (('installed', domain.installed_repos, True),
+              ('source', domain.source_repos, False))
+    pkgs = dict((name, {}) for name, group, livefs in groups)
+    count = 0
+    seen = set()
+    queue = list(options.targets)
+    while queue and not (options.max_pkgs and count >= options.max_pkgs):
+        a = atom(queue.pop())
+        if a in seen:
+            continue
+        seen.add(a)
+        for name, group, livefs in groups:
+            # blockers only matter against what's installed.
+            if a.blocks and not livefs:
+                continue
+            for pkg in group.itermatch(a):
+                if pkg.cpvstr in pkgs[name]:
+                    continue
+                pkgs[name][pkg.cpvstr] = _pkg_data(pkg)
+                count += 1
+                for key, attr in dep_attrs:
+                    queue.extend(
+                        str(x) for x in iflatten_instance(
+                            getattr(pkg, attr), atom))
+    problem = {
+        'targets': options.targets,
+        'repos': [
+            {'repo_id': name, 'livefs': livefs,
+             'pkgs': [pkgs[name][x] for x in sorted(pkgs[name])]}
+            for name, group, livefs in groups],
+    }
+    with open(options.output, 'w') as f:
+        json.dump(problem, f, indent=1, sort_keys=True)
+        f.write('\n')
+    return 0
+
+
+argparser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+subparsers = argparser.add_subparsers()
+run_parser = subparsers.add_parser('run', help='benchmark resolvers')
+run_parser.add_argument('problems', nargs='+', help='problem files')
+run_parser.add_argument(
+    '-r', '--resolver', dest='resolvers', action='append',
+    choices=sorted(resolvers),
+    help='resolver to benchmark (default: all of them)')
+run_parser.add_argument(
+    '-n', '--repeat', type=int, default=5, help='number of runs per resolver')
+run_parser.add_argument(
+    '-u', '--upgrade', action='store_true',
+    help='use the upgrade resolver configuration instead of min install')
+run_parser.set_defaults(func=run)
+record_parser = subparsers.add_parser(
+    'record', help='record a problem from the configured domain')
+record_parser.add_argument('output', help='file to write the problem to')
+record_parser.add_argument('targets', nargs='+', help='target atoms')
+record_parser.add_argument(
+    '--max-pkgs', type=int, default=0,
+    help='stop expanding the dependency closure after this many packages')
+record_parser.set_defaults(func=record)
+
+
+if __name__ == '__main__':
+    options = argparser.parse_args()
+    if options.func is run and not options.resolvers:
+        options.resolvers = sorted(resolvers)
+    sys.exit(options.func(options))
@@ -0,0 +1,702 @@
+#!/usr/bin/env python
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+benchmark pkgcore against generated repositories
+
+``generate`` writes an ebuild repository with md5-cache metadata, a vdb of
+installed packages and a world file into a directory.  The number of
+packages, their versions and dependencies, and how often dependencies use
+|| groups, slots, blockers and USE conditionals are set by options; the same
+options and seed always generate the same tree.
+
+``run`` times benchmarks against a generated tree, running each repetition
+in a forked process so that neither timings nor peak memory use depend on
+what ran before:
+
+    resolve:<resolver>  upgrading the world set with a resolver strategy
+    match               repo.match of every dependency atom in the repo
+    query               iterating the repo, loading metadata from the cache
+    vdb                 iterating the vdb, loading metadata
+    vdb-index           the same, via a prebuilt vdb metadata index
+    contents            loading the CONTENTS of every installed package
+    owns                finding the owners of a few paths, as pquery --owns
+    owns-index          the same, via a prebuilt vdb owners index
+    revdep              finding the dependents of a few installed packages,
+                        as pquery --restrict-revdep
+    revdep-index        the same, via a prebuilt vdb reverse dependencies
+                        index
+    regen               regenerating the metadata cache of the repo
+    merge               merging packages to an offset livefs
+
+Nothing is fetched; everything happens in the tree's directory and the
+temporary directory.  ``run --output`` records the results along with the
+tree parameters and pkgcore revision, and ``compare`` shows the change
+between two such records, e.g. of runs on two commits against one tree.
+"""
+
+from __future__ import print_function
+
+import argparse
+from hashlib import md5, sha256, sha512
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+try:
+    from snakeoil.chksum import LazilyHashedPath
+    from snakeoil.lists import iflatten_instance
+    from snakeoil.osutils import ensure_dirs, pjoin
+
+    import pkgcore
+    from pkgcore.cache import flat_hash
+    from pkgcore.ebuild import eclass_cache, repository, restricts
+    from pkgcore.ebuild.atom import atom
+    from pkgcore.fs import livefs
+    from pkgcore.fs.contents import contentsSet
+    from pkgcore.fs.fs import fsBase
+    from pkgcore.merge import engine
+    from pkgcore.operations import observer
+    from pkgcore.restrictions import packages, values
+    from pkgcore.test.misc import FakeRepo
+    from pkgcore.vdb import ondisk
+
+    from resolver import RecordedPkg, dep_attrs, resolve, resolvers
+except ImportError:
+    print('Cannot import pkgcore!', file=sys.stderr)
+    print('Verify it is properly installed and/or PYTHONPATH is set correctly.', file=sys.stderr)
+    sys.exit(1)
+
+
+# IUSE of every package; flags with a + are enabled.
+iuse = ('+ssl', 'doc', '+nls', 'test')
+enabled_use = frozenset(x[1:] for x in iuse if x.startswith('+'))
+
+ebuild_template = """\
+# synthetic package generated by pkgcore's benchmarks/synthetic.py
+EAPI=5
+inherit synthetic
+DESCRIPTION="synthetic package %(cpv)s"
+HOMEPAGE="https://example.com/"
+SRC_URI="https://example.com/distfiles/${P}.tar.gz"
+LICENSE="GPL-2"
+SLOT="%(slot)s"
+KEYWORDS="amd64 x86"
+IUSE="%(iuse)s"
+RDEPEND="%(rdepend)s"
+DEPEND="${RDEPEND}"
+"""
+
+eclass_data = """\
+# synthetic eclass generated by pkgcore's benchmarks/synthetic.py
+synthetic_src_install() {
+	:
+}
+EXPORT_FUNCTIONS src_install
+"""
+
+
+class BenchmarkFailure(Exception):
+    pass
+
+
+def _cpv(params, idx):
+    return 'cat%i/pkg%i' % (idx % params['categories'], idx)
+
+
+def _dep_atom(rng, params, versions, slotted, idx):
+    key = _cpv(params, idx)
+    if slotted[idx] and rng.random() < params['slots']:
+        return '%s:%s' % (key, rng.choice(versions[idx]).split('.')[0])
+    elif rng.random() < 0.3:
+        return '>=%s-%s' % (key, rng.choice(versions[idx]))
+    return key
+
+
+def _dep_string(rng, params, versions, slotted, idx):
+    """Generate the dependencies of a package.
+
+    Packages only depend on packages with a lower index, so the dependency
+    graph is acyclic and every package is resolvable.
+    """
+    if not idx:
+        return ''
+    count = min(idx, rng.randint(0, 2 * params['deps']))
+    deps = []
+    for dep_idx in rng.sample(xrange(idx), count):
+        dep = _dep_atom(rng, params, versions, slotted, dep_idx)
+        if rng.random() < params['or_groups']:
+            alt = _dep_atom(rng, params, versions, slotted, rng.randrange(idx))
+            dep = '|| ( %s %s )' % (dep, alt)
+        if rng.random() < params['use_deps']:
+            dep = '%s? ( %s )' % (rng.choice(iuse).lstrip('+'), dep)
+        deps.append(dep)
+    if rng.random() < params['blockers']:
+        # block versions that don't exist; exercises blocker handling
+        # without making the tree unresolvable.
+        deps.append('!<%s-1.0' % (_cpv(params, rng.randrange(idx)),))
+    return ' '.join(deps)
+
+
+def _write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def load_repo(path, cache=None):
+    location = pjoin(path, 'repo')
+    if cache is None:
+        cache = flat_hash.md5_cache(location, readonly=True)
+    return repository._UnconfiguredTree(
+        location, eclass_cache.cache(pjoin(location, 'eclass')),
+        cache=(cache,))
+
+
+def load_vdb(path, cache_location=None):
+    if cache_location is None:
+        return ondisk.tree(pjoin(path, 'vdb'), disable_cache=True)
+    return ondisk.tree(pjoin(path, 'vdb'), cache_location=cache_location)
+
+
+def load_params(path):
+    with open(pjoin(path, 'params.json')) as f:
+        return json.load(f)
+
+
+def _generate_repo(path, params, rng):
+    location = pjoin(path, 'repo')
+    categories = ['cat%i' % x for x in xrange(params['categories'])]
+    for subdir in ('profiles', 'metadata', 'eclass'):
+        ensure_dirs(pjoin(location, subdir))
+    _write(pjoin(location, 'profiles', 'repo_name'), 'synthetic\n')
+    _write(pjoin(location, 'profiles', 'categories'),
+           ''.join('%s\n' % x for x in categories))
+    _write(pjoin(location, 'metadata', 'layout.conf'),
+           'masters =\ncache-formats = md5-dict\nthin-manifests = true\n')
+    _write(pjoin(location, 'eclass', 'synthetic.eclass'), eclass_data)
+
+    total = params['categories'] * params['packages']
+    versions = []
+    for idx in xrange(total):
+        count = rng.randint(1, params['versions'])
+        versions.append(['%i.0' % x for x in xrange(1, count + 1)])
+    slotted = [rng.random() < params['slots'] for x in xrange(total)]
+
+    ecache = eclass_cache.cache(pjoin(location, 'eclass'))
+    eclasses = ecache.get_eclass_data(['synthetic'])
+    cache = flat_hash.md5_cache(location, readonly=False)
+    for idx in xrange(total):
+        key = _cpv(params, idx)
+        pkgdir = pjoin(location, key)
+        ensure_dirs(pkgdir)
+        rdepend = _dep_string(rng, params, versions, slotted, idx)
+        manifest = []
+        for ver in versions[idx]:
+            distfile = '%s-%s.tar.gz' % (key.split('/')[1], ver)
+            manifest.append('DIST %s 1024 SHA256 %s SHA512 %s\n' % (
+                distfile, sha256(distfile).hexdigest(),
+                sha512(distfile).hexdigest()))
+            slot = ver.split('.')[0] if slotted[idx] else '0'
+            ebuild = pjoin(pkgdir, '%s-%s.ebuild' % (key.split('/')[1], ver))
+            _write(ebuild, ebuild_template % {
+                'cpv': '%s-%s' % (key, ver), 'slot': slot,
+                'iuse': ' '.join(iuse), 'rdepend': rdepend})
+            cache['%s-%s' % (key, ver)] = {
+                'EAPI': '5', 'SLOT': slot, 'IUSE': ' '.join(iuse),
+                'KEYWORDS': 'amd64 x86', 'LICENSE': 'GPL-2',
+                'DESCRIPTION': 'synthetic package %s-%s' % (key, ver),
+                'HOMEPAGE': 'https://example.com/',
+                'SRC_URI': 'https://example.com/distfiles/%s' % (distfile,),
+                'RDEPEND': rdepend, 'DEPEND': rdepend,
+                'DEFINED_PHASES': 'install',
+                '_eclasses_': eclasses, '_chf_': LazilyHashedPath(ebuild)}
+        _write(pjoin(pkgdir, 'Manifest'), ''.join(manifest))
+    cache.commit()
+    return total
+
+
+def _contents(pkg, files):
+    base = '/usr/share/synthetic/%s' % (pkg.package,)
+    lines = ['dir /usr', 'dir /usr/share', 'dir /usr/share/synthetic',
+             'dir %s' % (base,)]
+    for x in xrange(files):
+        path = '%s/file%i' % (base, x)
+        lines.append('obj %s %s 1000000000' % (path, md5(path).hexdigest()))
+    lines.append('sym /usr/lib/lib%s.so -> lib%s.so.1 1000000000' % (
+        pkg.package, pkg.package))
+    return ''.join('%s\n' % x for x in lines)
+
+
+def _generate_vdb(path, params, rng):
+    """Install the dependency closure of a random world set.
+
+    Packages get their best matching version except for a fraction that
+    stays at the lowest one, leaving something to upgrade.
+    """
+    repo = load_repo(path)
+    keys = sorted(repo.versions, key=lambda x: int(x[1][3:]))
+    world = [
+        '%s/%s' % x for x in rng.sample(
+            keys, max(1, int(len(keys) * params['installed'] / 4)))]
+    installed = {}
+    queue = [atom(x) for x in world]
+    while queue and len(installed) < len(keys) * params['installed']:
+        a = queue.pop(0)
+        matches = sorted(repo.match(a))
+        if not matches:
+            continue
+        if rng.random() < params['outdated']:
+            pkg = matches[0]
+        else:
+            pkg = matches[-1]
+        if (pkg.key, pkg.slot) in installed:
+            continue
+        installed[pkg.key, pkg.slot] = pkg
+        rdepends = pkg.rdepends.evaluate_depset(enabled_use)
+        queue.extend(x for x in iflatten_instance(rdepends, atom)
+                     if not x.blocks)
+
+    location = pjoin(path, 'vdb')
+    for pkg in installed.itervalues():
+        pkgdir = pjoin(location, pkg.category, pkg.PF)
+        ensure_dirs(pkgdir)
+        use = enabled_use.intersection(pkg.iuse_stripped)
+        rdepends = str(pkg.rdepends.evaluate_depset(use))
+        entries = {
+            'CATEGORY': pkg.category, 'PF': pkg.PF, 'SLOT': pkg.slot,
+            'EAPI': '5', 'IUSE': ' '.join(iuse), 'USE': ' '.join(sorted(use)),
+            'KEYWORDS': 'amd64 x86', 'LICENSE': 'GPL-2',
+            'DESCRIPTION': pkg.description, 'HOMEPAGE': 'https://example.com/',
+            'repository': 'synthetic', 'DEPEND': rdepends,
+            'RDEPEND': rdepends, 'DEFINED_PHASES': 'install',
+            'INHERITED': 'synthetic', 'COUNTER': '1',
+            'CONTENTS': _contents(pkg, params['contents'])}
+        for name, data in entries.iteritems():
+            if not data.endswith('\n'):
+                data += '\n'
+            _write(pjoin(pkgdir, name), data)
+        shutil.copy(pkg.path, pjoin(pkgdir, '%s.ebuild' % (pkg.PF,)))
+    _write(pjoin(path, 'world'), ''.join('%s\n' % x for x in sorted(world)))
+    return len(installed)
+
+
+params_defaults = (
+    ('seed', 0, 'seed for the random generator'),
+    ('categories', 10, 'number of categories'),
+    ('packages', 50, 'number of packages per category'),
+    ('versions', 3, 'maximum number of versions per package'),
+    ('deps', 3, 'average number of dependencies per package'),
+    ('or_groups', 0.1, 'fraction of dependencies that are || groups'),
+    ('slots', 0.2, 'fraction of packages that are slotted, and of '
+                   'dependencies on them using slot deps'),
+    ('blockers', 0.1, 'fraction of packages with a blocker'),
+    ('use_deps', 0.2, 'fraction of dependencies that are USE conditional'),
+    ('installed', 0.3, 'fraction of packages that are installed'),
+    ('outdated', 0.2, 'fraction of installed packages not at their best '
+                      'version'),
+    ('contents', 20, 'number of files installed by each package'),
+)
+
+
+def generate(options):
+    path = options.path
+    if os.path.exists(path) and os.listdir(path):
+        print("%s isn't empty" % (path,), file=sys.stderr)
+        return 1
+    params = dict((name, getattr(options, name))
+                  for name, default, doc in params_defaults)
+    rng = random.Random(params['seed'])
+    ensure_dirs(path)
+    start = time()
+    count = _generate_repo(path, params, rng)
+    installed = _generate_vdb(path, params, rng)
+    with open(pjoin(path, 'params.json'), 'w') as f:
+        json.dump(params, f, indent=1, sort_keys=True)
+        f.write('\n')
+    print("generated %i package(s), %i installed in %.2fs" % (
+        count, installed, time() - start))
+    return 0
+
+
+def _problem(path):
+    """Return the world set and repos of a tree for the resolver benchmark.
+
+    As with a configured domain, USE conditionals are evaluated up front.
+    """
+    repos = []
+    for raw_repo, livefs_repo in ((load_vdb(path), True),
+                                  (load_repo(path), False)):
+        repo = FakeRepo(repo_id=raw_repo.repo_id, livefs=livefs_repo)
+        pkgs = []
+        for pkg in raw_repo:
+            use = getattr(pkg, 'use', None) if livefs_repo else enabled_use
+            data = {'cpv': pkg.cpvstr, 'slot': pkg.slot}
+            for key, attr in dep_attrs:
+                data[key] = str(getattr(pkg, attr).evaluate_depset(use))
+            pkgs.append(RecordedPkg(data, repo))
+        repo.pkgs = pkgs
+        repos.append(repo)
+    with open(pjoin(path, 'world')) as f:
+        targets = [atom(x.strip()) for x in f if x.strip()]
+    return targets, repos
+
+
+def bench_resolve(path, options, name):
+    targets, repos = _problem(path)
+    elapsed, ret, resolver_inst = resolve(
+        resolvers[name], targets, repos, upgrade=True)
+    if ret:
+        raise BenchmarkFailure("failed resolving %s" % (ret[0][0],))
+    return elapsed, len(list(resolver_inst.state.iter_ops()))
+
+
+def bench_match(path, options):
+    atoms = set()
+    for pkg in load_repo(path):
+        for attr in ('depends', 'rdepends'):
+            atoms.update(x for x in iflatten_instance(getattr(pkg, attr), atom)
+                         if not x.blocks)
+    # query a fresh instance so nothing is cached yet.
+    repo = load_repo(path)
+    start = time()
+    for a in atoms:
+        repo.match(a)
+    return time() - start, len(atoms)
+
+
+def bench_query(path, options):
+    repo = load_repo(path)
+    start = time()
+    count = 0
+    for pkg in repo.itermatch(packages.AlwaysTrue, sorter=sorted):
+        for attr in ('depends', 'rdepends', 'slot', 'keywords', 'iuse',
+                     'license', 'fetchables'):
+            getattr(pkg, attr)
+        count += 1
+    return time() - start, count
+
+
+def _load_vdb_metadata(vdb):
+    count = 0
+    for pkg in vdb.itermatch(packages.AlwaysTrue, sorter=sorted):
+        for attr in ('depends', 'rdepends', 'slot', 'use', 'keywords'):
+            getattr(pkg, attr)
+        count += 1
+    return count
+
+
+def bench_vdb(path, options):
+    vdb = load_vdb(path)
+    start = time()
+    count = _load_vdb_metadata(vdb)
+    return time() - start, count
+
+
+def bench_vdb_index(path, options):
+    tmpdir = tempfile.mkdtemp(prefix='pkgcore-bench-')
+    try:
+        # build the index up front, where supported.
+        vdb = load_vdb(path, cache_location=tmpdir)
+        _load_vdb_metadata(vdb)
+        index = getattr(vdb, 'metadata_index', None)
+        if index is not None:
+            index.flush()
+        vdb = load_vdb(path, cache_location=tmpdir)
+        start = time()
+        count = _load_vdb_metadata(vdb)
+        return time() - start, count
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_contents(path, options):
+    vdb = load_vdb(path)
+    start = time()
+    count = 0
+    for pkg in vdb:
+        count += len(pkg.contents)
+    return time() - start, count
+
+
+def _owns_restrict(vdb):
+    # a file of every tenth installed package.
+    pkgs = sorted(vdb)[::10]
+    paths = ['/usr/share/synthetic/%s/file0' % (pkg.package,) for pkg in pkgs]
+    return packages.PackageRestriction('contents', values.ContainmentMatch2(
+        contentsSet(fsBase(x, strict=False) for x in paths)))
+
+
+def bench_owns(path, options):
+    vdb = load_vdb(path)
+    restrict = _owns_restrict(vdb)
+    start = time()
+    count = sum(1 for pkg in vdb.itermatch(restrict))
+    return time() - start, count
+
+
+def bench_owns_index(path, options):
+    tmpdir = tempfile.mkdtemp(prefix='pkgcore-bench-')
+    try:
+        # build the index up front, where supported.
+        vdb = load_vdb(path, cache_location=tmpdir)
+        restrict = _owns_restrict(vdb)
+        for pkg in vdb.itermatch(restrict):
+            pass
+        index = getattr(vdb, 'owners_index', None)
+        if index is not None:
+            index.flush()
+        vdb = load_vdb(path, cache_location=tmpdir)
+        start = time()
+        count = sum(1 for pkg in vdb.itermatch(restrict))
+        return time() - start, count
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _revdep_restrict(vdb):
+    # dependents of every tenth installed package.
+    l = []
+    for pkg in sorted(vdb)[::10]:
+        target = pkg.unversioned_atom
+        if hasattr(restricts, 'DepIntersects'):
+            r = restricts.DepIntersects(target)
+        else:
+            r = values.FunctionRestriction(target.intersects)
+        r = values.FlatteningRestriction(atom, values.AnyMatch(r))
+        l.extend(packages.PackageRestriction(attr, r) for _key, attr in dep_attrs)
+    return packages.OrRestriction(*l)
+
+
+def bench_revdep(path, options):
+    vdb = load_vdb(path)
+    restrict = _revdep_restrict(vdb)
+    start = time()
+    count = sum(1 for pkg in vdb.itermatch(restrict))
+    return time() - start, count
+
+
+def bench_revdep_index(path, options):
+    tmpdir = tempfile.mkdtemp(prefix='pkgcore-bench-')
+    try:
+        # build the index up front, where supported.
+        vdb = load_vdb(path, cache_location=tmpdir)
+        restrict = _revdep_restrict(vdb)
+        for pkg in vdb.itermatch(restrict):
+            pass
+        for attr in ('metadata_index', 'revdep_index'):
+            index = getattr(vdb, attr, None)
+            if index is not None:
+                index.flush()
+        vdb = load_vdb(path, cache_location=tmpdir)
+        start = time()
+        count = sum(1 for pkg in vdb.itermatch(restrict))
+        return time() - start, count
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_regen(path, options):
+    tmpdir = tempfile.mkdtemp(prefix='pkgcore-bench-')
+    try:
+        cache = flat_hash.md5_cache(tmpdir, readonly=False)
+        repo = load_repo(path, cache=cache)
+        start = time()
+        repo.operations.regen_cache(threads=options.threads)
+        elapsed = time() - start
+        return elapsed, sum(1 for x in cache.iterkeys())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class _ImagePkg(object):
+
+    def __init__(self, name, contents):
+        self.name = name
+        self.contents = contents
+
+    def __str__(self):
+        return self.name
+
+
+def bench_merge(path, options):
+    files = load_params(path)['contents']
+    tmpdir = tempfile.mkdtemp(prefix='pkgcore-bench-')
+    try:
+        root = pjoin(tmpdir, 'root')
+        ensure_dirs(root)
+        pkgs = []
+        for idx in xrange(options.merge_pkgs):
+            image = pjoin(tmpdir, 'image%i' % (idx,))
+            base = pjoin(image, 'usr', 'share', 'synthetic', 'pkg%i' % (idx,))
+            ensure_dirs(base)
+            for x in xrange(files):
+                _write(pjoin(base, 'file%i' % (x,)), '%i %i\n' % (idx, x))
+            pkgs.append(_ImagePkg(
+                'pkg%i' % (idx,), livefs.scan(image, offset=image)))
+        obs = observer.repo_observer(observer.null_output())
+        start = time()
+        for pkg in pkgs:
+            me = engine.MergeEngine.install(
+                tempfile.mkdtemp(dir=tmpdir), pkg, offset=root, observer=obs)
+            me.sanity_check()
+            me.pre_merge()
+            me.merge()
+            me.post_merge()
+            me.final()
+        return time() - start, len(pkgs)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+benchmarks = [('resolve:%s' % (x,), bench_resolve, (x,), 'ops')
+              for x in sorted(resolvers)]
+benchmarks.extend([
+    ('match', bench_match, (), 'queries'),
+    ('query', bench_query, (), 'pkgs'),
+    ('vdb', bench_vdb, (), 'pkgs'),
+    ('vdb-index', bench_vdb_index, (), 'pkgs'),
+    ('contents', bench_contents, (), 'entries'),
+    ('owns', bench_owns, (), 'pkgs'),
+    ('owns-index', bench_owns_index, (), 'pkgs'),
+    ('revdep', bench_revdep, (), 'pkgs'),
+    ('revdep-index', bench_revdep_index, (), 'pkgs'),
+    ('regen', bench_regen, (), 'pkgs'),
+    ('merge', bench_merge, (), 'pkgs'),
+])
+
+
+def _forked(func, *args):
+    """Run func in a child process, returning its result and peak RSS."""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        try:
+            try:
+                data = {'result': func(*args)}
+            except Exception as e:
+                data = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            data['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            with os.fdopen(wfd, 'w') as f:
+                json.dump(data, f)
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        return {'error': 'benchmark process died'}
+    return json.loads(data)
+
+
+def _revision():
+    try:
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'], stderr=null,
+                cwd=os.path.dirname(os.path.abspath(pkgcore.__file__))).strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return pkgcore.__version__
+
+
+def run(options):
+    path = options.path
+    params = load_params(path)
+    selected = options.benchmarks or [x[0] for x in benchmarks]
+    record = {'params': params, 'revision': _revision(),
+              'python': sys.version.split()[0], 'results': {}}
+    print("%s: pkgcore %s" % (path, record['revision']))
+    for name, func, args, unit in benchmarks:
+        if name not in selected:
+            continue
+        times = []
+        maxrss = 0
+        for x in xrange(options.repeat):
+            data = _forked(func, path, options, *args)
+            if 'error' in data:
+                print("  %-20s %s" % (name, data['error']))
+                break
+            elapsed, items = data['result']
+            times.append(elapsed)
+            maxrss = max(maxrss, data['maxrss'])
+        else:
+            best = min(times)
+            record['results'][name] = {
+                'best': best, 'mean': sum(times) / len(times),
+                'items': items, 'unit': unit, 'maxrss': maxrss}
+            print("  %-20s best %8.4fs, mean %8.4fs, %10.1f %s/s, "
+                  "maxrss %6.1fMiB" % (
+                      name, best, sum(times) / len(times),
+                      items / best if best else 0, unit, maxrss / 1024.))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+def compare(options):
+    records = []
+    for path in (options.base, options.new):
+        with open(path) as f:
+            records.append(json.load(f))
+    base, new = records
+    if base['params'] != new['params']:
+        print("warning: the runs used differently generated trees",
+              file=sys.stderr)
+    print("%-20s %10s %10s %8s %10s %10s" % (
+        "benchmark", base['revision'][:10], new['revision'][:10], "change",
+        "maxrss", "maxrss"))
+    for name in sorted(set(base['results']).intersection(new['results'])):
+        old_res, new_res = base['results'][name], new['results'][name]
+        print("%-20s %9.4fs %9.4fs %+7.1f%% %9.1fM %9.1fM" % (
+            name, old_res['best'], new_res['best'],
+            (new_res['best'] / old_res['best'] - 1) * 100 if old_res['best'] else 0,
+            old_res['maxrss'] / 1024., new_res['maxrss'] / 1024.))
+    return 0
+
+
+argparser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+subparsers = argparser.add_subparsers()
+generate_parser = subparsers.add_parser(
+    'generate', help='generate a synthetic tree')
+generate_parser.add_argument('path', help='directory to generate into')
+for name, default, doc in params_defaults:
+    generate_parser.add_argument(
+        '--%s' % (name.replace('_', '-'),), type=type(default), default=default,
+        help='%s (default: %%(default)s)' % (doc,))
+generate_parser.set_defaults(func=generate)
+run_parser = subparsers.add_parser('run', help='run benchmarks against a tree')
+run_parser.add_argument('path', help='generated tree')
+run_parser.add_argument(
+    '-b', '--benchmark', dest='benchmarks', action='append',
+    choices=[x[0] for x in benchmarks],
+    help='benchmark to run (default: all of them)')
+run_parser.add_argument(
+    '-n', '--repeat', type=int, default=3, help='number of runs per benchmark')
+run_parser.add_argument(
+    '-o', '--output', help='file to record the results in, for compare')
+run_parser.add_argument(
+    '--threads', type=int, default=1, help='threads to regen with')
+run_parser.add_argument(
+    '--merge-pkgs', type=int, default=20,
+    help='number of packages to merge')
+run_parser.set_defaults(func=run)
+compare_parser = subparsers.add_parser(
+    'compare', help='compare the results of two runs')
+compare_parser.add_argument('base', help='results of the baseline run')
+compare_parser.add_argument('new', help='results to compare against it')
+compare_parser.set_defaults(func=compare)
+
+
+if __name__ == '__main__':
+    options = argparser.parse_args()
+    sys.exit(options.func(options))
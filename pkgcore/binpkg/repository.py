@@ -27,6 +27,7 @@ from pkgcore.repository import prototype, errors
 
 demandload(
     "errno",
+    "time:time",
     "snakeoil:chksum",
     "snakeoil:compression",
     "snakeoil.data_source:local_source,data_source",
@@ -35,6 +36,7 @@ demandload(
     "pkgcore.fs.contents:offset_rewriter,contentsSet",
     "pkgcore.fs.livefs:scan",
     "pkgcore.fs.tar:generate_contents",
+    "pkgcore.log:logger",
     "pkgcore.merge:engine",
     "pkgcore.package:base@pkg_base",
     "pkgcore.repository:wrapper",
@@ -226,19 +228,36 @@ class tree(prototype.tree):
 
     pkgcore_config_type = ConfigHint({
         'location': 'str',
-        'repo_id': 'str', 'ignore_paludis_versioning': 'bool'},
+        'repo_id': 'str', 'ignore_paludis_versioning': 'bool',
+        'prefetch_threads': 'int', 'trust_index': 'bool',
+        'reconcile_interval': 'int'},
         typename='repo')
 
     def __init__(self, location, repo_id=None, ignore_paludis_versioning=False,
-                 cache_version='0'):
+                 cache_version='0', prefetch_threads=0, trust_index=False,
+                 reconcile_interval=0):
         """
         :param location: root of the tbz2 repository
         :keyword repo_id: unique repository id to use; else defaults to
             the location
         :keyword ignore_paludis_versioning: if False, error when -scm is seen.
             If True, silently ignore -scm ebuilds.
+        :keyword prefetch_threads: if more than 1, list category directories
+            using that many threads when walking the whole repo
+        :keyword trust_index: if True, the Packages index is authoritative:
+            packages are listed and their metadata read from it without
+            looking at the category directories or binpkgs (see
+            :obj:`reconcile`).  If the index doesn't exist, the repo is
+            scanned as usual.
+        :keyword reconcile_interval: with trust_index, if more than 0, an
+            index older than this many seconds is reconciled with the
+            binpkgs on disk on first use
         """
         super(tree, self).__init__()
+        self.prefetch_threads = prefetch_threads
+        self.trust_index = trust_index
+        self.reconcile_interval = reconcile_interval
+        self._trusted = False
         self.base = self.location = location
         if repo_id is None:
             repo_id = location
@@ -257,16 +276,102 @@ class tree(prototype.tree):
                 " by this user" %
                 (self.base, os.stat(self.base).st_mode & 04777))
 
-        self.cache = remote.get_cache_kls(cache_version)(pjoin(self.base, self.cache_name))
+        self.cache_location = pjoin(self.base, self.cache_name)
+        self.cache = remote.get_cache_kls(cache_version)(self.cache_location)
         self.package_class = wrap_factory(self.package_factory, self)
 
     def __str__(self):
         return self.repo_id
 
+    @jit_attr
+    def _indexed(self):
+        # mapping of category to package to versions listed in the Packages
+        # index if it's trusted, else None.
+        if not self.trust_index:
+            return None
+        try:
+            mtime = os.stat(self.cache_location).st_mtime
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        if self.reconcile_interval > 0 and \
+                time() - mtime >= self.reconcile_interval:
+            # without writing the result back every process would rescan the
+            # repo, so users that can't write the index just trust it.
+            if self._index_writable():
+                try:
+                    self.reconcile()
+                except EnvironmentError as e:
+                    logger.warning("%s: failed reconciling %s: %s",
+                                   self.repo_id, self.cache_location, e)
+            else:
+                logger.debug("%s: not reconciling read-only %s",
+                             self.repo_id, self.cache_location)
+        d = {}
+        for cpvstr in self.cache.iterkeys():
+            try:
+                cpv = versioned_CPV(cpvstr)
+            except InvalidCPV:
+                logger.warning("%s: invalid cpv %r in %s", self.repo_id,
+                               cpvstr, self.cache_location)
+                continue
+            d.setdefault(cpv.category, {}).setdefault(
+                cpv.package, []).append(cpv.fullver)
+        self._trusted = True
+        return d
+
+    def reconcile(self):
+        """Bring the Packages index in sync with the binpkgs on disk.
+
+        Entries of binpkgs that no longer exist are dropped, and new or
+        modified binpkgs are read from their xpak.  The index is rewritten
+        even if nothing changed, restarting the reconcile interval; if it
+        isn't writable, the reconciled entries are only kept in memory.
+        """
+        on_disk = set()
+        for category in self._list_categories():
+            for (cat, pkg), versions in \
+                    self._list_packages(category).iteritems():
+                on_disk.update((cat, pkg, ver) for ver in versions)
+        for cpvstr in list(self.cache.iterkeys()):
+            try:
+                cpv = versioned_CPV(cpvstr)
+            except InvalidCPV:
+                del self.cache[cpvstr]
+                continue
+            if (cpv.category, cpv.package, cpv.fullver) not in on_disk:
+                del self.cache[cpvstr]
+        for args in sorted(on_disk):
+            pkg = self.package_class(*args)
+            xpak = StackedXpakDict(self, pkg)
+            try:
+                if int(self.cache[pkg.cpvstr]['mtime']) == int(xpak.mtime):
+                    continue
+            except KeyError:
+                pass
+            self.cache.update_from_xpak(pkg, xpak)
+        if self._index_writable():
+            self.cache.commit(force=True)
+        else:
+            self.cache.discard_pending()
+
+    def _index_writable(self):
+        # the index is replaced atomically, so the directory has to be
+        # writable too.
+        return access(self.base, os.W_OK) and (
+            not os.path.exists(self.cache_location) or
+            access(self.cache_location, os.W_OK))
+
     def _get_categories(self, *optional_category):
         # return if optional_category is passed... cause it's not yet supported
         if optional_category:
             return {}
+        if self._indexed is not None:
+            return tuple(self._indexed)
+        return self._list_categories()
+
+    def _list_categories(self):
         try:
             return tuple(
                 x for x in listdir_dirs(self.base)
@@ -275,8 +380,19 @@ class tree(prototype.tree):
             raise_from(KeyError("failed fetching categories: %s" % str(e)))
 
     def _get_packages(self, category):
+        if self._indexed is not None:
+            pkgs = self._indexed.get(category, {})
+            self._versions_tmp_cache.update(
+                ((category, pkg), versions) for pkg, versions in pkgs.iteritems())
+            return tuple(pkgs)
+        d = self._list_packages(category)
+        self._versions_tmp_cache.update(d)
+        return tuple(pkg for _category, pkg in d)
+
+    def _list_packages(self, category):
+        # mapping of (category, package) to the versions in a category
+        # directory.
         cpath = pjoin(self.base, category.lstrip(os.path.sep))
-        l = set()
         d = {}
         lext = len(self.extension)
         bad = False
@@ -307,15 +423,12 @@ class tree(prototype.tree):
                     raise InvalidCPV(
                         "%s/%s: -%s version component is "
                         "not standard." % (category, pv, bad))
-                l.add(pkg.package)
                 d.setdefault((category, pkg.package), []).append(pkg.fullver)
         except EnvironmentError as e:
             raise_from(KeyError(
                 "failed fetching packages for category %s: %s" %
                 (pjoin(self.base, category.lstrip(os.path.sep)), str(e))))
-
-        self._versions_tmp_cache.update(d)
-        return tuple(l)
+        return d
 
     def _get_versions(self, catpkg):
         return tuple(self._versions_tmp_cache.pop(catpkg))
@@ -332,7 +445,9 @@ class tree(prototype.tree):
             if force:
                 raise KeyError
             cache_data = self.cache[pkg.cpvstr]
-            if int(cache_data['mtime']) != int(xpak.mtime):
+            # a trusted index isn't checked against the binpkg.
+            if not self._trusted and \
+                    int(cache_data['mtime']) != int(xpak.mtime):
                 raise KeyError
         except KeyError:
             cache_data = self.cache.update_from_xpak(pkg, xpak)
@@ -347,6 +462,9 @@ class tree(prototype.tree):
 
     def notify_remove_package(self, pkg):
         prototype.tree.notify_remove_package(self, pkg)
+        if pkg.cpvstr in self.cache:
+            del self.cache[pkg.cpvstr]
+            self.cache.commit()
         try:
             os.rmdir(pjoin(self.base, pkg.category))
         except OSError as oe:
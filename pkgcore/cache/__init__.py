@@ -32,10 +32,13 @@ class base(object):
         or queues up updates.
     :ivar cleanse_keys: Boolean controlling whether the template should drop
         empty keys for storing.
+    :ivar concurrent_writes: Boolean controlling whether separate processes
+        may safely update the same backing store at once.
     """
 
     autocommits = False
     cleanse_keys = False
+    concurrent_writes = False
     default_sync_rate = 1
     chf_type = 'mtime'
     eclass_chf_types = ('mtime',)
@@ -315,3 +318,8 @@ class bulk(base):
         if self._pending_updates or force:
             self._write_data()
             self._pending_updates = []
+
+    def discard_pending(self):
+        """Forget queued updates without writing them; they stay visible
+        through this instance."""
+        self._pending_updates = []
@@ -35,6 +35,7 @@ class database(fs_template.FsBased):
 
 
     autocommits = True
+    concurrent_writes = True
     mtime_in_entry = True
     eclass_chf_types = ('eclassdir', 'mtime')
 
@@ -0,0 +1,285 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+single file, append only cache backend
+
+All entries live in one file; each record is a ``cpv<TAB>length`` header
+line followed by ``length`` bytes of ``key=value`` lines.  Rewrites and
+deletions append a new record (a length of -1 marks a deletion), so the
+last record for a cpv wins.  On first access the record headers are
+scanned into an offset index, and lookups become a dict probe plus a slice
+of the memory mapped file instead of an open/read per cpv.
+
+Appending writers hold a shared lock on a separate lock file, while
+compaction (which replaces the data file) holds it exclusively, so no
+append can land in a data file that's being replaced.
+"""
+
+__all__ = ("database",)
+
+import errno
+import fcntl
+import mmap
+import os
+
+from snakeoil.compatibility import raise_from
+from snakeoil.fileutils import AtomicWriteFile
+from snakeoil.osutils import pjoin
+
+from pkgcore.cache import fs_template, errors
+from pkgcore.config import ConfigHint
+
+
+class database(fs_template.FsBased):
+
+    """
+    stores all cache entries in a single indexed, memory mapped file
+
+    Updates are queued and appended in one write per commit; use
+    :obj:`compact` (invoked automatically by a forced commit once more than
+    half of the file is dead records) to reclaim space.
+    """
+
+    pkgcore_config_type = ConfigHint(
+        {'readonly': 'bool', 'location': 'str', 'label': 'str',
+         'auxdbkeys': 'list'},
+        required=['location'],
+        positional=['location'],
+        typename='cache')
+
+    autocommits = False
+    concurrent_writes = True
+    default_sync_rate = 100
+    chf_type = 'md5'
+    eclass_chf_types = ('md5',)
+
+    filename = 'pkgcore-index'
+    lockname = 'pkgcore-index.lock'
+    magic = 'pkgcore-indexed-cache-1\n'
+
+    def __init__(self, location, **config):
+        fs_template.FsBased.__init__(self, location, **config)
+        self.path = pjoin(self.location, self.filename)
+        self.lock_path = pjoin(self.location, self.lockname)
+        self._pending = {}
+        self._reset_index()
+
+    def _reset_index(self):
+        self._index = None
+        self._map = None
+        self._inode = None
+        self._end = 0
+        self._waste = 0
+
+    @property
+    def index(self):
+        """mapping of cpv to (offset, length) within the data file"""
+        if self._index is None:
+            self._index = {}
+            self._scan()
+        return self._index
+
+    def _refresh(self):
+        """Bring the index up to date with records from other writers."""
+        if self._index is None:
+            self.index
+        else:
+            self._scan()
+
+    def _scan(self):
+        """Index any records appended since the last scan."""
+        try:
+            f = open(self.path, 'rb')
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise_from(errors.GeneralCacheCorruption(e))
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if self._inode is not None and st.st_ino != self._inode:
+                # compacted by someone else; our offsets are meaningless now.
+                self._index.clear()
+                self._end = self._waste = 0
+            self._inode = st.st_ino
+            size = st.st_size
+            if size <= max(self._end, len(self.magic)):
+                self._end = max(self._end, min(size, len(self.magic)))
+                return
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+        if data[:len(self.magic)] != self.magic:
+            raise errors.GeneralCacheCorruption(
+                "%s isn't a pkgcore indexed cache" % (self.path,))
+        index = self._index
+        pos = max(self._end, len(self.magic))
+        while pos < size:
+            eol = data.find('\n', pos)
+            if eol == -1:
+                # partial header from an interrupted writer
+                break
+            try:
+                cpv, length = data[pos:eol].rsplit('\t', 1)
+                length = int(length)
+            except ValueError:
+                raise_from(errors.GeneralCacheCorruption(
+                    "%s: invalid record header at offset %i" %
+                    (self.path, pos)))
+            start = eol + 1
+            if start + max(length, 0) > size:
+                # partial record from an interrupted writer
+                break
+            old = index.pop(cpv, None)
+            if old is not None:
+                self._waste += old[1]
+            if length >= 0:
+                index[cpv] = (start, length)
+            else:
+                self._waste += start - pos
+            pos = start + max(length, 0)
+        self._map = data
+        self._end = pos
+
+    def _getitem(self, cpv):
+        payload = self._pending.get(cpv, self)
+        if payload is self:
+            try:
+                offset, length = self.index[cpv]
+            except KeyError:
+                # may have been appended by another process since our scan.
+                self._scan()
+                offset, length = self._index[cpv]
+            payload = self._map[offset:offset + length]
+        elif payload is None:
+            raise KeyError(cpv)
+        return self._parse_data(cpv, payload.splitlines())
+
+    def _parse_data(self, cpv, data):
+        d = self._cdict_kls()
+        known = self._known_keys
+        for x in data:
+            k, v = x.split("=", 1)
+            if k in known:
+                d[k] = v
+        try:
+            d[self._chf_key] = self._chf_deserializer(d[self._chf_key])
+        except (KeyError, ValueError) as e:
+            raise_from(errors.CacheCorruption(cpv, e))
+        return d
+
+    def _setitem(self, cpv, values):
+        known = self._known_keys
+        self._pending[cpv] = ''.join(
+            "%s=%s\n" % (k, v) for k, v in sorted(values.iteritems())
+            if k in known)
+
+    def _delitem(self, cpv):
+        if cpv not in self:
+            raise KeyError(cpv)
+        self._pending[cpv] = None
+
+    def __contains__(self, cpv):
+        payload = self._pending.get(cpv, self)
+        if payload is self:
+            return cpv in self.index
+        return payload is not None
+
+    def iterkeys(self):
+        pending = self._pending
+        for cpv in self.index.keys():
+            if cpv not in pending:
+                yield cpv
+        for cpv, payload in pending.items():
+            if payload is not None:
+                yield cpv
+
+    def _create(self):
+        if not self._ensure_dirs():
+            raise errors.GeneralCacheCorruption(
+                "failed creating %s" % (self.location,))
+        fd = os.open(self.path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+        try:
+            # if someone else won the race, the magic is already there.
+            if not os.fstat(fd).st_size:
+                os.write(fd, self.magic)
+        finally:
+            os.close(fd)
+
+    def _lock(self, exclusive=False):
+        """Lock the data file against compaction (or, if exclusive, against
+        any writer); return the lock's fd, closing it releases the lock."""
+        fd = os.open(self.lock_path, os.O_RDWR|os.O_CREAT, 0644)
+        try:
+            self._ensure_access(self.lock_path)
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def _serialize(items):
+        for cpv, payload in items:
+            if payload is None:
+                yield "%s\t-1\n" % (cpv,)
+            else:
+                yield "%s\t%i\n%s" % (cpv, len(payload), payload)
+
+    def commit(self, force=False):
+        if self._pending:
+            # make sure we've indexed everything prior to our append
+            self.index
+            data = ''.join(self._serialize(self._pending.iteritems()))
+            try:
+                if not self._end:
+                    self._create()
+                lock = self._lock()
+                try:
+                    # single write with O_APPEND; concurrent writers can't
+                    # interleave within a record.
+                    fd = os.open(self.path, os.O_WRONLY|os.O_APPEND)
+                    try:
+                        os.write(fd, data)
+                    finally:
+                        os.close(fd)
+                finally:
+                    os.close(lock)
+            except EnvironmentError as e:
+                raise_from(errors.GeneralCacheCorruption(e))
+            self._ensure_access(self.path)
+            self._pending.clear()
+            self._scan()
+        if force and not self.readonly:
+            self._refresh()
+            if self._waste > self._end // 2:
+                self.compact()
+
+    def compact(self):
+        """Rewrite the data file dropping all superseded records."""
+        if self.readonly:
+            raise errors.ReadOnly()
+        self.commit()
+        try:
+            lock = self._lock(exclusive=True)
+        except EnvironmentError as e:
+            raise_from(errors.GeneralCacheCorruption(e))
+        try:
+            # pick up whatever was appended before we got the lock.
+            self._refresh()
+            index, data = self._index, self._map
+            if data is None:
+                return
+            f = AtomicWriteFile(self.path, binary=True)
+            try:
+                f.write(self.magic)
+                f.writelines(self._serialize(
+                    (cpv, data[offset:offset + length])
+                    for cpv, (offset, length) in sorted(index.iteritems())))
+                f.close()
+            except EnvironmentError as e:
+                f.discard()
+                raise_from(errors.GeneralCacheCorruption(e))
+            self._ensure_access(self.path)
+        finally:
+            os.close(lock)
+        self._reset_index()
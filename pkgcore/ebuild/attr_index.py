@@ -0,0 +1,355 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+secondary indexes of package attribute values for ebuild repositories
+
+Queries on keywords, license, inherited eclasses or maintainers normally
+have to instantiate every package and load its metadata just to reject it.
+:obj:`AttrIndex` maps the values of those attributes to the cpvs carrying
+them, so :obj:`pkgcore.repository.prototype.tree.itermatch` only has to
+look at packages that can match.
+
+The index is kept up to date by ``pmaint regen`` (for repos configured
+with one), which records each cpv with the state of its ebuild, its
+package's metadata.xml and the eclasses it inherits, and reindexes what
+changed.  Queries don't stat every ebuild to revalidate it: packages whose
+directory changed since (versions were added or removed, or files replaced,
+as syncing and most editors do), packages inheriting changed eclasses and
+packages that failed indexing are treated as candidates for every query,
+and candidates whose ebuild vanished are dropped.  Files rewritten in place
+without touching their package directory are picked up on the next regen,
+as with the metadata cache itself.
+"""
+
+__all__ = ("AttrIndex",)
+
+import errno
+import os
+
+from snakeoil import compatibility
+from snakeoil.demandload import demandload
+from snakeoil.lists import iflatten_instance
+from snakeoil.osutils import pjoin
+
+demandload(
+    'snakeoil.fileutils:AtomicWriteFile',
+    'pkgcore.ebuild.cpv:versioned_CPV',
+    'pkgcore.ebuild.errors:InvalidCPV',
+    'pkgcore.ebuild.repo_objs:Maintainer',
+    'pkgcore.log:logger',
+    'pkgcore.restrictions:packages,values',
+)
+
+
+def _clean(val):
+    # fields are tab separated, one record per line.
+    if val is None:
+        return ''
+    if isinstance(val, unicode):
+        val = val.encode('utf8')
+    return ' '.join(val.split())
+
+
+def _unclean(val):
+    if not val:
+        return None
+    return val.decode('utf8')
+
+
+class AttrIndex(object):
+
+    """
+    mapping of indexed package attributes to value -> cpvs mappings
+
+    :ivar values: dict of attr name to dict of value to set of cpv strings;
+        maintainers are keyed by (email, name, description) tuples
+    :ivar ebuilds: dict of cpv to the (mtime, size) its ebuild had when
+        indexed
+    :ivar metadata_xml: dict of cat/pkg to the mtime of its metadata.xml
+    :ivar eclasses: dict of eclass name to its mtime when indexed
+    :ivar packages: dict of cat/pkg to the mtime of its directory when
+        indexed
+    :ivar unindexed: set of cpvs that failed indexing
+    """
+
+    magic = 'pkgcore-attr-index-3'
+    attrs = ('keywords', 'license', 'inherited', 'maintainers')
+
+    def __init__(self, path):
+        self.path = path
+        self.values = {attr: {} for attr in self.attrs}
+        self.ebuilds = {}
+        self.metadata_xml = {}
+        self.eclasses = {}
+        self.packages = {}
+        self.unindexed = set()
+        self._reset()
+
+    def _reset(self):
+        self._stale = None
+
+    @classmethod
+    def load(cls, path):
+        """Load an index from disk; missing or invalid files yield an empty
+        index."""
+        obj = cls(path)
+        try:
+            f = open(path)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("failed reading attr index %s: %s", path, e)
+            return obj
+        with f:
+            if f.readline().rstrip('\n') != cls.magic:
+                return obj
+            for line in f:
+                l = line.rstrip('\n').split('\t')
+                try:
+                    obj._load_line(l)
+                except (ValueError, IndexError):
+                    continue
+        return obj
+
+    def _load_line(self, l):
+        kind = l[0]
+        if kind == 'ebuild':
+            self.ebuilds[l[1]] = (long(l[2]), long(l[3]))
+        elif kind == 'xml':
+            self.metadata_xml[l[1]] = long(l[2]) if l[2] else None
+        elif kind == 'eclass':
+            self.eclasses[l[1]] = long(l[2])
+        elif kind == 'package':
+            self.packages[l[1]] = long(l[2]) if l[2] else None
+        elif kind == 'unindexed':
+            self.unindexed.add(l[1])
+        elif kind == 'maintainers':
+            key = tuple(_unclean(x) for x in l[1:4])
+            self.values[kind][key] = set(l[4].split())
+        elif kind in self.values:
+            self.values[kind][l[1]] = set(l[2].split())
+
+    def write(self):
+        f = AtomicWriteFile(self.path)
+        try:
+            f.write("%s\n" % (self.magic,))
+            for name, mtime in sorted(self.eclasses.iteritems()):
+                f.write("eclass\t%s\t%i\n" % (name, mtime))
+            for cp, mtime in sorted(self.packages.iteritems()):
+                f.write("package\t%s\t%s\n" % (
+                    cp, '' if mtime is None else mtime))
+            for cpv in sorted(self.unindexed):
+                f.write("unindexed\t%s\n" % (cpv,))
+            for cp, mtime in sorted(self.metadata_xml.iteritems()):
+                f.write("xml\t%s\t%s\n" % (cp, '' if mtime is None else mtime))
+            for cpv, (mtime, size) in sorted(self.ebuilds.iteritems()):
+                f.write("ebuild\t%s\t%i\t%i\n" % (cpv, mtime, size))
+            for attr in self.attrs:
+                for key, cpvs in sorted(self.values[attr].iteritems()):
+                    if attr == 'maintainers':
+                        key = '\t'.join(_clean(x) for x in key)
+                    f.write("%s\t%s\t%s\n" % (attr, key, ' '.join(sorted(cpvs))))
+            f.close()
+        except:
+            f.discard()
+            raise
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            return None
+        return long(st.st_mtime), long(st.st_size)
+
+    @classmethod
+    def _mtime(cls, *path):
+        st = cls._stat(pjoin(*path))
+        if st is None:
+            return None
+        return st[0]
+
+    @staticmethod
+    def _eclass_mtimes(repo):
+        mtimes = {}
+        for name, hashed in repo.eclass_cache.eclasses.iteritems():
+            try:
+                mtimes[name] = long(hashed.mtime)
+            except EnvironmentError:
+                continue
+        return mtimes
+
+    def _walk(self, repo):
+        """Yield (cpv, (cat, pkg, ver), ebuild stat, metadata.xml mtime)
+        for every ebuild in the repo."""
+        for (cat, pkg), vers in repo.versions.iteritems():
+            cp = '%s/%s' % (cat, pkg)
+            xml = self._mtime(repo.location, cp, 'metadata.xml')
+            for ver in vers:
+                path = pjoin(repo.location, cat, pkg, '%s-%s%s' % (
+                    pkg, ver, repo.extension))
+                yield '%s-%s' % (cp, ver), (cat, pkg, ver), self._stat(path), xml
+
+    def _changed_eclasses(self, repo):
+        current = self._eclass_mtimes(repo)
+        changed = set(current).symmetric_difference(self.eclasses)
+        changed.update(
+            name for name, mtime in current.iteritems()
+            if name in self.eclasses and self.eclasses[name] != mtime)
+        return changed
+
+    def stale(self, repo):
+        """Return the cpvs in the repo the index can't answer for.
+
+        These are the versions of packages whose directory changed since
+        the index was updated, and the indexed packages inheriting eclasses
+        that changed; neither requires looking at individual ebuilds.  This
+        is computed once per instance; :obj:`update` resets it.
+        """
+        if self._stale is not None:
+            return self._stale
+        stale = set()
+        inherited = self.values['inherited']
+        for name in self._changed_eclasses(repo):
+            stale.update(inherited.get(name, ()))
+        for (cat, pkg), vers in repo.versions.iteritems():
+            cp = '%s/%s' % (cat, pkg)
+            if self._mtime(repo.location, cp) != self.packages.get(cp, -1):
+                stale.update('%s-%s' % (cp, ver) for ver in vers)
+        self._stale = frozenset(stale)
+        return self._stale
+
+    def _changed(self, repo):
+        """Return the cpvs in the repo whose ebuild, metadata.xml or
+        inherited eclasses changed since they were indexed, and a dict of
+        every cpv in the repo to its (cat, pkg, ver), ebuild stat and
+        metadata.xml mtime.
+
+        Unlike :obj:`stale`, this walks the whole repo.
+        """
+        inherited = self.values['inherited']
+        stale = set()
+        for name in self._changed_eclasses(repo):
+            stale.update(inherited.get(name, ()))
+        cpvs = {}
+        for cpv, key, st, xml in self._walk(repo):
+            cpvs[cpv] = (key, st, xml)
+            if (st is None or self.ebuilds.get(cpv) != st or
+                    self.metadata_xml.get(key[0] + '/' + key[1], -1) != xml):
+                stale.add(cpv)
+        return frozenset(stale.intersection(cpvs)), cpvs
+
+    def update(self, repo, observer=None):
+        """Bring the index up to date with a repo, reindexing changed
+        packages from their metadata."""
+        stale, cpvs = self._changed(repo)
+        dead = stale.union(cpv for cpv in self.ebuilds if cpv not in cpvs)
+        for d in self.values.itervalues():
+            for key, s in d.items():
+                s.difference_update(dead)
+                if not s:
+                    del d[key]
+        for cpv in dead:
+            self.ebuilds.pop(cpv, None)
+
+        xml = {}
+        self.unindexed.clear()
+        for cpv, (key, st, xml_mtime) in cpvs.iteritems():
+            xml['%s/%s' % key[:2]] = xml_mtime
+            if cpv not in stale or st is None:
+                continue
+            try:
+                pkg = repo.package_class(*key)
+                vals = {
+                    'keywords': pkg.keywords,
+                    'license': iflatten_instance(pkg.license),
+                    'inherited': pkg.inherited,
+                    'maintainers': ((m.email, m.name, m.description)
+                                    for m in pkg.maintainers),
+                }
+                for attr, l in vals.iteritems():
+                    d = self.values[attr]
+                    for val in l:
+                        d.setdefault(val, set()).add(cpv)
+            except compatibility.IGNORED_EXCEPTIONS:
+                raise
+            except Exception as e:
+                # left unindexed, so it stays a candidate for every query.
+                if observer is not None:
+                    observer.warn("failed indexing %s: %s", cpv, e)
+                self.unindexed.add(cpv)
+                continue
+            self.ebuilds[cpv] = st
+        self.metadata_xml = xml
+        self.eclasses = self._eclass_mtimes(repo)
+        self.packages = dict(
+            (cp, self._mtime(repo.location, cp)) for cp in xml)
+        self._reset()
+
+    def _element(self, attr, key):
+        if attr == 'maintainers':
+            return Maintainer(email=key[0], name=key[1], description=key[2])
+        return key
+
+    def _evaluate(self, term):
+        """Return the set of indexed cpvs a restriction term may match, or
+        None if the term can't be answered from the index."""
+        if not isinstance(term, packages.PackageRestriction) or term.negate:
+            return None
+        d = self.values.get(term.attr)
+        if d is None:
+            return None
+        r = term.restriction
+        if isinstance(r, values.ContainmentMatch2) and not r.negate:
+            if term.attr == 'maintainers':
+                return None
+            sets = [d.get(x, frozenset()) for x in r.vals]
+            if not sets:
+                return None
+            if r.all:
+                return frozenset.intersection(*map(frozenset, sets))
+            return frozenset().union(*sets)
+        if isinstance(r, values.AnyMatch) and not r.negate:
+            match = r.restriction.match
+            s = set()
+            for key, cpvs in d.iteritems():
+                if match(self._element(term.attr, key)):
+                    s.update(cpvs)
+            return s
+        return None
+
+    def candidates(self, repo, terms):
+        """Return the packages that may match a set of ANDed restriction terms.
+
+        :return: dict of (cat, pkg) to a tuple of versions, or None if none
+            of the terms can be answered from the index
+        """
+        if not self.ebuilds:
+            return None
+        matched = None
+        for term in terms:
+            s = self._evaluate(term)
+            if s is None:
+                continue
+            if matched is None:
+                matched = set(s)
+            else:
+                matched.intersection_update(s)
+        if matched is None:
+            return None
+        matched.update(self.stale(repo))
+        matched.update(self.unindexed)
+        d = {}
+        for cpv in matched:
+            try:
+                cpv = versioned_CPV(cpv)
+            except InvalidCPV:
+                continue
+            # only candidates are checked for having been removed.
+            path = pjoin(
+                repo.location, cpv.category, cpv.package,
+                '%s-%s%s' % (cpv.package, cpv.fullver, repo.extension))
+            if self._stat(path) is None:
+                continue
+            d.setdefault((cpv.category, cpv.package), []).append(cpv.fullver)
+        return {k: tuple(v) for k, v in d.iteritems()}
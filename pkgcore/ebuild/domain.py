@@ -180,6 +180,8 @@ class domain(config_domain):
         self.profile = profile
         pkg_masks, pkg_unmasks, pkg_keywords, pkg_licenses = [], [], [], []
         pkg_use, self.bashrcs = [], []
+        # user config files/dirs read, for cache validation.
+        self.config_files = []
 
         self.ebuild_hook_dir = settings.pop("ebuild_hook_dir", None)
 
@@ -194,6 +196,7 @@ class domain(config_domain):
             ):
 
             for fp in settings.pop(key, ()):
+                self.config_files.append(fp)
                 try:
                     if key == "package.env":
                         base = self.ebuild_hook_dir
@@ -5,7 +5,7 @@
 in memory representation of on disk eclass stacking order
 """
 
-__all__ = ("base", "cache", "StackedCaches")
+__all__ = ("base", "cache", "StackedCaches", "UsageIndex")
 
 from snakeoil.chksum import LazilyHashedPath
 from snakeoil.compatibility import intern
@@ -20,9 +20,12 @@ from pkgcore.config import ConfigHint
 
 demandload(
     "errno",
+    "itertools:chain",
     "os",
+    "snakeoil.fileutils:AtomicWriteFile",
     "snakeoil.mappings:StackedDict",
     "snakeoil.osutils:normpath",
+    "pkgcore.cache:errors@cache_errors",
 )
 
 
@@ -33,6 +36,11 @@ class base(object):
 
     def __init__(self, location=None, eclassdir=None):
         self._eclass_data_inst_cache = WeakValCache()
+        # (eclass, chksums) -> eclass data, or None if invalid, and likewise
+        # for whole cache entries; see rebuild_cache_entry.
+        self._validated_eclasses = {}
+        self._validated_entries = {}
+        self._eclassdir_mtimes = None
         # generate this.
         # self.eclasses = {} # {"Name": ("location", "_mtime_")}
         self.location = location
@@ -62,25 +70,71 @@ class base(object):
 
     eclasses = jit_attr_ext_method("_load_eclasses", "_eclasses")
 
+    def _get_eclassdir_mtimes(self):
+        """Return the mtimes of the eclass directories backing this cache."""
+        return ()
+
+    def invalidate_if_modified(self):
+        """Drop the eclass view and validation results if the eclass
+        directories were modified since they were loaded.
+
+        Note this only catches eclasses being added, removed, or replaced
+        via rename; in place edits don't change the directory mtime.
+
+        :return: True if the cache was invalidated
+        """
+        mtimes = self._get_eclassdir_mtimes()
+        if mtimes == self._eclassdir_mtimes:
+            return False
+        self._eclassdir_mtimes = mtimes
+        self.__dict__.pop('_eclasses', None)
+        self._eclass_data_inst_cache = WeakValCache()
+        self._validated_eclasses.clear()
+        self._validated_entries.clear()
+        return True
+
     def rebuild_cache_entry(self, entry_eclasses):
         """Check if eclass data is still valid.
 
-        Given a dict as returned by get_eclass_data, walk it comparing
-        it to internal eclass view.
+        Given a sequence of (eclass, chksums) pairs as stored in a cache
+        entry, walk it comparing it to internal eclass view.  Results are
+        memoized both per eclass and per entry; since most ebuilds share a
+        handful of eclass combinations, validating a full cache costs
+        little more than a dict lookup per entry.
 
-        :return: a boolean representing whether that eclass data is still
-            up to date, or not
+        :return: a mapping of eclass name to eclass data if that eclass data
+            is still up to date, else None
         """
+        key = tuple(entry_eclasses)
+        try:
+            return self._validated_entries[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable chksums; do it the slow way.
+            return self._rebuild_cache_entry(key)
+        d = self._validated_entries[key] = self._rebuild_cache_entry(
+            key, self._validated_eclasses)
+        return d
+
+    def _rebuild_cache_entry(self, entry_eclasses, memo=None):
         ec = self.eclasses
         d = {}
 
-        for eclass, chksums in entry_eclasses:
-            data = ec.get(eclass)
-            if any(val != getattr(data, chf, None) for chf, val in chksums):
+        for item in entry_eclasses:
+            data = memo.get(item, self) if memo is not None else self
+            if data is self:
+                eclass, chksums = item
+                data = ec.get(eclass)
+                if any(val != getattr(data, chf, None) for chf, val in chksums):
+                    data = None
+                if memo is not None:
+                    memo[item] = data
+            if data is None:
                 return None
-            d[eclass] = data
+            d[item[0]] = data
 
-        return d
+        return ImmutableDict(d)
 
 
 class cache(base):
@@ -94,8 +148,16 @@ class cache(base):
         """
         base.__init__(self, location=location, eclassdir=normpath(path))
 
+    def _get_eclassdir_mtimes(self):
+        try:
+            return (os.stat(self.eclassdir).st_mtime,)
+        except EnvironmentError:
+            return (None,)
+
     def _load_eclasses(self):
         """Force an update of the internal view of on disk/remote eclasses."""
+        if self._eclassdir_mtimes is None:
+            self._eclassdir_mtimes = self._get_eclassdir_mtimes()
         ec = {}
         eclass_len = len(".eclass")
         try:
@@ -143,5 +205,140 @@ class StackedCaches(base):
         self._caches = caches
         base.__init__(self, **kwds)
 
+    def _get_eclassdir_mtimes(self):
+        return tuple(chain.from_iterable(
+            ec._get_eclassdir_mtimes() for ec in self._caches))
+
+    def invalidate_if_modified(self):
+        # the stacked view references the underlying caches' eclass views,
+        # so those need to be reset too.
+        changed = [ec.invalidate_if_modified() for ec in self._caches]
+        if any(changed):
+            self._eclassdir_mtimes = None
+        return base.invalidate_if_modified(self)
+
     def _load_eclasses(self):
+        if self._eclassdir_mtimes is None:
+            self._eclassdir_mtimes = self._get_eclassdir_mtimes()
         return StackedDict(*[ec.eclasses for ec in self._caches])
+
+
+class UsageIndex(object):
+
+    """
+    reverse index of which packages inherit which eclasses
+
+    Built from the _eclasses_ data of metadata cache entries, and optionally
+    persisted to disk so that questions such as "which packages inherit
+    eutils" can be answered without instantiating every package.  Since the
+    eclass view is shared between repos, this is maintained per repo.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._inherits = {}
+        self._users = {}
+
+    @classmethod
+    def load(cls, path):
+        """Load a persisted index, returning None if it doesn't exist."""
+        try:
+            f = open(path)
+        except EnvironmentError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return None
+        inherits = {}
+        with f:
+            for line in f:
+                eclass, _sep, cpvs = line.rstrip('\n').partition('\t')
+                for cpv in cpvs.split():
+                    l = inherits.setdefault(cpv, [])
+                    if eclass:
+                        l.append(intern(eclass))
+        obj = cls(path)
+        for cpv, eclasses in inherits.iteritems():
+            obj.update(cpv, eclasses)
+        return obj
+
+    @classmethod
+    def from_caches(cls, cpvs, caches, path=None):
+        """Build an index from the first cache holding each cpv.
+
+        :param cpvs: iterable of cpv strings to index
+        :param caches: sequence of :obj:`pkgcore.cache.base` instances
+        """
+        obj = cls(path)
+        for cpv in cpvs:
+            for cache in caches:
+                try:
+                    eclasses = cache[cpv].get('_eclasses_', ())
+                except (KeyError, cache_errors.CacheError):
+                    continue
+                obj.update(cpv, (x[0] for x in eclasses))
+                break
+        return obj
+
+    def __contains__(self, eclass):
+        return eclass in self._users
+
+    def __getitem__(self, eclass):
+        """Return the cpvs inheriting the given eclass."""
+        return frozenset(self._users.get(eclass, ()))
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def __len__(self):
+        return len(self._users)
+
+    def iteritems(self):
+        for eclass, cpvs in self._users.iteritems():
+            yield eclass, frozenset(cpvs)
+
+    @property
+    def cpvs(self):
+        """cpvs known to this index"""
+        return frozenset(self._inherits)
+
+    def inherited(self, cpv):
+        """Return the eclasses a cpv inherits; KeyError if not indexed."""
+        return self._inherits[cpv]
+
+    def dependents(self, eclasses):
+        """Return the cpvs inheriting any of the given eclasses."""
+        users = self._users
+        result = set()
+        for eclass in eclasses:
+            result.update(users.get(eclass, ()))
+        return result
+
+    def update(self, cpv, eclasses):
+        """Set the eclasses a cpv inherits."""
+        self.discard(cpv)
+        eclasses = frozenset(eclasses)
+        self._inherits[cpv] = eclasses
+        for eclass in eclasses:
+            self._users.setdefault(eclass, set()).add(cpv)
+
+    def discard(self, cpv):
+        """Drop a cpv from the index if it's present."""
+        users = self._users
+        for eclass in self._inherits.pop(cpv, ()):
+            s = users[eclass]
+            s.discard(cpv)
+            if not s:
+                del users[eclass]
+
+    def write(self, path=None):
+        if path is None:
+            path = self.path
+        f = AtomicWriteFile(path)
+        for eclass, cpvs in sorted(self._users.iteritems()):
+            f.write("%s\t%s\n" % (eclass, ' '.join(sorted(cpvs))))
+        # packages inheriting nothing still need to be known as indexed.
+        none = sorted(cpv for cpv, eclasses in self._inherits.iteritems()
+                      if not eclasses)
+        if none:
+            f.write("\t%s\n" % (' '.join(none),))
+        f.close()
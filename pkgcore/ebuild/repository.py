@@ -36,9 +36,11 @@ demandload(
     'snakeoil.data_source:local_source',
     'pkgcore.ebuild:cpv,digest,ebd,repo_objs,atom,restricts,profiles,processor',
     'pkgcore.ebuild:errors@ebuild_errors',
+    'pkgcore.ebuild.attr_index:AttrIndex',
     'pkgcore.fs.livefs:sorted_scan',
     'pkgcore.log:logger',
     'pkgcore.package:errors@pkg_errors',
+    'pkgcore.repository:listing',
     'pkgcore.restrictions:packages',
     'pkgcore.util.packages:groupby_pkg',
 )
@@ -163,10 +165,14 @@ def _sort_eclasses(config, raw_repo, eclasses):
         'default_mirrors': 'list',
         'override_repo_id': 'str',
         'ignore_paludis_versioning': 'bool',
-        'allow_missing_manifests': 'bool'},
+        'allow_missing_manifests': 'bool',
+        'listing_index': 'str',
+        'prefetch_threads': 'int',
+        'attr_index': 'str'},
     requires_config='config')
 def tree(config, raw_repo, cache=(), eclass_override=None, default_mirrors=None,
-         ignore_paludis_versioning=False, allow_missing_manifests=False):
+         ignore_paludis_versioning=False, allow_missing_manifests=False,
+         listing_index=None, prefetch_threads=0, attr_index=None):
     eclass_override = _sort_eclasses(config, raw_repo, eclass_override)
 
     return _UnconfiguredTree(
@@ -174,7 +180,8 @@ def tree(config, raw_repo, cache=(), eclass_override=None, default_mirrors=None,
         default_mirrors=default_mirrors,
         ignore_paludis_versioning=ignore_paludis_versioning,
         allow_missing_manifests=allow_missing_manifests,
-        repo_config=raw_repo)
+        repo_config=raw_repo, listing_index=listing_index,
+        prefetch_threads=prefetch_threads, attr_index=attr_index)
 
 @configurable(
     typename='repo',
@@ -185,10 +192,14 @@ def tree(config, raw_repo, cache=(), eclass_override=None, default_mirrors=None,
         'default_mirrors': 'list',
         'override_repo_id': 'str',
         'ignore_paludis_versioning': 'bool',
-        'allow_missing_manifests': 'bool'},
+        'allow_missing_manifests': 'bool',
+        'listing_index': 'str',
+        'prefetch_threads': 'int',
+        'attr_index': 'str'},
     requires_config='config')
 def slavedtree(config, raw_repo, parent_repo, cache=(), eclass_override=None, default_mirrors=None,
-               ignore_paludis_versioning=False, allow_missing_manifests=False):
+               ignore_paludis_versioning=False, allow_missing_manifests=False,
+               listing_index=None, prefetch_threads=0, attr_index=None):
     eclass_override = _sort_eclasses(config, raw_repo, eclass_override)
 
     return _SlavedTree(
@@ -196,7 +207,8 @@ def slavedtree(config, raw_repo, parent_repo, cache=(), eclass_override=None, de
         default_mirrors=default_mirrors,
         ignore_paludis_versioning=ignore_paludis_versioning,
         allow_missing_manifests=allow_missing_manifests,
-        repo_config=raw_repo)
+        repo_config=raw_repo, listing_index=listing_index,
+        prefetch_threads=prefetch_threads, attr_index=attr_index)
 
 
 metadata_offset = "profiles"
@@ -231,13 +243,17 @@ class _UnconfiguredTree(prototype.tree):
         'ignore_paludis_versioning': 'bool',
         'allow_missing_manifests': 'bool',
         'repo_config': 'ref:raw_repo',
+        'listing_index': 'str',
+        'prefetch_threads': 'int',
+        'attr_index': 'str',
         },
         typename='repo')
 
     def __init__(self, location, eclass_cache, cache=(),
                  default_mirrors=None, override_repo_id=None,
                  ignore_paludis_versioning=False, allow_missing_manifests=False,
-                 repo_config=None):
+                 repo_config=None, listing_index=None, prefetch_threads=0,
+                 attr_index=None):
 
         """
         :param location: on disk location of the tree
@@ -252,6 +268,14 @@ class _UnconfiguredTree(prototype.tree):
             repository unique id
         :param ignore_paludis_versioning: If False, fail when -scm is encountred.  if True,
             silently ignore -scm ebuilds.
+        :param listing_index: Either None, or path to a
+            :obj:`pkgcore.repository.listing.ListingIndex` file used to avoid
+            relisting unchanged category and package directories
+        :param prefetch_threads: if more than 1, list directories using
+            that many threads when walking the whole tree
+        :param attr_index: Either None, or path to a
+            :obj:`pkgcore.ebuild.attr_index.AttrIndex` file used to narrow
+            down queries on keywords, license, inherited and maintainers
         """
 
         prototype.tree.__init__(self)
@@ -296,9 +320,20 @@ class _UnconfiguredTree(prototype.tree):
         self.package_class = self.package_factory(
             self, cache, self.eclass_cache, self.mirrors, self.default_mirrors)
         self._shared_pkg_cache = WeakValCache()
+        if listing_index is not None:
+            listing_index = listing.ListingIndex(listing_index, self.base)
+        self.listing_index = listing_index
+        self.prefetch_threads = prefetch_threads
+        self._attr_index_path = attr_index
 
     repo_id = klass.alias_attr("config.repo_id")
 
+    @klass.jit_attr
+    def attr_index(self):
+        if self._attr_index_path is None:
+            return None
+        return AttrIndex.load(self._attr_index_path)
+
     def path_restrict(self, path):
         """Return a restriction from a given path in a repo.
 
@@ -353,6 +388,8 @@ class _UnconfiguredTree(prototype.tree):
         """
 
         o = self.__class__(self.location, **kwds)
+        if o.listing_index is None:
+            o.listing_index = self.listing_index
         o.categories = self.categories
         o.packages = self.packages
         o.versions = self.versions
@@ -368,6 +405,11 @@ class _UnconfiguredTree(prototype.tree):
             cats = tuple(imap(intern, cats))
         return cats
 
+    def _listdir(self, path, lister):
+        if self.listing_index is None:
+            return lister(path)
+        return self.listing_index.listdir(path, lister)
+
     def _get_categories(self, *optional_category):
         # why the auto return? current porttrees don't allow/support
         # categories deeper then one dir.
@@ -380,7 +422,7 @@ class _UnconfiguredTree(prototype.tree):
         try:
             return tuple(imap(intern, ifilterfalse(
                 self.false_categories.__contains__,
-                (x for x in listdir_dirs(self.base) if x[0:1] != "."))))
+                (x for x in self._listdir(self.base, listdir_dirs) if x[0:1] != "."))))
         except EnvironmentError as e:
             raise_from(KeyError("failed fetching categories: %s" % str(e)))
 
@@ -388,7 +430,8 @@ class _UnconfiguredTree(prototype.tree):
         cpath = pjoin(self.base, category.lstrip(os.path.sep))
         try:
             return tuple(ifilterfalse(
-                self.false_packages.__contains__, listdir_dirs(cpath)))
+                self.false_packages.__contains__,
+                self._listdir(cpath, listdir_dirs)))
         except EnvironmentError as e:
             if e.errno == errno.ENOENT:
                 if self.hardcoded_categories and category in self.hardcoded_categories or \
@@ -406,7 +449,7 @@ class _UnconfiguredTree(prototype.tree):
         extension = self.extension
         ext_len = -len(extension)
         try:
-            ret = tuple(x[lp:ext_len] for x in listdir_files(cppath)
+            ret = tuple(x[lp:ext_len] for x in self._listdir(cppath, listdir_files)
                         if x[ext_len:] == extension and x[:lp] == pkg)
             if any(('scm' in x or '-try' in x) for x in ret):
                 if not self.ignore_paludis_versioning:
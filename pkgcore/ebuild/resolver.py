@@ -10,7 +10,7 @@ __all__ = ["upgrade_resolver", "min_install_resolver"]
 from snakeoil.demandload import demandload
 
 from pkgcore.repository import misc, multiplex
-from pkgcore.resolver import plan
+from pkgcore.resolver import plan, sat
 
 demandload(
     'pkgcore.restrictions:packages,values',
@@ -106,6 +106,10 @@ class empty_tree_merge_plan(plan.merge_plan):
             *[x for x in self.all_raw_dbs if not x.livefs])
 
 
+class empty_tree_sat_merge_plan(empty_tree_merge_plan, sat.sat_merge_plan):
+    pass
+
+
 def generate_replace_resolver_kls(resolver_kls):
 
     class replace_resolver(resolver_kls):
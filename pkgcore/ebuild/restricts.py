@@ -8,7 +8,7 @@
 atom version restrict
 """
 
-__all__ = ("VersionMatch",)
+__all__ = ("VersionMatch", "DepIntersects", "DepMatchesPkgs")
 
 from snakeoil.klass import generic_equality
 
@@ -315,3 +315,63 @@ def _parse_nontransitive_use(sequence):
     if default_on[0] or default_on[1]:
         r.append(UseDepDefault(True, *default_on))
     return r
+
+
+class _DepKeyRestriction(values.base):
+
+    """
+    value restriction on dependency atoms that only matches atoms of
+    specific package keys
+
+    Unlike a :obj:`pkgcore.restrictions.values.FunctionRestriction`, indexes
+    of dependencies (see :obj:`pkgcore.vdb.index.RevdepIndex`) can look the
+    atoms possibly matching it up by :obj:`keys`.
+    """
+
+    __slots__ = ()
+
+
+class DepIntersects(_DepKeyRestriction):
+
+    """matches dependency atoms intersecting an atom"""
+
+    __slots__ = __attr_comparison__ = ('atom', 'keys', 'negate')
+    __metaclass__ = generic_equality
+
+    def __init__(self, atom, negate=False):
+        object.__setattr__(self, 'atom', atom)
+        object.__setattr__(self, 'keys', frozenset([atom.key]))
+        object.__setattr__(self, 'negate', negate)
+
+    def match(self, val):
+        return self.atom.intersects(val) != self.negate
+
+    def __hash__(self):
+        return hash((self.atom, self.negate))
+
+    def __str__(self):
+        return '%sintersects %s' % ('not ' if self.negate else '', self.atom)
+
+
+class DepMatchesPkgs(_DepKeyRestriction):
+
+    """matches dependency atoms matching any of a set of packages"""
+
+    __slots__ = __attr_comparison__ = ('pkgs', 'keys', 'negate')
+    __metaclass__ = generic_equality
+
+    def __init__(self, pkgs, negate=False):
+        pkgs = tuple(pkgs)
+        object.__setattr__(self, 'pkgs', pkgs)
+        object.__setattr__(self, 'keys', frozenset(pkg.key for pkg in pkgs))
+        object.__setattr__(self, 'negate', negate)
+
+    def match(self, val):
+        return any(val.match(pkg) for pkg in self.pkgs) != self.negate
+
+    def __hash__(self):
+        return hash((self.pkgs, self.negate))
+
+    def __str__(self):
+        return '%smatches %s' % ('not ' if self.negate else '', ', '.join(
+            str(pkg.cpvstr) for pkg in self.pkgs))
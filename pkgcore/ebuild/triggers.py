@@ -29,6 +29,7 @@ demandload(
     'fnmatch',
     'snakeoil:compatibility',
     'pkgcore:os_data',
+    'pkgcore.util.repo_utils:get_raw_repos',
 )
 
 colon_parsed = frozenset([
@@ -454,14 +455,26 @@ class ProtectOwned(FileCollision):
         self.vdb = vdb
 
     def collision(self, colliding):
-        real_pkgs = (pkg for repo in self.vdb for pkg in repo if pkg.package_is_real)
         collisions = {}
-
-        # TODO: worth parallelizing this vdb scanning?
-        for pkg in real_pkgs:
-            pkg_file_collisions = pkg.contents.intersection(colliding)
-            if pkg_file_collisions:
-                collisions[pkg.cpvstr] = pkg_file_collisions
+        by_path = dict((x.location, x) for x in colliding)
+
+        for repo in get_raw_repos(self.vdb):
+            owners = getattr(repo, 'owners', None)
+            if owners is not None:
+                # vdb lookup, indexed where enabled.
+                for path, pkgs in owners(by_path).iteritems():
+                    for pkg in pkgs:
+                        if pkg.package_is_real:
+                            collisions.setdefault(pkg.cpvstr, []).append(
+                                by_path[path])
+                continue
+            # TODO: worth parallelizing this vdb scanning?
+            for pkg in repo:
+                if not pkg.package_is_real:
+                    continue
+                pkg_file_collisions = pkg.contents.intersection(colliding)
+                if pkg_file_collisions:
+                    collisions[pkg.cpvstr] = pkg_file_collisions
 
         if collisions:
             pkg_collisions = [
@@ -0,0 +1,167 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+background fetching of the files of many packages
+
+:obj:`Prefetcher` wraps a fetcher: files submitted to it are fetched (and
+verified) by a pool of worker threads, while calling it for a file behaves
+as calling the wrapped fetcher, except that it waits for the background
+fetch of the file if there is one.  Substituting it for the fetcher used by
+the build steps thus lets downloads run ahead of the builds, with each
+build blocking only on its own files.
+"""
+
+__all__ = ("Prefetcher",)
+
+import sys
+import threading
+from urlparse import urlsplit
+
+from snakeoil.klass import GetAttrProxy
+
+from pkgcore.fetch import fetchable as fetchable_kls
+
+
+def _host(target):
+    for uri in target.uri:
+        return urlsplit(uri).netloc
+    return None
+
+
+class _Task(object):
+
+    __slots__ = ("fetchable", "host", "state", "result", "exc_info", "done")
+
+    def __init__(self, target):
+        self.fetchable = target
+        self.host = _host(target)
+        self.state = 'pending'
+        self.result = self.exc_info = None
+        self.done = threading.Event()
+
+
+class Prefetcher(object):
+
+    """
+    fetcher wrapper fetching submitted files in background threads
+
+    The number of concurrent downloads from one host is limited; files are
+    attributed to the host of their first uri.
+    """
+
+    def __init__(self, fetcher, jobs=4, per_host=2):
+        """
+        :param fetcher: the :obj:`pkgcore.fetch.base.fetcher` to fetch with
+        :param jobs: number of worker threads
+        :param per_host: maximum number of concurrent fetches per host
+        """
+        self.fetcher = fetcher
+        self.jobs = max(jobs, 1)
+        self.per_host = max(per_host, 1)
+        self._tasks = {}
+        self._pending = []
+        self._active = {}
+        self._cond = threading.Condition()
+        self._workers = []
+        self._running = 0
+        self._stopped = False
+
+    __getattr__ = GetAttrProxy("fetcher")
+
+    def submit(self, fetchables):
+        """Queue files for fetching, in order.
+
+        Files without uris and those already submitted are ignored.
+        """
+        with self._cond:
+            for target in fetchables:
+                if not isinstance(target, fetchable_kls) or not target.uri:
+                    continue
+                if target.filename in self._tasks:
+                    continue
+                task = self._tasks[target.filename] = _Task(target)
+                self._pending.append(task)
+            while self._running < min(self.jobs, len(self._pending)):
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                self._workers.append(t)
+                self._running += 1
+                t.start()
+            self._cond.notify_all()
+
+    def _next_task(self):
+        for idx, task in enumerate(self._pending):
+            if self._active.get(task.host, 0) < self.per_host:
+                return self._start(self._pending.pop(idx))
+        return None
+
+    def _start(self, task):
+        # must be called with the lock held, so hosts are accounted for
+        # before any other worker picks its next task.
+        task.state = 'fetching'
+        self._active[task.host] = self._active.get(task.host, 0) + 1
+        return task
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = None
+                while not self._stopped:
+                    task = self._next_task()
+                    if task is not None or not self._pending:
+                        break
+                    self._cond.wait()
+                if task is None:
+                    self._running -= 1
+                    return
+            self._run(task)
+
+    def _run(self, task):
+        try:
+            task.result = self.fetcher(task.fetchable)
+        except Exception:
+            task.exc_info = sys.exc_info()
+        finally:
+            with self._cond:
+                self._active[task.host] -= 1
+                task.state = 'done'
+                self._cond.notify_all()
+            task.done.set()
+
+    def __call__(self, target):
+        """Fetch a file, waiting for its background fetch if it has one.
+
+        A file still queued is fetched directly, ahead of the queue.
+        """
+        with self._cond:
+            task = self._tasks.get(target.filename)
+            if task is not None and task.fetchable != target:
+                task = None
+            claimed = task is not None and task.state == 'pending'
+            if claimed:
+                if task in self._pending:
+                    self._pending.remove(task)
+                self._start(task)
+        if task is None:
+            return self.fetcher(target)
+        if claimed:
+            self._run(task)
+        task.done.wait()
+        if task.exc_info is not None:
+            raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+        return task.result
+
+    def shutdown(self, wait=False):
+        """Stop fetching queued files.
+
+        :param wait: if True, wait for the fetches in progress to finish
+        """
+        with self._cond:
+            self._stopped = True
+            del self._pending[:]
+            self._cond.notify_all()
+        if wait:
+            for t in self._workers:
+                t.join()
+        self._workers = []
@@ -1,14 +1,28 @@
 # Copyright: 2011 Brian Harring <ferringb@gmail.com>
 # License: GPL2/BSD 3 clause
 
+import Queue
+
 from snakeoil import compatibility
 from snakeoil.demandload import demandload
 
 demandload(
+    'errno',
+    'multiprocessing',
+    'os',
+    'snakeoil.chksum:LazilyHashedPath',
+    'snakeoil.fileutils:AtomicWriteFile',
+    'pkgcore.cache:errors@cache_errors',
+    'pkgcore.ebuild:eclass_cache,processor',
+    'pkgcore.ebuild.atom:atom',
     'pkgcore.util.thread_pool:map_async',
 )
 
 
+class RegenError(Exception):
+    """Raised when regeneration can't be completed."""
+
+
 def regen_iter(iterable, regen_func, observer, is_thread=False):
     for x in iterable:
         try:
@@ -21,7 +35,316 @@ def regen_iter(iterable, regen_func, observer, is_thread=False):
             observer.error("caught exception %s while processing %s", e, x)
 
 
-def regen_repository(repo, observer, threads=1, pkg_attr='keywords', **options):
+class RegenState(object):
+
+    """
+    ebuild and eclass state recorded at the end of an incremental regen
+
+    Each ebuild and eclass is recorded with its mtime, size and md5; which
+    packages inherit which eclasses is tracked by a
+    :obj:`pkgcore.ebuild.eclass_cache.UsageIndex` persisted next to it.
+    On the next run only packages whose ebuild changed, or that inherit a
+    changed eclass, need to be looked at; md5s are only computed when the
+    mtime or size differs from the record.
+    """
+
+    def __init__(self, path, usage_path):
+        self.path = path
+        self.ebuilds = {}
+        self.eclasses = {}
+        self.usage = eclass_cache.UsageIndex.load(usage_path)
+        if self.usage is None:
+            self.usage = eclass_cache.UsageIndex(usage_path)
+            # without the reverse index the ebuild records are useless.
+            return
+        try:
+            f = open(path)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with f:
+            for line in f:
+                l = line.rstrip('\n').split('\t')
+                if len(l) != 5:
+                    continue
+                chksums = (long(l[2]), long(l[3]), l[4])
+                if l[0] == 'eclass':
+                    self.eclasses[l[1]] = chksums
+                elif l[0] == 'ebuild' and l[1] in self.usage.cpvs:
+                    self.ebuilds[l[1]] = chksums
+
+    @staticmethod
+    def _chksums(hashed):
+        return (long(hashed.mtime), long(hashed.size), '%x' % hashed.md5)
+
+    def _changed(self, record, hashed):
+        """Compare a recorded (mtime, size, md5) against the current state.
+
+        :return: the current chksums if they differ from the record, None
+            if unchanged.  If only the mtime or size moved (touched but
+            identical content), the current chksums are returned as well
+            as the second item so the record can be refreshed.
+        """
+        try:
+            if record is not None and record[:2] == (
+                    long(hashed.mtime), long(hashed.size)):
+                return None, None
+            chksums = self._chksums(hashed)
+        except EnvironmentError:
+            return (), None
+        if record is not None and record[2] == chksums[2]:
+            return None, chksums
+        return chksums, None
+
+    def changed_eclasses(self, eclasses):
+        """Return the names of eclasses added, removed or modified."""
+        changed = set(self.eclasses).difference(eclasses)
+        for name, hashed in eclasses.iteritems():
+            if self._changed(self.eclasses.get(name), hashed)[0] is not None:
+                changed.add(name)
+        return changed
+
+    def stale_pkgs(self, pkgs, changed_eclasses):
+        """Yield packages needing revalidation."""
+        affected = self.usage.dependents(changed_eclasses)
+        for pkg in pkgs:
+            cpv = pkg.cpvstr
+            record = self.ebuilds.get(cpv)
+            if record is None or cpv in affected:
+                yield pkg
+                continue
+            changed, touched = self._changed(record, LazilyHashedPath(pkg.path))
+            if changed is not None:
+                yield pkg
+            elif touched is not None:
+                self.ebuilds[cpv] = touched
+
+    def current(self, repo):
+        """Return whether the recorded state, and so the eclass usage
+        index, still matches a repo.
+
+        Ebuilds are only compared by mtime and size unless those moved,
+        so this is far cheaper than loading every package's metadata.
+        """
+        if not self.ebuilds:
+            return False
+        pkgs = list(repo)
+        if frozenset(pkg.cpvstr for pkg in pkgs) != frozenset(self.ebuilds):
+            return False
+        if self.changed_eclasses(repo.eclass_cache.eclasses):
+            return False
+        for pkg in self.stale_pkgs(pkgs, ()):
+            return False
+        return True
+
+    def update(self, repo, pkgs, stale, caches):
+        """Rebuild the state from the current tree.
+
+        :param pkgs: every package in the repo
+        :param stale: packages that were regenerated; their eclasses are
+            pulled from the cache entries written during the regen.
+        """
+        stale = frozenset(pkg.cpvstr for pkg in stale)
+        usage = self.usage
+        ebuilds = {}
+        for pkg in pkgs:
+            cpv = pkg.cpvstr
+            record = self.ebuilds.get(cpv)
+            if cpv in stale or record is None:
+                usage.discard(cpv)
+                fresh = eclass_cache.UsageIndex.from_caches((cpv,), caches)
+                if cpv not in fresh.cpvs:
+                    # regen failed; leave it for the next run.
+                    continue
+                try:
+                    record = self._chksums(LazilyHashedPath(pkg.path))
+                except EnvironmentError:
+                    continue
+                usage.update(cpv, fresh.inherited(cpv))
+            ebuilds[cpv] = record
+        for cpv in usage.cpvs.difference(ebuilds):
+            usage.discard(cpv)
+        self.ebuilds = ebuilds
+        eclasses = {}
+        for name, hashed in repo.eclass_cache.eclasses.iteritems():
+            try:
+                eclasses[name] = self._chksums(hashed)
+            except EnvironmentError:
+                continue
+        self.eclasses = eclasses
+
+    def write(self):
+        self.usage.write()
+        f = AtomicWriteFile(self.path)
+        for name, chksums in sorted(self.eclasses.iteritems()):
+            f.write("eclass\t%s\t%i\t%i\t%s\n" % ((name,) + chksums))
+        for cpv, chksums in sorted(self.ebuilds.iteritems()):
+            f.write("ebuild\t%s\t%i\t%i\t%s\n" % ((cpv,) + chksums))
+        f.close()
+
+
+def _cache_sidecar(repo, suffix):
+    caches = getattr(repo, 'cache', ())
+    if hasattr(caches, 'commit'):
+        caches = (caches,)
+    for cache in caches:
+        location = getattr(cache, 'location', None)
+        if location is not None:
+            return location.rstrip(os.path.sep) + suffix
+    return None
+
+
+def regen_state_path(repo):
+    """Location of the incremental regen state for a repo.
+
+    This lives alongside the repo's first on disk cache; None if there is none.
+    """
+    return _cache_sidecar(repo, '.regen-state')
+
+
+def eclass_usage_path(repo):
+    """Location of the persisted eclass usage index for a repo.
+
+    Like :obj:`regen_state_path`, None if the repo has no on disk cache.
+    """
+    return _cache_sidecar(repo, '.eclass-usage')
+
+
+class _QueueObserver(object):
+
+    """Observer forwarding messages from a worker process to the parent."""
+
+    def __init__(self, queue):
+        self._queue = queue
+
+    def _forward(self, level, msg, *args):
+        if args:
+            msg = msg % args
+        self._queue.put((level, msg))
+
+    def __getattr__(self, attr):
+        if attr not in ('error', 'warn', 'info', 'debug', 'write'):
+            raise AttributeError(attr)
+        return lambda msg, *args, **kwds: self._forward(attr, msg, *args)
+
+
+def _writable_caches(repo):
+    caches = getattr(repo, 'cache', ())
+    if hasattr(caches, 'commit'):
+        caches = (caches,)
+    return [x for x in caches if x is not None and not x.readonly]
+
+
+def _regen_process(repo, get_helper, tasks, results):
+    # any processors inherited over fork belong to the parent.
+    processor.forget_all_processors()
+    observer = _QueueObserver(results)
+    try:
+        helper = get_helper()
+        pkgs = (pkg for shard in iter(tasks.get, None) for target in shard
+                for pkg in repo.itermatch(atom(target)))
+        regen_iter(pkgs, helper, observer)
+        f = getattr(helper, 'finish', None)
+        if f is not None:
+            f()
+        for cache in _writable_caches(repo):
+            if not cache.autocommits:
+                cache.commit()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        observer.error("regen worker failed: %s", e)
+    finally:
+        processor.shutdown_all_processors()
+        results.put((None, os.getpid()))
+
+
+def regen_processes(repo, get_helper, observer, processes, shard_size=16,
+                    pkgs=None, poll_interval=1):
+    """Regenerate a repository's cache across a pool of worker processes.
+
+    Each worker owns its ebuild processors and writes cache entries directly;
+    the parent only hands out shards of packages and relays worker messages
+    to the observer.
+
+    :param pkgs: if given, only regenerate these packages instead of
+        the whole repo
+    :param poll_interval: seconds between checks for workers that died
+        without finishing
+    :raise RegenError: if a worker died; the remaining ones are terminated
+    """
+    if pkgs is None:
+        targets = ('%s/%s' % cp for cp in repo.versions)
+    else:
+        targets = ('=%s' % pkg.cpvstr for pkg in pkgs)
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=_regen_process, args=(repo, get_helper, tasks, results))
+        for x in xrange(processes)]
+    try:
+        for worker in workers:
+            worker.start()
+        shard = []
+        for target in targets:
+            shard.append(target)
+            if len(shard) >= shard_size:
+                tasks.put(shard)
+                shard = []
+        if shard:
+            tasks.put(shard)
+        for worker in workers:
+            tasks.put(None)
+
+        finished = set()
+
+        def relay(msg):
+            level, msg = msg
+            if level is None:
+                finished.add(msg)
+            else:
+                getattr(observer, level)("%s", msg)
+
+        while len(finished) < len(workers):
+            try:
+                relay(results.get(timeout=poll_interval))
+                continue
+            except Queue.Empty:
+                pass
+            dead = [x for x in workers
+                    if not x.is_alive() and x.pid not in finished]
+            if not dead:
+                continue
+            # a worker flushes its messages before exiting; pick up any
+            # still queued before deciding it died.
+            try:
+                while True:
+                    relay(results.get_nowait())
+            except Queue.Empty:
+                pass
+            dead = [x for x in dead if x.pid not in finished]
+            if dead:
+                for worker in dead:
+                    observer.error(
+                        "regen worker %i died with exit status %s",
+                        worker.pid, worker.exitcode)
+                raise RegenError(
+                    "%i regen worker(s) died unexpectedly" % (len(dead),))
+    except:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            if worker.pid is not None:
+                worker.join()
+
+
+def regen_repository(repo, observer, threads=1, pkg_attr='keywords',
+                     processes=False, incremental=False, **options):
 
     helpers = []
 
@@ -33,14 +356,76 @@ def regen_repository(repo, observer, threads=1, pkg_attr='keywords', **options):
         helpers.append(helper)
         return helper
 
+    if processes and threads > 1:
+        unsafe = [x for x in _writable_caches(repo) if not x.concurrent_writes]
+        if unsafe:
+            observer.warn(
+                "cache %s doesn't support concurrent writers; "
+                "falling back to threads", unsafe[0])
+            processes = False
+
+    ecache = getattr(repo, 'eclass_cache', None)
+    if ecache is not None:
+        # drop memoized eclass validation if eclasses were added/removed.
+        ecache.invalidate_if_modified()
+
+    state = pkgs = None
+    if incremental:
+        path = regen_state_path(repo)
+        if (path is None or not _writable_caches(repo) or
+                getattr(repo, 'eclass_cache', None) is None):
+            observer.warn(
+                "repo %s doesn't support incremental regen; "
+                "regenerating everything", repo)
+        else:
+            state = RegenState(path, eclass_usage_path(repo))
+            pkgs = list(state.stale_pkgs(
+                repo, state.changed_eclasses(repo.eclass_cache.eclasses)))
+            observer.info("%i package(s) require revalidation", len(pkgs))
+
     if threads == 1:
-        regen_iter(iter(repo), _get_repo_helper(), observer)
+        regen_iter(iter(repo if pkgs is None else pkgs),
+                   _get_repo_helper(), observer)
+    elif processes:
+        regen_processes(repo, _get_repo_helper, observer, threads, pkgs=pkgs)
     else:
         def get_args():
             return (_get_repo_helper(), observer, True)
-        map_async(repo, regen_iter, per_thread_args=get_args)
+        map_async(repo if pkgs is None else pkgs, regen_iter,
+                  per_thread_args=get_args)
 
     for helper in helpers:
         f = getattr(helper, 'finish', None)
         if f is not None:
             f()
+
+    index = getattr(repo, 'attr_index', None)
+    caches = _writable_caches(repo)
+    if state is not None or index is not None:
+        for cache in caches:
+            if not cache.autocommits:
+                cache.commit()
+
+    if state is not None:
+        previous = frozenset(state.ebuilds)
+        state.update(repo, repo, pkgs, caches)
+        # drop cache entries for removed ebuilds; without prior state we
+        # don't know what was removed, so check the cache contents instead.
+        for cache in caches:
+            keys = previous if previous else frozenset(cache)
+            for cpv in keys.difference(state.ebuilds):
+                try:
+                    del cache[cpv]
+                except KeyError:
+                    pass
+        try:
+            state.write()
+        except EnvironmentError as e:
+            observer.error("failed writing regen state %s: %s", state.path, e)
+
+    if index is not None:
+        index.update(repo, observer)
+        try:
+            index.write()
+        except EnvironmentError as e:
+            observer.error("failed writing attr index %s: %s", index.path, e)
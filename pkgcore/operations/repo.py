@@ -245,7 +245,9 @@ class operations(sync_operations):
             ret = regen.regen_repository(
                 self.repo,
                 self._get_observer(observer), threads=threads, **options)
-            self._cmd_implementation_clean_cache()
+            if not options.get('incremental'):
+                # incremental regen drops stale entries itself.
+                self._cmd_implementation_clean_cache()
             return ret
         finally:
             if sync_rate is not None:
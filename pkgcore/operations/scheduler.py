@@ -0,0 +1,214 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+parallel execution of a resolved plan
+
+:obj:`dependency_graph` derives which ops of a plan have to wait for which
+others from the dependencies recorded in their choice points;
+:obj:`Scheduler` then runs the builds of independent ops concurrently while
+merging to the livefs one op at a time.
+"""
+
+__all__ = ("dependency_graph", "Job", "Scheduler")
+
+import os
+import Queue
+import threading
+from time import time
+
+from snakeoil.compatibility import IGNORED_EXCEPTIONS
+
+
+def dependency_graph(ops):
+    """Return the ops each op of a plan has to wait for.
+
+    An op depends on the earlier ops providing its build or runtime
+    dependencies and on earlier replacements removing packages it blocks.
+    Only earlier ops are considered- the resolver orders dependencies first,
+    so this breaks cycles the same way running the plan sequentially does.
+    Removals are ordered against everything.
+
+    :param ops: sequence of plan ops, as from
+        :obj:`pkgcore.resolver.state.plan_state.ops`
+    :return: list holding, for each op, the set of indexes of the ops it
+        depends on
+    """
+    graph = []
+    by_key = {}
+    barrier = None
+    for idx, op in enumerate(ops):
+        deps = set()
+        if op.desc == 'remove':
+            deps.update(xrange(idx))
+            barrier = idx
+        else:
+            if barrier is not None:
+                deps.add(barrier)
+            for attr in ('depends', 'rdepends'):
+                for or_block in getattr(op.choices, attr):
+                    for node in or_block:
+                        for prev_idx, prev in by_key.get(getattr(node, 'key', None), ()):
+                            if node.blocks:
+                                old_pkg = getattr(prev, 'old_pkg', None)
+                                if old_pkg is not None and node.match(old_pkg):
+                                    deps.add(prev_idx)
+                            elif node.match(prev.pkg):
+                                deps.add(prev_idx)
+        graph.append(deps)
+        by_key.setdefault(op.pkg.key, []).append((idx, op))
+    return graph
+
+
+class Job(object):
+
+    """
+    one op of a :obj:`Scheduler` run
+
+    :ivar index: position of the op in the plan
+    :ivar op: the plan op
+    :ivar deps: indexes of the jobs that have to be merged first
+    :ivar state: one of pending, building, built, merged, failed or skipped
+    :ivar result: return value of the build callable
+    :ivar error: exception raised by the build callable, if any
+    :ivar start: time the build started
+    :ivar end: time the job was merged or failed
+    """
+
+    __slots__ = ("index", "op", "deps", "state", "result", "error",
+                 "start", "end")
+
+    def __init__(self, index, op, deps):
+        self.index = index
+        self.op = op
+        self.deps = deps
+        self.state = 'pending'
+        self.result = self.error = None
+        self.start = self.end = None
+
+    def __str__(self):
+        return "%s: %s" % (self.state, self.op)
+
+
+class Scheduler(object):
+
+    """
+    run the builds of a plan concurrently, merging serially
+
+    Builds run in worker threads as soon as every op they depend on is
+    merged, limited by a job count and optionally the system load average.
+    Merges, and any notification callbacks, run in the thread calling
+    :obj:`run`.
+    """
+
+    # seconds to wait for a build to finish before checking the load again.
+    poll_interval = 1
+
+    def __init__(self, ops, build, merge, jobs=1, load_average=None,
+                 notify=None, graph=None):
+        """
+        :param ops: plan ops to run, in plan order
+        :param build: callable taking a :obj:`Job`, ran in a worker thread;
+            returns the result to merge, or False on failure.  Exceptions
+            are treated as failures.
+        :param merge: callable taking a built :obj:`Job`; returns False on
+            failure
+        :param jobs: maximum number of concurrent builds
+        :param load_average: while a build is running, don't start others
+            if the load average is at least this
+        :param notify: if given, called with the scheduler and a job
+            whenever the job changes state
+        :param graph: dependencies of the ops, defaults to
+            :obj:`dependency_graph` of them
+        """
+        if graph is None:
+            graph = dependency_graph(ops)
+        self.jobs = [Job(idx, op, deps)
+                     for idx, (op, deps) in enumerate(zip(ops, graph))]
+        self.build = build
+        self.merge = merge
+        self.max_jobs = max(jobs, 1)
+        self.load_average = load_average
+        self.notify = notify
+        self.running = 0
+        self._results = Queue.Queue()
+
+    def count(self, *states):
+        """Return the number of jobs in any of the given states."""
+        return sum(1 for job in self.jobs if job.state in states)
+
+    def _set_state(self, job, state):
+        job.state = state
+        if state in ('merged', 'failed', 'skipped'):
+            job.end = time()
+        if self.notify is not None:
+            self.notify(self, job)
+
+    def _overloaded(self):
+        if self.load_average is None:
+            return False
+        try:
+            return os.getloadavg()[0] >= self.load_average
+        except OSError:
+            return False
+
+    def _worker(self, job):
+        try:
+            result = self.build(job)
+        except IGNORED_EXCEPTIONS:
+            raise
+        except Exception as e:
+            job.error = e
+            result = False
+        self._results.put((job, result))
+
+    def _start_builds(self):
+        for job in self.jobs:
+            if job.state != 'pending':
+                continue
+            states = [self.jobs[x].state for x in job.deps]
+            if any(x in ('failed', 'skipped') for x in states):
+                self._set_state(job, 'skipped')
+                continue
+            if any(x != 'merged' for x in states):
+                continue
+            if self.running >= self.max_jobs or \
+                    (self.running and self._overloaded()):
+                return
+            job.start = time()
+            self.running += 1
+            self._set_state(job, 'building')
+            t = threading.Thread(target=self._worker, args=(job,))
+            t.daemon = True
+            t.start()
+
+    def run(self, keep_going=False):
+        """Run the plan.
+
+        :param keep_going: if False, no further builds are started after
+            the first failure; those already running are still finished
+        :return: list of the failed jobs
+        """
+        failed = []
+        while True:
+            if keep_going or not failed:
+                self._start_builds()
+            if not self.running:
+                break
+            try:
+                job, result = self._results.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                continue
+            self.running -= 1
+            job.result = result
+            if result is False:
+                failed.append(job)
+                self._set_state(job, 'failed')
+                continue
+            self._set_state(job, 'built')
+            if self.merge(job) is False:
+                failed.append(job)
+                self._set_state(job, 'failed')
+            else:
+                self._set_state(job, 'merged')
+        return failed
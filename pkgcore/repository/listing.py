@@ -0,0 +1,135 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+persistent directory listing index for on disk repositories
+
+Walking a repo's category and package directories costs a ``listdir`` per
+directory; on network filesystems that dominates startup of full tree
+queries.  :obj:`ListingIndex` records each listing along with the directory
+mtime it was taken at, so later runs only need a ``stat`` per directory and
+relist just the directories that changed.
+"""
+
+__all__ = ("ListingIndex",)
+
+import errno
+import os
+import time
+
+from snakeoil.demandload import demandload
+
+demandload(
+    'snakeoil.fileutils:AtomicWriteFile',
+    'pkgcore.log:logger',
+    'pkgcore.spawn:atexit_register',
+)
+
+
+class ListingIndex(object):
+
+    """
+    on disk cache of directory listings, validated by directory mtimes
+
+    Listings are keyed by their path relative to the repo base.  The whole
+    index is read in one go on first use; updated listings are written back
+    at exit (or via :obj:`write`).
+    """
+
+    magic = 'pkgcore-listing-index-1'
+
+    # listings taken this close to a directory's mtime aren't persisted;
+    # a change within the same timestamp granularity would go unnoticed.
+    racy_window = 1
+
+    def __init__(self, path, base):
+        """
+        :param path: location of the index file
+        :param base: repo base the recorded listings are relative to
+        """
+        self.path = path
+        self.base = base.rstrip(os.path.sep)
+        self._entries = None
+        self._dirty = False
+
+    @property
+    def entries(self):
+        """mapping of relative path to (mtime, listing)"""
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self):
+        entries = {}
+        try:
+            f = open(self.path)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning(
+                    "failed reading listing index %s: %s", self.path, e)
+            return entries
+        with f:
+            if f.readline().rstrip('\n') != self.magic:
+                return entries
+            for line in f:
+                l = line.rstrip('\n').split('\t')
+                if len(l) != 3:
+                    continue
+                try:
+                    mtime = float(l[1])
+                except ValueError:
+                    continue
+                entries[l[0]] = (mtime, tuple(l[2].split()))
+        return entries
+
+    def listdir(self, path, lister):
+        """Return the listing of a directory, using the index if it's current.
+
+        :param path: absolute path of the directory, within :obj:`base`
+        :param lister: callable returning the listing on a miss; its
+            exceptions propagate unchanged
+        """
+        key = path[len(self.base):].strip(os.path.sep)
+        try:
+            mtime = os.stat(path).st_mtime
+        except EnvironmentError:
+            # let the lister raise the appropriate error.
+            return lister(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        listing = tuple(lister(path))
+        if time.time() - mtime > self.racy_window:
+            self._entries[key] = (mtime, listing)
+            self._mark_dirty()
+        elif entry is not None:
+            del self._entries[key]
+            self._mark_dirty()
+        return listing
+
+    def _mark_dirty(self):
+        if not self._dirty:
+            self._dirty = True
+            atexit_register(self.flush)
+
+    def flush(self):
+        """Write the index if it was modified, logging any failure."""
+        if not self._dirty:
+            return
+        try:
+            self.write()
+        except EnvironmentError as e:
+            logger.warning("failed writing listing index %s: %s", self.path, e)
+
+    def write(self):
+        """Write the index back to disk."""
+        f = AtomicWriteFile(self.path)
+        try:
+            f.write("%s\n" % (self.magic,))
+            for key, (mtime, listing) in sorted(self.entries.iteritems()):
+                f.write("%s\t%r\t%s\n" % (key, mtime, ' '.join(listing)))
+            f.close()
+        except:
+            f.discard()
+            raise
+        self._dirty = False
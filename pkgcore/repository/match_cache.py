@@ -0,0 +1,267 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+persistent cross run cache of repository query results
+
+:obj:`pkgcore.repository.misc.caching_repo` only remembers matches for the
+lifetime of one resolver, so every resolution queries the trees for the
+same atoms again.  :obj:`MatchCache` records, per repository location and
+atom, the versions that matched; later runs hand those straight to the
+repository as the candidates to examine, so non-matching versions aren't
+instantiated and atoms without matches don't hit the repository at all.
+
+Entries are validated with a few ``stat`` calls: the whole cache is keyed
+by a signature of the configuration (see :obj:`domain_signature`), each
+repository by the mtimes of its base, profiles and eclass directories and
+sync timestamp, and each entry by the mtimes of its category and package
+directories, the category's md5-cache directory and the package's
+ebuilds, so edits made in place are noticed too.  Only atoms are cached,
+as their string form fully identifies them.
+"""
+
+__all__ = ("MatchCache", "domain_signature", "repo_stamp")
+
+import errno
+import hashlib
+import os
+import time
+
+from snakeoil.demandload import demandload
+from snakeoil.osutils import pjoin
+
+from pkgcore.ebuild.atom import atom
+
+demandload(
+    'snakeoil.fileutils:AtomicWriteFile',
+    'pkgcore.log:logger',
+    'pkgcore.spawn:atexit_register',
+)
+
+
+def _mtime(path):
+    try:
+        return repr(os.stat(path).st_mtime)
+    except EnvironmentError:
+        return '-'
+
+
+def _settings_value(val):
+    if isinstance(val, basestring):
+        return val
+    if isinstance(val, (set, frozenset)):
+        return ' '.join(sorted(map(str, val)))
+    if isinstance(val, (tuple, list)):
+        return ' '.join(map(str, val))
+    # arbitrary objects don't have a stable representation.
+    return val.__class__.__name__
+
+
+def domain_signature(domain, use=True):
+    """Return a digest of a domain's configuration affecting query results.
+
+    This covers the domain settings and the state of the user's package.*
+    files and the profile directories.
+
+    :param use: if False, the USE settings (including USE_EXPAND ones) and
+        the user's package.use files are left out, for consumers checking
+        the USE flags of each package themselves
+    """
+    chksum = hashlib.md5()
+    skip = frozenset()
+    if not use:
+        skip = frozenset(['USE']).union(
+            getattr(domain.profile, 'use_expand', ()))
+    for key, val in sorted(domain.settings.iteritems()):
+        if key not in skip:
+            chksum.update('%s=%s\n' % (key, _settings_value(val)))
+    paths = []
+    for path in getattr(domain, 'config_files', ()):
+        if not use and os.path.basename(path).startswith('package.use'):
+            continue
+        paths.append(path)
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            paths.extend(pjoin(root, x) for x in sorted(files))
+    for node in getattr(domain.profile, 'stack', ()):
+        paths.append(node.path)
+        try:
+            paths.extend(pjoin(node.path, x) for x in sorted(os.listdir(node.path)))
+        except EnvironmentError:
+            continue
+    for path in paths:
+        chksum.update('%s %s\n' % (path, _mtime(path)))
+    return chksum.hexdigest()
+
+
+def repo_stamp(location, sync=True):
+    """Return a stamp of the repo wide state of an ebuild repository.
+
+    This changes on syncs and when profiles or eclasses are modified, but
+    not for changes limited to individual packages.
+
+    :param sync: if False, syncs only change the stamp if they touched
+        the profiles or eclasses
+    """
+    paths = ['', 'profiles', pjoin('profiles', 'package.mask'), 'eclass']
+    if sync:
+        paths.append(pjoin('metadata', 'timestamp.chk'))
+    return ','.join(_mtime(pjoin(location, x)) for x in paths)
+
+
+class _RepoMatches(object):
+
+    """cached matches for one repository location"""
+
+    __slots__ = ("cache", "location", "entries")
+
+    def __init__(self, cache, location, entries):
+        self.cache = cache
+        self.location = location
+        self.entries = entries
+
+    def _stamp(self, repo, restrict):
+        base = self.location
+        cat = restrict.category
+        pkgdir = pjoin(base, cat, restrict.package)
+        paths = [pjoin(base, cat), pkgdir,
+                 pjoin(base, 'metadata', 'md5-cache', cat)]
+        extension = getattr(repo, 'extension', None)
+        if extension is not None:
+            try:
+                paths.extend(
+                    pjoin(pkgdir, x) for x in sorted(os.listdir(pkgdir))
+                    if x.endswith(extension))
+            except EnvironmentError:
+                pass
+        return ','.join(_mtime(x) for x in paths)
+
+    def itermatch(self, repo, restrict, sorter):
+        """Query a repo, via the cache where possible.
+
+        On a miss the query is run to completion so its result can be
+        recorded.
+        """
+        if not isinstance(restrict, atom):
+            return repo.itermatch(restrict, sorter=sorter)
+        key = str(restrict)
+        stamp = self._stamp(repo, restrict)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] == stamp:
+                if not entry[1]:
+                    return iter(())
+                return repo.itermatch(
+                    restrict, sorter=sorter, candidates={
+                        (restrict.category, restrict.package): entry[1]})
+            del self.entries[key]
+            self.cache._mark_dirty()
+        pkgs = list(repo.itermatch(restrict, sorter=sorter))
+        cutoff = time.time() - self.cache.racy_window
+        if all(x == '-' or float(x) < cutoff for x in stamp.split(',')):
+            self.entries[key] = (stamp, tuple(pkg.fullver for pkg in pkgs))
+            self.cache._mark_dirty()
+        return iter(pkgs)
+
+
+class MatchCache(object):
+
+    """
+    on disk cache of atom matches per repository
+
+    The file is read on first use; updated entries are written back at
+    exit (or via :obj:`write`).
+    """
+
+    magic = 'pkgcore-match-cache-1'
+
+    # directories modified this close to a query aren't trusted; a change
+    # within the same timestamp granularity would go unnoticed.
+    racy_window = 1
+
+    def __init__(self, path, signature=''):
+        """
+        :param path: location of the cache file
+        :param signature: configuration signature the results depend on,
+            usually from :obj:`domain_signature`; entries recorded under a
+            different signature are discarded
+        """
+        self.path = path
+        self.signature = signature
+        self._repos = None
+        self._dirty = False
+
+    @property
+    def repos(self):
+        """mapping of repo location to (repo stamp, entries); entries map
+        atom strings to (stamp, versions)"""
+        if self._repos is None:
+            self._repos = self._load()
+        return self._repos
+
+    def _load(self):
+        repos = {}
+        try:
+            f = open(self.path)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning(
+                    "failed reading match cache %s: %s", self.path, e)
+            return repos
+        with f:
+            if f.readline().rstrip('\n') != self.magic:
+                return repos
+            if f.readline().rstrip('\n') != 'signature\t%s' % (self.signature,):
+                return repos
+            for line in f:
+                l = line.rstrip('\n').split('\t')
+                if l[0] == 'repo' and len(l) == 3:
+                    repos[l[1]] = (l[2], {})
+                elif l[0] == 'match' and len(l) == 5 and l[1] in repos:
+                    repos[l[1]][1][l[2]] = (l[3], tuple(l[4].split()))
+        return repos
+
+    def for_repo(self, repo):
+        """Return the cached matches for a repo, or None if it can't be
+        cached (it has no on disk location)."""
+        location = getattr(repo, 'location', None)
+        if not isinstance(location, basestring) or not os.path.isdir(location):
+            return None
+        location = os.path.abspath(location)
+        stamp = repo_stamp(location)
+        existing = self.repos.get(location)
+        if existing is None or existing[0] != stamp:
+            if existing is not None:
+                self._mark_dirty()
+            existing = self.repos[location] = (stamp, {})
+        return _RepoMatches(self, location, existing[1])
+
+    def _mark_dirty(self):
+        if not self._dirty:
+            self._dirty = True
+            atexit_register(self.flush)
+
+    def flush(self):
+        """Write the cache if it was modified, logging any failure."""
+        if not self._dirty:
+            return
+        try:
+            self.write()
+        except EnvironmentError as e:
+            logger.warning("failed writing match cache %s: %s", self.path, e)
+
+    def write(self):
+        """Write the cache back to disk."""
+        f = AtomicWriteFile(self.path)
+        try:
+            f.write("%s\nsignature\t%s\n" % (self.magic, self.signature))
+            for location, (stamp, entries) in sorted(self.repos.iteritems()):
+                f.write("repo\t%s\t%s\n" % (location, stamp))
+                for key, (entry_stamp, vers) in sorted(entries.iteritems()):
+                    f.write("match\t%s\t%s\t%s\t%s\n" % (
+                        location, key, entry_stamp, ' '.join(vers)))
+            f.close()
+        except:
+            f.discard()
+            raise
+        self._dirty = False
@@ -67,25 +67,33 @@ class caching_repo(object):
 
     operations_kls = operations_proxy
 
-    def __init__(self, db, strategy):
+    def __init__(self, db, strategy, persistent=None):
         """
         :param db: an instance supporting the repository protocol to cache
           queries from.
         :param strategy: forced sorting strategy for results.  If you don't
           need sorting, pass in iter.
+        :param persistent: if not None, the db's entry in a
+          :obj:`pkgcore.repository.match_cache.MatchCache` to consult for
+          queries not yet cached in memory
         """
         self.__db__ = db
         self.__strategy__ = strategy
+        self.__persistent__ = persistent
         self.__cache__ = {}
 
     def match(self, restrict):
         v = self.__cache__.get(restrict)
         if v is None:
-            v = self.__cache__[restrict] = \
-                caching_iter(
-                    self.__db__.itermatch(restrict, sorter=self.__strategy__))
+            v = self.__cache__[restrict] = caching_iter(self._query(restrict))
         return v
 
+    def _query(self, restrict):
+        if self.__persistent__ is not None:
+            return self.__persistent__.itermatch(
+                self.__db__, restrict, self.__strategy__)
+        return self.__db__.itermatch(restrict, sorter=self.__strategy__)
+
     def itermatch(self, restrict):
         return iter(self.match(restrict))
 
@@ -17,6 +17,7 @@ from snakeoil.currying import post_curry
 from snakeoil.iterables import iter_sort
 
 from pkgcore.config import configurable
+from pkgcore.ebuild.atom import atom
 from pkgcore.operations import repo as repo_interface
 from pkgcore.repository import prototype, errors
 
@@ -148,11 +149,59 @@ class tree(prototype.tree):
                 raise
         raise ValueError("no repo contains: '%s'" % path)
 
+    def _shared_candidates(self, restrict, candidates=None):
+        """Identify candidates once against the merged category/package view.
+
+        :return: list of the candidates each tree has to examine (None for
+            trees that have to identify their own, such as wrappers not
+            derived from :obj:`pkgcore.repository.prototype.tree` whose
+            itermatch doesn't take candidates), or None if the whole of
+            every tree has to be walked anyway
+        """
+        if candidates is None:
+            if isinstance(restrict, atom):
+                candidates = [(restrict.category, restrict.package)]
+            else:
+                plan = self.plan(restrict)
+                if plan.full_scan:
+                    return None
+                if any(x.attrs for x in plan.solutions) and any(
+                        getattr(x, 'attr_index', None) is not None
+                        for x in self.trees):
+                    # let the trees narrow things down via their indexes.
+                    return None
+                if not plan.narrows(self):
+                    return None
+                candidates = plan.candidates(self, iter)
+        candidates = list(candidates)
+        l = []
+        for repo in self.trees:
+            if not isinstance(repo, prototype.tree):
+                l.append(None)
+                continue
+            pkgs = getattr(repo, 'packages', None)
+            if pkgs is None:
+                l.append(None)
+            else:
+                l.append([cp for cp in candidates
+                          if cp[1] in pkgs.get(cp[0], ())])
+        return l
+
     def itermatch(self, restrict, **kwds):
-        sorter = kwds.get("sorter", iter)
+        sorter = kwds.get("sorter") or iter
+        shared = self._shared_candidates(
+            restrict, kwds.pop("candidates", None))
+        if shared is None:
+            sources = (repo.itermatch(restrict, **kwds) for repo in self.trees)
+        else:
+            # only dispatch to the trees actually holding candidates.
+            sources = (
+                repo.itermatch(restrict, **kwds) if candidates is None else
+                repo.itermatch(restrict, candidates=candidates, **kwds)
+                for repo, candidates in zip(self.trees, shared)
+                if candidates is None or candidates)
         if sorter is iter:
-            return (match for repo in self.trees
-                    for match in repo.itermatch(restrict, **kwds))
+            return chain.from_iterable(sources)
 
         # ugly, and a bit slow, but works.
         def f(x, y):
@@ -161,8 +210,7 @@ class tree(prototype.tree):
                 return 1
             return -1
         f = post_curry(sorted_cmp, f, key=self.zero_index_grabber)
-        return iter_sort(
-            f, *[repo.itermatch(restrict, **kwds) for repo in self.trees])
+        return iter_sort(f, *sources)
 
     itermatch.__doc__ = prototype.tree.itermatch.__doc__.replace(
         "@param", "@keyword").replace(":keyword restrict:", ":param restrict:")
@@ -0,0 +1,370 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+restriction to candidate query planning for repositories
+
+A restriction is compiled once into a :obj:`QueryPlan`: its DNF solutions
+are reduced to per solution category/package steps (exact lookups or
+filters over the listing), plus attribute terms a repo's secondary index
+(see ``attr_index`` on :obj:`pkgcore.repository.prototype.tree`) may be able
+to answer; everything else is left to the per package match.  Compiled plans
+are cached per restriction instance, and a plan can describe itself along
+with cost estimates for a given repo via :obj:`QueryPlan.explain`.
+"""
+
+__all__ = ("QueryPlan", "SolutionPlan", "compile_plan")
+
+from pkgcore.restrictions import packages, values
+
+
+# cost model knobs; costs are in units of listings consulted or
+# category/package names examined.
+default_avg_packages = 100
+filter_selectivity = 0.1
+
+_plan_cache = {}
+_plan_cache_size = 1024
+
+
+def _negated(match):
+    return lambda val: not match(val)
+
+
+class _Step(object):
+
+    """category or package selection for a solution"""
+
+    __slots__ = ("exact", "filters", "descriptions")
+
+    def __init__(self, exact=None, filters=(), descriptions=()):
+        # exact is None (no exact constraint) or a frozenset of values.
+        self.exact = exact
+        self.filters = tuple(filters)
+        self.descriptions = tuple(descriptions)
+
+    @property
+    def unconstrained(self):
+        return self.exact is None and not self.filters
+
+    def select(self, vals, sorter):
+        if self.exact is not None:
+            if self.filters:
+                return [x for x in sorter(self.exact) if self.accepts(x)]
+            return sorter(self.exact)
+        if self.filters:
+            return (x for x in sorter(vals) if self.accepts(x))
+        return sorter(vals)
+
+    def accepts(self, val):
+        if self.exact is not None and val not in self.exact:
+            return False
+        for f in self.filters:
+            if not f(val):
+                return False
+        return True
+
+    def describe(self):
+        l = []
+        if self.exact is not None:
+            l.append("exact %s" % (", ".join(sorted(self.exact)) or "<none>",))
+        l.extend("filter %s" % (x,) for x in self.descriptions)
+        return "; ".join(l) or "all"
+
+
+class SolutionPlan(object):
+
+    """category/package steps for one DNF solution of a restriction
+
+    :ivar attrs: package restrictions on other attributes, for repos with
+        secondary indexes
+    """
+
+    __slots__ = ("cat", "pkg", "attrs")
+
+    def __init__(self, cat, pkg, attrs=()):
+        self.cat = cat
+        self.pkg = pkg
+        self.attrs = tuple(attrs)
+
+    @classmethod
+    def from_solution(cls, solution):
+        steps = {}
+        for attr in ("category", "package"):
+            exact = None
+            filters, descriptions = [], []
+            for r in solution:
+                if (not isinstance(r, packages.PackageRestriction) or
+                        r.attr != attr):
+                    continue
+                v = r.restriction
+                if (isinstance(v, values.StrExactMatch) and v.case_sensitive
+                        and v.negate == r.negate):
+                    if exact is None:
+                        exact = frozenset([v.exact])
+                    else:
+                        exact = exact.intersection([v.exact])
+                    continue
+                match = v.match
+                if r.negate:
+                    match = _negated(match)
+                filters.append(match)
+                descriptions.append(("not %s" if r.negate else "%s") % (v,))
+            steps[attr] = _Step(exact, filters, descriptions)
+        attrs = (r for r in solution
+                 if isinstance(r, packages.PackageRestriction) and
+                 not _is_cp_term(r))
+        return cls(steps["category"], steps["package"], attrs)
+
+    @property
+    def unconstrained(self):
+        return self.cat.unconstrained and self.pkg.unconstrained
+
+    @property
+    def impossible(self):
+        return self.cat.exact == frozenset() or self.pkg.exact == frozenset()
+
+    def cost(self, n_cats, avg_pkgs):
+        """Estimate the cost of running this solution against a repo.
+
+        :return: (cost, estimated number of candidates)
+        """
+        if self.impossible:
+            return 0, 0
+        if self.cat.exact is not None:
+            cost = cats = len(self.cat.exact)
+        else:
+            cost = n_cats
+            cats = n_cats * (filter_selectivity if self.cat.filters else 1)
+        if self.pkg.exact is not None:
+            cost += cats * len(self.pkg.exact)
+            cands = cats * len(self.pkg.exact)
+        else:
+            cost += cats * avg_pkgs
+            cands = cats * avg_pkgs * (
+                filter_selectivity if self.pkg.filters else 1)
+        return cost, cands
+
+    def indexed(self, repo):
+        """Resolve this solution through the repo's attribute index.
+
+        :return: dict of (cat, pkg) to versions that may match, or None if
+            the repo has no index usable for this solution
+        """
+        index = getattr(repo, 'attr_index', None)
+        if index is None or not self.attrs:
+            return None
+        d = index.candidates(repo, self.attrs)
+        if d is None:
+            return None
+        cat, pkg = self.cat, self.pkg
+        return dict((cp, vers) for cp, vers in d.iteritems()
+                    if cat.accepts(cp[0]) and pkg.accepts(cp[1]))
+
+    def candidates(self, repo, sorter):
+        if self.impossible:
+            return
+        pkg_step = self.pkg
+        pgetter = repo.packages.get
+        cats = self.cat.select(repo.categories, sorter)
+        if self.cat.exact is not None and pkg_step.exact is not None \
+                and not pkg_step.filters:
+            # direct cp lookups; don't pull package listings.
+            for c in cats:
+                for p in sorter(pkg_step.exact):
+                    yield (c, p)
+            return
+        for c in cats:
+            for p in pkg_step.select(pgetter(c, ()), sorter):
+                yield (c, p)
+
+    def describe(self):
+        return "category: %s, package: %s" % (
+            self.cat.describe(), self.pkg.describe())
+
+
+class QueryPlan(object):
+
+    """
+    compiled candidate selection for a restriction
+
+    :ivar solutions: tuple of :obj:`SolutionPlan` instances, one per usable
+        DNF solution, or None if some solution constrains neither
+        category nor package and the whole repo has to be walked
+    :ivar predicates: number of DNF terms left to the per package match
+    """
+
+    __slots__ = ("restriction", "solutions", "predicates")
+
+    def __init__(self, restrict, solutions, predicates=0):
+        self.restriction = restrict
+        self.solutions = solutions
+        self.predicates = predicates
+
+    @property
+    def full_scan(self):
+        return self.solutions is None
+
+    @staticmethod
+    def _repo_stats(repo):
+        n_cats = len(repo.categories)
+        cached = getattr(repo.packages, '_cache', None)
+        if cached:
+            avg_pkgs = sum(len(x) for x in cached.itervalues()) / float(
+                len(cached))
+        else:
+            avg_pkgs = default_avg_packages
+        return n_cats, avg_pkgs
+
+    def cost(self, repo):
+        """Estimate the cost of this plan against a repo.
+
+        :return: (plan cost, full scan cost)
+        """
+        n_cats, avg_pkgs = self._repo_stats(repo)
+        full = n_cats + n_cats * avg_pkgs
+        if self.solutions is None:
+            return full, full
+        return sum(x.cost(n_cats, avg_pkgs)[0] for x in self.solutions), full
+
+    def _resolve(self, repo):
+        if self.solutions is None:
+            return None
+        resolved = []
+        for solution in self.solutions:
+            d = solution.indexed(repo)
+            if d is None and solution.unconstrained:
+                return None
+            resolved.append((solution, d))
+        if len(resolved) > 1 and all(d is None for s, d in resolved):
+            cost, full = self.cost(repo)
+            if cost >= full:
+                return None
+        return resolved
+
+    def narrows(self, repo):
+        """Return whether the plan avoids walking the whole repo."""
+        return self._resolve(repo) is not None
+
+    def candidates(self, repo, sorter):
+        """Return the (category, package) pairs a repo needs to examine.
+
+        If the repo's attribute index narrowed things down to specific
+        versions, a mapping of (category, package) to versions is returned
+        instead.
+        """
+        resolved = self._resolve(repo)
+        if resolved is None:
+            repo._maybe_prefetch()
+            if sorter is iter:
+                return repo.versions
+            return (
+                (c, p)
+                for c in sorter(repo.categories)
+                for p in sorter(repo.packages.get(c, ())))
+        if len(resolved) == 1:
+            solution, d = resolved[0]
+            if d is None:
+                return solution.candidates(repo, sorter)
+            return d
+        if all(d is None for s, d in resolved):
+            # union the solutions, keeping the sorter's category grouping.
+            cps = {}
+            for solution, d in resolved:
+                for c, p in solution.candidates(repo, iter):
+                    cps.setdefault(c, set()).add(p)
+            return ((c, p) for c in sorter(cps) for p in sorter(cps[c]))
+        vers = {}
+        for solution, d in resolved:
+            if d is None:
+                for cp in solution.candidates(repo, iter):
+                    vers.setdefault(cp, set()).update(
+                        repo.versions.get(cp, ()))
+            else:
+                for cp, l in d.iteritems():
+                    vers.setdefault(cp, set()).update(l)
+        return dict((cp, tuple(l)) for cp, l in vers.iteritems() if l)
+
+    def explain(self, repo=None):
+        """Describe the plan, with cost estimates if a repo is given."""
+        l = ["plan for %s:" % (self.restriction,)]
+        if repo is not None:
+            n_cats, avg_pkgs = self._repo_stats(repo)
+            cost, full = self.cost(repo)
+            l.append("  estimated cost %i (full scan %i; %i categories, "
+                     "~%i packages per category)" % (
+                         cost, full, n_cats, avg_pkgs))
+            if self.solutions is not None and len(self.solutions) > 1 and \
+                    cost >= full:
+                l.append("  union is costlier than a full scan; scanning")
+        if self.solutions is None:
+            l.append("  full scan")
+        elif not self.solutions:
+            l.append("  no possible matches")
+        else:
+            for solution in self.solutions:
+                line = "  lookup %s" % (solution.describe(),)
+                d = None
+                if repo is not None:
+                    d = solution.indexed(repo)
+                    if d is None:
+                        line += " (cost %i)" % (
+                            solution.cost(n_cats, avg_pkgs)[0],)
+                if d is not None:
+                    line += ", indexed on %s (%i candidate versions)" % (
+                        ", ".join(sorted(set(x.attr for x in solution.attrs))),
+                        sum(len(x) for x in d.itervalues()))
+                elif solution.unconstrained:
+                    line += "; no usable index, full scan"
+                l.append(line)
+        if self.predicates:
+            l.append("  %i term(s) left to package matching" % (
+                self.predicates,))
+        return "\n".join(l)
+
+    def __str__(self):
+        return self.explain()
+
+
+def _is_cp_term(r):
+    return (isinstance(r, packages.PackageRestriction) and
+            r.attr in ("category", "package"))
+
+
+def compile_plan(restrict):
+    """Compile a package restriction into a :obj:`QueryPlan`, reusing cached
+    plans for previously seen restrictions."""
+    # keyed by identity; restriction equality ignores some distinctions
+    # (and/or for example).  The plan holds a reference to its restriction,
+    # so the id can't be recycled while it's cached.
+    plan = _plan_cache.get(id(restrict))
+    if plan is not None and plan.restriction is restrict:
+        return plan
+    plan = _compile_plan(restrict)
+    if len(_plan_cache) >= _plan_cache_size:
+        _plan_cache.clear()
+    _plan_cache[id(restrict)] = plan
+    return plan
+
+
+def _compile_plan(restrict):
+    f = getattr(restrict, 'iter_dnf_solutions', None)
+    if f is None:
+        dnf = [[restrict]]
+    else:
+        dnf = f(True)
+    solutions = []
+    full_scan = False
+    predicates = 0
+    for solution in dnf:
+        predicates += sum(1 for r in solution if not _is_cp_term(r))
+        if full_scan:
+            continue
+        plan = SolutionPlan.from_solution(solution)
+        if plan.unconstrained and not plan.attrs:
+            full_scan = True
+        elif not plan.impossible:
+            solutions.append(plan)
+    if full_scan:
+        return QueryPlan(restrict, None, predicates)
+    return QueryPlan(restrict, tuple(solutions), predicates)
@@ -11,14 +11,19 @@ __all__ = (
 
 import os
 
+from snakeoil import compatibility
 from snakeoil.compatibility import is_py3k
-from snakeoil.lists import iflatten_instance
+from snakeoil.demandload import demandload
 from snakeoil.mappings import LazyValDict, DictMixin
 
 from pkgcore.ebuild.atom import atom
 from pkgcore.operations import repo
-from pkgcore.restrictions import values, boolean, restriction, packages
-from pkgcore.restrictions.util import collect_package_restrictions
+from pkgcore.repository import planner
+from pkgcore.restrictions import restriction, packages
+
+demandload(
+    'pkgcore.util.thread_pool:map_async',
+)
 
 
 class IterValLazyDict(LazyValDict):
@@ -119,6 +124,27 @@ class VersionMapping(DictMixin):
             self._cache.pop(key, None)
 
 
+def _prefetch_worker(queue, mapping, loaded):
+    for key in queue:
+        try:
+            loaded[key] = mapping[key]
+        except compatibility.IGNORED_EXCEPTIONS:
+            raise
+        except Exception:
+            # left for the lazy lookup to raise in context.
+            pass
+
+
+def _prefetch(mapping, keys, threads):
+    """Pull the values for keys from a lazy mapping across threads.
+
+    :return: dict of the values successfully loaded
+    """
+    loaded = {}
+    map_async(tuple(keys), _prefetch_worker, mapping, loaded, threads=threads)
+    return loaded
+
+
 class tree(object):
     """
     repository template
@@ -133,6 +159,13 @@ class tree(object):
         yielding a configured form of the repository
     :ivar frozen_settable: bool controlling whether frozen is able to be set
         via __init__
+    :ivar prefetch_threads: if more than 1, full tree walks first populate
+        the packages and versions mappings using that many threads; see
+        :obj:`prefetch`
+    :ivar attr_index: None, or an object with a ``candidates(repo, terms)``
+        method (see :obj:`pkgcore.ebuild.attr_index.AttrIndex`) that
+        narrows package restrictions on other attributes down to candidate
+        versions
     """
 
     raw_repo = None
@@ -142,6 +175,9 @@ class tree(object):
     configure = None
     frozen_settable = True
     operations_kls = repo.operations
+    prefetch_threads = 0
+    _prefetched = False
+    attr_index = None
 
     def __init__(self, frozen=False):
         """
@@ -175,6 +211,29 @@ class tree(object):
             raise KeyError(cpv)
         return cpv_inst
 
+    def prefetch(self, threads=None):
+        """Populate the packages and versions mappings for the whole repo.
+
+        The per category and per package lookups are spread across a pool
+        of threads so their I/O latency overlaps; lookups that fail are left
+        unpopulated for the normal lazy access to raise.
+
+        :param threads: number of threads to use, defaults to
+            :obj:`prefetch_threads`, or the cpu count if that's unset
+        """
+        if threads is None:
+            threads = self.prefetch_threads or None
+        self._prefetched = True
+        pkgs = _prefetch(self.packages, self.categories, threads)
+        _prefetch(
+            self.versions,
+            ((cat, pkg) for cat, l in pkgs.iteritems() for pkg in l),
+            threads)
+
+    def _maybe_prefetch(self):
+        if self.prefetch_threads > 1 and not self._prefetched:
+            self.prefetch()
+
     def __setitem__(self, *vals):
         raise AttributeError
 
@@ -211,7 +270,8 @@ class tree(object):
         return list(self.itermatch(atom, **kwds))
 
     def itermatch(self, restrict, restrict_solutions=None, sorter=None,
-                  pkg_klass_override=None, force=None, yield_none=False):
+                  pkg_klass_override=None, force=None, yield_none=False,
+                  candidates=None):
 
         """
         generator that yields packages match a restriction.
@@ -230,6 +290,10 @@ class tree(object):
             packages. If you override this method you should yield
             None in long-running loops, strictly calling it for every package
             is not necessary.
+        :param candidates: iterable of (category, package) pairs to examine
+            instead of identifying them from the restriction; used by
+            :obj:`pkgcore.repository.multiplex.tree` to share that work
+            across its trees.
         """
 
         if not isinstance(restrict, restriction.base):
@@ -240,10 +304,11 @@ class tree(object):
         if sorter is None:
             sorter = iter
 
-        if isinstance(restrict, atom):
-            candidates = [(restrict.category, restrict.package)]
-        else:
-            candidates = self._identify_candidates(restrict, sorter)
+        if candidates is None:
+            if isinstance(restrict, atom):
+                candidates = [(restrict.category, restrict.package)]
+            else:
+                candidates = self._identify_candidates(restrict, sorter)
 
         if force is None:
             match = restrict.match
@@ -257,9 +322,11 @@ class tree(object):
 
     def _internal_gen_candidates(self, candidates, sorter):
         pkls = self.package_class
+        # candidates narrowed down to specific versions come as a mapping.
+        versions = getattr(candidates, 'get', self.versions.get)
         for cp in sorter(candidates):
             for pkg in sorter(pkls(cp[0], cp[1], ver)
-                              for ver in self.versions.get(cp, ())):
+                              for ver in versions(cp, ())):
                 yield pkg
 
     def _internal_match(self, candidates, match_func, sorter,
@@ -274,147 +341,20 @@ class tree(object):
                 yield None
 
     def _identify_candidates(self, restrict, sorter):
-        # full expansion
-        if not isinstance(restrict, boolean.base) or isinstance(restrict, atom):
-            return self._fast_identify_candidates(restrict, sorter)
-        dsolutions = [
-            ([c.restriction
-              for c in collect_package_restrictions(x, ("category",))],
-             [p.restriction
-              for p in collect_package_restrictions(x, ("package",))])
-            for x in restrict.iter_dnf_solutions(True)]
-
-        # see if any solution state isn't dependent on cat/pkg in anyway.
-        # if so, search whole search space.
-        for x in dsolutions:
-            if not x[0] and not x[1]:
-                if sorter is iter:
-                    return self.versions
-                return (
-                    (c, p)
-                    for c in sorter(self.categories)
-                    for p in sorter(self.packages.get(c, ())))
-
-        # simple cases first.
-        # if one specifies categories, and one doesn't
-        cat_specified = bool(dsolutions[0][0])
-        pkg_specified = bool(dsolutions[0][1])
-        pgetter = self.packages.get
-        if any(True for x in dsolutions[1:] if bool(x[0]) != cat_specified):
-            if any(True for x in dsolutions[1:] if bool(x[1]) != pkg_specified):
-                # merde.  so we've got a mix- some specify cats, some
-                # don't, some specify pkgs, some don't.
-                # this may be optimizable
-                return self.versions
-            # ok. so... one doesn't specify a category, but they all
-            # specify packages (or don't)
-            pr = values.OrRestriction(
-                *tuple(iflatten_instance(
-                    (x[1] for x in dsolutions if x[1]), values.base)))
-            return (
-                (c, p)
-                for c in sorter(self.categories)
-                for p in sorter(pgetter(c, [])) if pr.match(p))
-
-        elif any(True for x in dsolutions[1:] if bool(x[1]) != pkg_specified):
-            # one (or more) don't specify pkgs, but they all specify cats.
-            cr = values.OrRestriction(
-                *tuple(iflatten_instance(
-                    (x[0] for x in dsolutions), values.base)))
-            cats_iter = (c for c in sorter(self.categories) if cr.match(c))
-            return (
-                (c, p)
-                for c in cats_iter for p in sorter(pgetter(c, [])))
-
-        return self._fast_identify_candidates(restrict, sorter)
-
-    def _fast_identify_candidates(self, restrict, sorter):
-        pkg_restrict = set()
-        cat_restrict = set()
-        cat_exact = set()
-        pkg_exact = set()
-
-        for x in collect_package_restrictions(restrict,
-                                              ("category", "package",)):
-            if x.attr == "category":
-                cat_restrict.add(x.restriction)
-            elif x.attr == "package":
-                pkg_restrict.add(x.restriction)
-
-        for e, s in ((pkg_exact, pkg_restrict), (cat_exact, cat_restrict)):
-            l = [x for x in s
-                 if isinstance(x, values.StrExactMatch) and not x.negate]
-            s.difference_update(l)
-            e.update(x.exact for x in l)
-        del l
-
-        if restrict.negate:
-            cat_exact = pkg_exact = ()
-
-        if cat_exact:
-            if not cat_restrict and len(cat_exact) == 1:
-                # Cannot use pop here, cat_exact is reused below.
-                c = iter(cat_exact).next()
-                if not pkg_restrict and len(pkg_exact) == 1:
-                    cp = (c, pkg_exact.pop())
-                    if cp in self.versions:
-                        return [cp]
-                    return []
-                cats_iter = [c]
-            else:
-                cat_restrict.add(values.ContainmentMatch(*cat_exact))
-                cats_iter = sorter(self._cat_filter(cat_restrict))
-        elif cat_restrict:
-            cats_iter = self._cat_filter(
-                cat_restrict, negate=restrict.negate)
-        else:
-            cats_iter = sorter(self.categories)
-
-        if pkg_exact:
-            if not pkg_restrict:
-                if sorter is iter:
-                    pkg_exact = tuple(pkg_exact)
-                else:
-                    pkg_exact = sorter(pkg_exact)
-                return (
-                    (c, p)
-                    for c in cats_iter for p in pkg_exact)
-            else:
-                pkg_restrict.add(values.ContainmentMatch(*pkg_exact))
-
-        if pkg_restrict:
-            return self._package_filter(
-                cats_iter, pkg_restrict, negate=restrict.negate)
-        elif not cat_restrict:
-            if sorter is iter and not cat_exact:
-                return self.versions
-            else:
-                return (
-                    (c, p) for c in
-                    cats_iter for p in sorter(self.packages.get(c, ())))
-        return (
-            (c, p)
-            for c in cats_iter for p in sorter(self.packages.get(c, ())))
-
-    def _cat_filter(self, cat_restricts, negate=False):
-        sentinel = not negate
-        cats = [x.match for x in cat_restricts]
-        for x in self.categories:
-            for match in cats:
-                if match(x) == sentinel:
-                    yield x
-                    break
-
-    def _package_filter(self, cats_iter, pkg_restricts, negate=False):
-        sentinel = not negate
-        restricts = [x.match for x in pkg_restricts]
-        pkgs_dict = self.packages
-        for cat in cats_iter:
-            for pkg in pkgs_dict.get(cat, ()):
-                for match in restricts:
-                    if match(pkg) == sentinel:
-                        yield (cat, pkg)
-                        break
+        return self.plan(restrict).candidates(self, sorter)
+
+    def plan(self, restrict):
+        """Return the compiled :obj:`pkgcore.repository.planner.QueryPlan`
+        used to select candidates for a restriction."""
+        return planner.compile_plan(restrict)
+
+    def explain(self, restrict):
+        """Describe how :obj:`itermatch` would search for a restriction,
+        with cost estimates against this repo."""
+        if isinstance(restrict, atom):
+            return "plan for %s:\n  lookup %s/%s" % (
+                restrict, restrict.category, restrict.package)
+        return self.plan(restrict).explain(self)
 
     def notify_remove_package(self, pkg):
         """
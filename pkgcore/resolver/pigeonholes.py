@@ -3,20 +3,149 @@
 
 __all__ = ("PigeonHoledSlots",)
 
+from bisect import bisect_left, bisect_right, insort
+from itertools import count
+
+from snakeoil.klass import inject_richcmp_methods_from_cmp
+
+from pkgcore.ebuild.atom import atom as atom_kls
+from pkgcore.ebuild.cpv import ver_cmp
 from pkgcore.restrictions import restriction
 
+# sorts after any serial; unlike sys.maxint, this exists on py3 too.
+_last_serial = float('inf')
+
 # lil too getter/setter like for my tastes...
 
 
+class _Version(object):
+
+    """version ordered by ebuild version rules, for bisecting"""
+
+    __slots__ = ("ver", "rev")
+
+    def __init__(self, ver, rev):
+        self.ver = ver
+        self.rev = rev
+
+    def __cmp__(self, other):
+        return ver_cmp(self.ver, self.rev, other.ver, other.rev)
+
+    inject_richcmp_methods_from_cmp(locals())
+
+
+class _Limiters(object):
+
+    """
+    limiters of a single key, bucketed by their version restriction
+
+    Atoms with a version operator are kept sorted by version, so only those
+    whose version range could hold an obj have to be matched against it;
+    unversioned atoms and any other restrictions are always matched.
+    Entries carry a serial so matches are returned in insertion order.
+    """
+
+    __slots__ = ("unversioned", "other", "exact", "approx", "upper", "lower",
+                 "count")
+
+    # op -> bucket; '~' ignores revisions, as atoms do.
+    buckets = {'=': 'exact', '~': 'approx', '<': 'upper', '<=': 'upper',
+               '>': 'lower', '>=': 'lower'}
+
+    # up to this many limiters, matching all of them is cheaper than
+    # bisecting.
+    linear_threshold = 8
+
+    def __init__(self):
+        for attr in self.__slots__[:-1]:
+            setattr(self, attr, [])
+        self.count = 0
+
+    def _bucket(self, limiter):
+        if isinstance(limiter, atom_kls) and not limiter.negate_vers:
+            if not limiter.op:
+                return self.unversioned, None
+            bucket = self.buckets.get(limiter.op)
+            if bucket is not None:
+                rev = None if bucket == 'approx' else limiter.revision
+                return getattr(self, bucket), _Version(limiter.version, rev)
+        return self.other, None
+
+    def add(self, limiter, serial):
+        l, version = self._bucket(limiter)
+        if version is None:
+            l.append((serial, limiter))
+        else:
+            insort(l, (version, serial, limiter))
+        self.count += 1
+
+    def remove(self, limiter):
+        """remove a limiter, returning True if it was present"""
+        # scanning is cheaper than bisecting on version comparisons.
+        l = self._bucket(limiter)[0]
+        for idx, x in enumerate(l):
+            if x[-1] is limiter:
+                del l[idx]
+                self.count -= 1
+                return True
+        return False
+
+    def __contains__(self, limiter):
+        return any(x[-1] == limiter for x in self._bucket(limiter)[0])
+
+    def __nonzero__(self):
+        return bool(self.count)
+
+    @staticmethod
+    def _range(l, version):
+        # entries with an equal version; (version,) sorts before them and
+        # (version, _last_serial) after them.
+        return l[bisect_left(l, (version,)):
+                 bisect_right(l, (version, _last_serial))]
+
+    def matches(self, obj):
+        """return the limiters matching obj, in insertion order"""
+        ver = getattr(obj, 'version', None)
+        l = self.unversioned + self.other
+        if ver is None or self.count <= self.linear_threshold:
+            for bucket in (self.exact, self.approx, self.upper, self.lower):
+                if bucket:
+                    l.extend(x[1:] for x in bucket)
+        else:
+            version = _Version(ver, getattr(obj, 'revision', None))
+            if self.exact:
+                l.extend(x[1:] for x in self._range(self.exact, version))
+            if self.approx:
+                l.extend(x[1:] for x in self._range(
+                    self.approx, _Version(ver, None)))
+            # upper bounds at or above the version, lower bounds at or
+            # below it.
+            l.extend(x[1:] for x in
+                     self.upper[bisect_left(self.upper, (version,)):])
+            l.extend(x[1:] for x in self.lower[
+                :bisect_right(self.lower, (version, _last_serial))])
+        l = [x for x in l if x[1].match(obj)]
+        if len(l) > 1:
+            l.sort()
+        return [x[1] for x in l]
+
+
 class PigeonHoledSlots(object):
     """class for tracking slotting to a specific atom/obj key
     no atoms present, just prevents conflicts of obj.key; atom present, assumes
     it's a blocker and ensures no obj matches the atom for that key
+
+    Objs are indexed by key and by (key, slot); limiters are bucketed per
+    key by version range (see :obj:`_Limiters`), keeping conflict checks
+    against large plans with many blockers cheap.  Removals, as done when
+    the resolver backtracks, don't rebuild any of these.
     """
 
     def __init__(self):
         self.slot_dict = {}
+        self._slots = {}
         self.limiters = {}
+        self._serial = count()
 
     def fill_slotting(self, obj, force=False):
         """Try to insert obj in.
@@ -28,22 +157,26 @@ class PigeonHoledSlots(object):
 
         key = obj.key
         dslot = obj.slot
-        l.extend(x for x in self.slot_dict.get(key, ()) if x.slot == dslot)
+        l.extend(self._slots.get((key, dslot), ()))
 
         if not l or force:
             self.slot_dict.setdefault(key, []).append(obj)
+            self._slots.setdefault((key, dslot), []).append(obj)
         return l
 
     def get_conflicting_slot(self, pkg):
-        for x in self.slot_dict.get(pkg.key, ()):
-            if pkg.slot == x.slot:
-                return x
+        for x in self._slots.get((pkg.key, pkg.slot), ()):
+            return x
         return None
 
     def find_atom_matches(self, atom, key=None):
         if key is None:
             key = atom.key
-        return filter(atom.match, self.slot_dict.get(key, ()))
+        if isinstance(atom, atom_kls) and atom.slot is not None:
+            l = self._slots.get((key, atom.slot), ())
+        else:
+            l = self.slot_dict.get(key, ())
+        return filter(atom.match, l)
 
     def add_limiter(self, atom, key=None):
         """add a limiter, returning any conflicting objs"""
@@ -54,37 +187,51 @@ class PigeonHoledSlots(object):
 
         if key is None:
             key = atom.key
-        self.limiters.setdefault(key, []).append(atom)
+        limiters = self.limiters.get(key)
+        if limiters is None:
+            limiters = self.limiters[key] = _Limiters()
+        limiters.add(atom, next(self._serial))
         return self.find_atom_matches(atom, key=key)
 
     def check_limiters(self, obj):
         """return any limiters conflicting w/ the passed in obj"""
-        key = obj.key
-        return [x for x in self.limiters.get(key, ()) if x.match(obj)]
+        limiters = self.limiters.get(obj.key)
+        if limiters is None:
+            return []
+        return limiters.matches(obj)
 
-    def remove_slotting(self, obj):
-        key = obj.key
+    @staticmethod
+    def _remove(d, key, obj):
         # let the key error be thrown if they screwed up.
-        l = [x for x in self.slot_dict[key] if x is not obj]
-        if len(l) == len(self.slot_dict[key]):
-            raise KeyError("obj %s isn't slotted" % obj)
-        if l:
-            self.slot_dict[key] = l
+        l = d[key]
+        for idx, x in enumerate(l):
+            if x is obj:
+                del l[idx]
+                break
         else:
-            del self.slot_dict[key]
+            raise KeyError("obj %s isn't slotted" % obj)
+        if not l:
+            del d[key]
+
+    def remove_slotting(self, obj):
+        key = obj.key
+        self._remove(self.slot_dict, key, obj)
+        self._remove(self._slots, (key, obj.slot), obj)
 
     def remove_limiter(self, atom, key=None):
         if key is None:
             key = atom.key
-        l = [x for x in self.limiters[key] if x is not atom]
-        if len(l) == len(self.limiters[key]):
+        limiters = self.limiters[key]
+        if not limiters.remove(atom):
             raise KeyError("obj %s isn't slotted" % atom)
-        if not l:
+        if not limiters:
             del self.limiters[key]
-        else:
-            self.limiters[key] = l
 
     def __contains__(self, obj):
         if isinstance(obj, restriction.base):
-            return obj in self.limiters.get(obj.key, ())
-        return obj in self.slot_dict.get(obj.key, ())
+            key = getattr(obj, 'key', None)
+            if key is None:
+                # limiters wrapping a blocker are filed under its key.
+                return any(obj in l for l in self.limiters.itervalues())
+            return obj in self.limiters.get(key, ())
+        return obj in self._slots.get((obj.key, obj.slot), ())
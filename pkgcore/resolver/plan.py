@@ -1,13 +1,14 @@
 # Copyright: 2006-2011 Brian Harring <ferringb@gmail.com>
 # License: GPL2/BSD
 
-__all__ = ("resolver_frame", "resolver_stack", "merge_plan")
+__all__ = ("resolver_frame", "resolver_stack", "resolver_stats", "merge_plan")
 
 from collections import deque
 from functools import partial
 import operator
 from itertools import chain, islice, ifilterfalse as filterfalse
 import sys
+from time import time
 
 from snakeoil.compatibility import cmp, sort_cmp
 from snakeoil.iterables import caching_iter
@@ -95,7 +96,7 @@ class resolver_frame(object):
 
     __slots__ = ("parent", "atom", "choices", "mode", "start_point", "dbs",
         "depth", "drop_cycles", "__weakref__", "ignored", "vdb_limited",
-        "events", "succeeded")
+        "events", "succeeded", "conflicts")
 
     def __init__(self, parent, mode, atom, choices, dbs, start_point, depth,
                  drop_cycles, ignored=False, vdb_limited=False):
@@ -112,6 +113,26 @@ class resolver_frame(object):
         self.vdb_limited = vdb_limited
         self.events = []
         self.succeeded = None
+        # state entries (pkgs or blockers) failures in this frame were
+        # caused by; None if a failure depended on more than the plan
+        # state (cycle handling, vdb filtering), so nothing can be learned.
+        if drop_cycles or vdb_limited:
+            self.conflicts = None
+        else:
+            self.conflicts = set()
+
+    def add_conflicts(self, conflicts):
+        """Record state entries responsible for a failure in this frame.
+
+        :param conflicts: iterable of pkgs/blockers, or None if the failure
+            can't be attributed to the plan state
+        """
+        if self.conflicts is None:
+            return
+        if conflicts is None:
+            self.conflicts = None
+        else:
+            self.conflicts.update(conflicts)
 
     def reduce_solutions(self, nodes):
         if isinstance(nodes, (list, tuple)):
@@ -191,6 +212,9 @@ class resolver_stack(deque):
         frame = self.pop()
         frame.succeeded = bool(result)
         frame.parent.events.append(frame)
+        if not result and self:
+            # the failure is part of why the requesting frame's choice fails.
+            frame.parent.add_conflicts(frame.conflicts)
 
     def slot_cycles(self, trg_frame, **kwds):
         pkg = trg_frame.current_pkg
@@ -222,6 +246,187 @@ class resolver_stack(deque):
         return -1
 
 
+def _timed_iter(counts, func, *args, **kwds):
+    # time spent producing matches, excluding the consumer's processing.
+    start = time()
+    i = iter(func(*args, **kwds))
+    counts[2] += time() - start
+    while True:
+        start = time()
+        try:
+            x = next(i)
+        except StopIteration:
+            counts[2] += time() - start
+            return
+        counts[2] += time() - start
+        counts[3] += 1
+        yield x
+
+
+class _instrumented_caching_repo(misc.caching_repo):
+
+    def __init__(self, db, strategy, persistent=None, stats=None):
+        misc.caching_repo.__init__(self, db, strategy, persistent=persistent)
+        name = getattr(db, 'repo_id', None) or str(db)
+        self._counts = stats.queries.setdefault(name, [0, 0, 0.0, 0])
+
+    def match(self, restrict):
+        self._counts[0 if restrict in self.__cache__ else 1] += 1
+        return misc.caching_repo.match(self, restrict)
+
+    def _query(self, restrict):
+        return _timed_iter(
+            self._counts, misc.caching_repo._query, self, restrict)
+
+
+class resolver_stats(object):
+
+    """
+    counters and timings collected while resolving
+
+    Collection is enabled by passing stats=True to :obj:`merge_plan`, which
+    wraps the resolver's hooks via :obj:`install`; without it nothing is
+    wrapped, so there's no overhead.
+
+    :ivar atoms: dict of atom to [calls, inclusive seconds, backtracks,
+        times its choices were exhausted]
+    :ivar queries: dict of repo name to [cache hits, cache misses, seconds
+        spent in itermatch, matches returned]
+    :ivar viable: dict of viability check outcome to count
+    :ivar backtracks: dict of stack depth to choices abandoned due to
+        failing dependencies, insertion conflicts or learned no-goods
+    :ivar exhausted: dict of stack depth to choice points that ran out of
+        choices
+    :ivar extra: dict of additional strategy specific statistics
+    """
+
+    def __init__(self):
+        self.atoms = {}
+        self.queries = {}
+        self.viable = {}
+        self.backtracks = {}
+        self.exhausted = {}
+        self.extra = {}
+
+    def install(self, resolver):
+        """Wrap a resolver's hooks to collect statistics."""
+        for attr in ('_rec_add_atom', '_viable', 'notify_viable',
+                     'notify_choice_failed', 'notify_choices_exhausted',
+                     'process_dependencies_and_blocks'):
+            setattr(resolver, attr, partial(
+                getattr(self, '_wrap_%s' % attr.lstrip('_')),
+                getattr(resolver, attr)))
+
+    def _atom(self, atom):
+        l = self.atoms.get(atom)
+        if l is None:
+            l = self.atoms[atom] = [0, 0.0, 0, 0]
+        return l
+
+    @staticmethod
+    def _incr(d, key):
+        d[key] = d.get(key, 0) + 1
+
+    def _wrap_rec_add_atom(self, func, atom, stack, dbs, **kwds):
+        l = self._atom(atom)
+        l[0] += 1
+        start = time()
+        try:
+            return func(atom, stack, dbs, **kwds)
+        finally:
+            l[1] += time() - start
+
+    def _wrap_viable(self, func, *args):
+        ret = func(*args)
+        if ret is not None and ret is not True:
+            self._incr(self.viable, "viable")
+        return ret
+
+    def _wrap_notify_viable(self, func, stack, atom, viable, msg='',
+                            pre_solved=False):
+        if viable:
+            self._incr(self.viable, pre_solved and "pre-solved" or "viable")
+        else:
+            # strip the specifics, ie which entries a no-good conflicts with.
+            self._incr(self.viable, msg.split(",", 1)[0] or "not viable")
+        return func(stack, atom, viable, msg, pre_solved=pre_solved)
+
+    def _backtracked(self, stack, atom):
+        self._incr(self.backtracks, stack.depth)
+        self._atom(atom)[2] += 1
+
+    def _wrap_notify_choice_failed(self, func, stack, atom, choices, *args):
+        self._backtracked(stack, atom)
+        return func(stack, atom, choices, *args)
+
+    def _wrap_process_dependencies_and_blocks(self, func, stack, choices,
+                                              attr, atom=None, depth=None):
+        ret = func(stack, choices, attr, atom, depth)
+        if ret[1]:
+            self._backtracked(stack, stack.current_frame.atom)
+        return ret
+
+    def _wrap_notify_choices_exhausted(self, func, stack, atom):
+        self._incr(self.exhausted, stack.depth)
+        self._atom(atom)[3] += 1
+        return func(stack, atom)
+
+    def to_dict(self):
+        """Return the statistics as a JSON serializable dict."""
+        return {
+            'atoms': dict(
+                (str(atom), dict(zip(
+                    ('calls', 'seconds', 'backtracks', 'exhausted'), l)))
+                for atom, l in self.atoms.iteritems()),
+            'queries': dict(
+                (name, dict(zip(('hits', 'misses', 'seconds', 'matches'), l)))
+                for name, l in self.queries.iteritems()),
+            'viable': dict(self.viable),
+            'backtracks': dict(
+                (str(k), v) for k, v in self.backtracks.iteritems()),
+            'exhausted': dict(
+                (str(k), v) for k, v in self.exhausted.iteritems()),
+            'extra': dict(self.extra),
+        }
+
+    def summary(self, limit=10):
+        """Return a human readable summary as a list of lines.
+
+        :param limit: number of the most expensive atoms to list
+        """
+        l = ["resolver statistics:"]
+        l.append("  %i atoms processed, %i times" % (
+            len(self.atoms), sum(x[0] for x in self.atoms.itervalues())))
+        if self.viable:
+            l.append("  viability checks: %s" % (", ".join(
+                "%s %i" % x for x in sorted(self.viable.iteritems())),))
+        for name, d in (("backtracks", self.backtracks),
+                        ("exhausted choice points", self.exhausted)):
+            if d:
+                l.append("  %s by depth: %s (%i total)" % (name, ", ".join(
+                    "%i: %i" % x for x in sorted(d.iteritems())),
+                    sum(d.itervalues())))
+        if self.queries:
+            l.append("  %-30s %8s %8s %8s %9s" % (
+                "repo queries", "hits", "misses", "matches", "seconds"))
+            for name, (hits, misses, seconds, matches) in sorted(
+                    self.queries.iteritems()):
+                l.append("    %-28s %8i %8i %8i %9.3f" % (
+                    name, hits, misses, matches, seconds))
+        atoms = sorted(self.atoms.iteritems(), key=lambda x: x[1][1],
+                       reverse=True)[:limit]
+        if atoms:
+            l.append("  %-30s %8s %8s %8s %9s" % (
+                "slowest atoms", "calls", "backtrack", "exhausted", "seconds"))
+            for atom, (calls, seconds, backtracks, exhausted) in atoms:
+                l.append("    %-28s %8i %8i %8i %9.3f" % (
+                    atom, calls, backtracks, exhausted, seconds))
+        for key, val in sorted(self.extra.iteritems()):
+            l.append("  %s: %s" % (key, val))
+        return l
+
+
+
 class merge_plan(object):
 
     vdb_restrict = packages.PackageRestriction("repo.livefs",
@@ -231,7 +436,8 @@ class merge_plan(object):
                  global_strategy=None,
                  depset_reorder_strategy=None,
                  process_built_depends=False,
-                 drop_cycles=False, debug=False, debug_handle=None):
+                 drop_cycles=False, debug=False, debug_handle=None,
+                 stats=False, match_cache=None):
 
         if debug_handle is None:
             debug_handle = sys.stdout
@@ -252,7 +458,19 @@ class merge_plan(object):
         self.depset_reorder = depset_reorder_strategy
         self.per_repo_strategy = per_repo_strategy
         self.total_ordering_strategy = global_strategy
-        self.all_raw_dbs = [misc.caching_repo(x, self.per_repo_strategy) for x in dbs]
+        # collection is opt in; the hooks are only wrapped when enabled.
+        self.stats = None
+        repo_kls = misc.caching_repo
+        if stats:
+            self.stats = resolver_stats()
+            repo_kls = partial(_instrumented_caching_repo, stats=self.stats)
+        if match_cache is None:
+            self.all_raw_dbs = [
+                repo_kls(x, self.per_repo_strategy) for x in dbs]
+        else:
+            self.all_raw_dbs = [
+                repo_kls(x, self.per_repo_strategy,
+                         persistent=match_cache.for_repo(x)) for x in dbs]
         self.all_dbs = global_strategy(self.all_raw_dbs)
         self.default_dbs = self.all_dbs
 
@@ -263,6 +481,9 @@ class merge_plan(object):
                 for x in self.all_raw_dbs if x.livefs])
 
         self.insoluble = set()
+        # atom -> set of frozensets of state entries; while all entries of
+        # one of those sets are in the plan, the atom can't be resolved.
+        self.nogoods = {}
         self.vdb_preloaded = False
         self._ensure_livefs_is_loaded = \
             self._ensure_livefs_is_loaded_nonpreloaded
@@ -274,6 +495,8 @@ class merge_plan(object):
                 self._rec_add_atom)
             self._debugging_depth = 0
             self._debugging_drop_cycles = False
+        if stats:
+            self.stats.install(self)
 
     @property
     def forced_restrictions(self):
@@ -310,6 +533,10 @@ class merge_plan(object):
         self._dprint("choice for %s%s, %s succeeded%s",
             (stack.depth * 2 * ' ', atom, choices.current_pkg, msg))
 
+    def notify_choices_exhausted(self, stack, atom):
+        self._dprint("no solution  %s%s", (stack.depth * 2 * " ", atom))
+        stack.add_event(("debug", "ran out of choices",))
+
     def notify_viable(self, stack, atom, viable, msg='', pre_solved=False):
         t_viable = viable and "processing" or "not viable"
         if pre_solved and viable:
@@ -321,7 +548,24 @@ class merge_plan(object):
         self._dprint("%s%s%s%s%s", (t_viable.ljust(13), "  "*stack.depth, atom, s, t_msg))
         stack.add_event(("viable", viable, pre_solved, atom, msg))
 
-    def load_vdb_state(self):
+    def load_vdb_state(self, snapshot=None):
+        """Insert every installed package into the plan.
+
+        :param snapshot: optional
+            :obj:`pkgcore.resolver.snapshot.StateSnapshot` to restore the
+            state from if valid, and to record it to otherwise
+        """
+        if snapshot is not None and snapshot.restore(self):
+            self._dprint("restored vdb state from %s", (snapshot.path,), "vdb")
+        else:
+            self._load_vdb_state()
+            if snapshot is not None:
+                snapshot.save(self)
+        self.vdb_preloaded = True
+        self._ensure_livefs_is_loaded = \
+            self._ensure_livefs_is_loaded_preloaded
+
+    def _load_vdb_state(self):
         for pkg in self.livefs_dbs:
             self._dprint("inserting %s", (pkg,), "vdb")
             ret = self.add_atom(pkg.versioned_atom)
@@ -330,9 +574,6 @@ class merge_plan(object):
                 raise Exception(
                     "couldn't load vdb state, %s %s" %
                     (pkg.versioned_atom, ret))
-        self.vdb_preloaded = True
-        self._ensure_livefs_is_loaded = \
-            self._ensure_livefs_is_loaded_preloaded
 
     def add_atoms(self, restricts, finalize=False):
         if restricts:
@@ -441,6 +682,17 @@ class merge_plan(object):
 
             self.notify_trying_choice(stack, atom, choices)
 
+            nogood = self._nogood_deps(stack, choices)
+            if nogood is not None:
+                # skip straight past choices requiring something already
+                # known to fail against the current plan.
+                self.notify_choice_failed(stack, atom, choices,
+                    "dependency hits learned no-good, conflicts with %s",
+                    ", ".join(map(str, nogood)))
+                stack.current_frame.add_conflicts(nogood)
+                choices.force_next_pkg()
+                continue
+
             if not choices.current_pkg.built or self.process_built_depends:
                 new_additions, failures = self.process_dependencies_and_blocks(
                     stack, choices, 'depends', atom, depth)
@@ -466,6 +718,7 @@ class merge_plan(object):
                 # failure.
                 self.notify_choice_failed(stack, atom, choices,
                     "failed inserting: %s", l)
+                stack.current_frame.add_conflicts(l)
                 self.state.backtrack(stack.current_frame.start_point)
                 choices.force_next_pkg()
                 continue
@@ -480,9 +733,9 @@ class merge_plan(object):
             stack.pop_frame(True)
             return None
 
-        self._dprint("no solution  %s%s", (depth*2*" ", atom))
-        stack.add_event(("debug", "ran out of choices",))
+        self.notify_choices_exhausted(stack, atom)
         self.state.backtrack(stack.current_frame.start_point)
+        self._learn_nogood(stack.current_frame)
         # saving roll.  if we're allowed to drop cycles, try it again.
         # this needs to be *far* more fine grained also. it'll try
         # regardless of if it's a cycle issue
@@ -500,6 +753,61 @@ class merge_plan(object):
         stack.pop_frame(False)
         return [atom] + failures
 
+    def _nogood(self, atom):
+        """Return the state entries of a learned no-good for an atom, if one
+        applies to the current plan state."""
+        nogoods = self.nogoods.get(atom)
+        if nogoods:
+            present = self.state.state.__contains__
+            for culprits in nogoods:
+                if all(present(x) for x in culprits):
+                    return culprits
+        return None
+
+    def _nogood_deps(self, stack, choices):
+        """Check the current choice's hard dependencies against learned
+        no-goods.
+
+        :return: None if no dependency is known to fail, else the state
+            entries responsible
+        """
+        if not self.nogoods or stack.current_frame.dbs is not self.default_dbs:
+            return None
+        attrs = ('rdepends', 'post_rdepends')
+        if not choices.current_pkg.built or self.process_built_depends:
+            attrs = ('depends',) + attrs
+        for attr in attrs:
+            for or_block in getattr(choices, attr):
+                culprits = set()
+                for or_node in or_block:
+                    if or_node.blocks or self.state.match_atom(or_node):
+                        break
+                    nogood = self._nogood(or_node)
+                    if nogood is None:
+                        break
+                    culprits.update(nogood)
+                else:
+                    return culprits
+        return None
+
+    def _learn_nogood(self, frame):
+        """Record why a frame ran out of choices.
+
+        Only entries that were in the plan before the frame started are
+        kept; anything the frame added itself was reverted along with it.
+        """
+        conflicts = frame.conflicts
+        if not conflicts:
+            return
+        present = self.state.state.__contains__
+        culprits = frozenset(x for x in conflicts if present(x))
+        # the requesting frame only cares about what's still in the plan.
+        frame.conflicts = set(culprits)
+        if culprits and frame.dbs is self.default_dbs:
+            self.nogoods.setdefault(frame.atom, set()).add(culprits)
+            self._dprint("learned no-good for %s: %s",
+                (frame.atom, ", ".join(map(str, culprits))), "nogood")
+
     def _viable(self, stack, mode, atom, dbs, drop_cycles, limit_to_vdb):
         """
         internal function to discern if an atom is viable, returning
@@ -517,14 +825,19 @@ class merge_plan(object):
         :return: 3 possible; None (not viable), True (presolved),
           :obj:`caching_iter` (not solved, but viable), :obj:`choice_point`
         """
-        choices = ret = None
+        choices = ret = nogood = None
         if atom in self.insoluble:
             ret = ((False, "globally insoluble"),{})
             matches = ()
         else:
             matches = self.state.match_atom(atom)
+            if not matches and dbs is self.default_dbs:
+                nogood = self._nogood(atom)
             if matches:
                 ret = ((True,), {"pre_solved":True})
+            elif nogood is not None:
+                ret = ((False, "learned no-good, conflicts with %s" %
+                    ", ".join(map(str, nogood))), {})
             else:
                 # not in the plan thus far.
                 matches = caching_iter(dbs.itermatch(atom))
@@ -546,7 +859,9 @@ class merge_plan(object):
         stack.add_frame(mode, atom, choices, dbs,
             self.state.current_state, drop_cycles, vdb_limited=limit_to_vdb)
 
-        if not limit_to_vdb and not matches:
+        if nogood is not None:
+            stack.current_frame.add_conflicts(nogood)
+        elif not limit_to_vdb and not matches:
             self.insoluble.add(atom)
         if ret is not None:
             self.notify_viable(stack, atom, *ret[0], **ret[1])
@@ -666,6 +981,7 @@ class merge_plan(object):
         ret = self.insert_blockers(stack, choices, [blocker])
         if ret is None:
             return []
+        stack.current_frame.add_conflicts(ret[1])
         self.notify_choice_failed(stack, atom, choices,
             "%s blocker: %s conflicts w/ %s", (mode, ret[0], ret[1]))
         return [ret[0]]
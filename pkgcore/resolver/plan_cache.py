@@ -0,0 +1,298 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+persistent cache of resolved plans, for incremental re-resolution
+
+Resolving a set like ``@world`` walks every package reachable from it, even
+if only a handful of them changed since the last run.  :obj:`PlanCache`
+records a successful plan together with what it was derived from: a stamp
+of each package key the plan or the dependencies of its packages refer to
+(see :obj:`_KeyStamps`), the USE flags each planned package was configured
+with, and the keys each planned package depends on.
+
+On the next run, keys whose stamp changed, whose planned packages vanished
+or whose USE flags differ are invalidated along with every key depending on
+them, directly or not.  The ops of the remaining keys are replayed into the
+resolver, where they're picked up as pre-solved, and the targets are
+resolved as usual; only the invalidated part of the graph is walked again.
+Replayed packages the new plan doesn't reach anymore are dropped by a
+second pass, and if the seeded resolution fails it's redone from scratch.
+
+The whole cache is discarded if its key doesn't match: a digest of the
+configuration signature (usually
+:obj:`pkgcore.repository.match_cache.domain_signature` computed without the
+USE configuration, as that's checked per package), the resolver setup and
+the profiles and eclasses of each repository.
+"""
+
+__all__ = ("PlanCache",)
+
+import hashlib
+import os
+
+from snakeoil.demandload import demandload
+from snakeoil.osutils import pjoin
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.repository.match_cache import _mtime, repo_stamp
+from pkgcore.resolver.choice_point import choice_point
+from pkgcore.resolver.snapshot import (
+    _PlanRecord, _Unsupported, _find_pkg, _name)
+
+demandload(
+    'pkgcore.log:logger',
+)
+
+
+class _KeyStamps(object):
+
+    """stamps of the on disk state of package keys across repositories"""
+
+    def __init__(self, dbs):
+        self.locations = [db.location for db in dbs]
+        self._listings = {}
+
+    def _listdir(self, path):
+        l = self._listings.get(path)
+        if l is None:
+            try:
+                l = sorted(os.listdir(path))
+            except EnvironmentError:
+                l = []
+            self._listings[path] = l
+        return l
+
+    def _tree_stamp(self, location, cat, pkg):
+        # ebuild repository layout: a directory per package holding the
+        # ebuilds, and an md5-cache entry per version.
+        base = pjoin(location, cat, pkg)
+        l = [base]
+        for x in self._listdir(base):
+            if x.endswith('.ebuild'):
+                l.append(pjoin(base, x))
+                l.append(pjoin(location, 'metadata', 'md5-cache', cat, x[:-7]))
+        return ['%s:%s' % (os.path.basename(x), _mtime(x)) for x in l]
+
+    def _flat_stamp(self, location, cat, pkg):
+        # vdb and binpkg layout: an entry per version in the category.
+        base = pjoin(location, cat)
+        prefix = pkg + '-'
+        return ['%s:%s' % (x, _mtime(pjoin(base, x)))
+                for x in self._listdir(base)
+                if x.startswith(prefix) and x[len(prefix):][:1].isdigit()]
+
+    def __call__(self, key):
+        cat, pkg = str(key).split('/', 1)
+        l = []
+        for location in self.locations:
+            if os.path.isdir(pjoin(location, cat, pkg)):
+                l.extend(self._tree_stamp(location, cat, pkg))
+            else:
+                l.extend(self._flat_stamp(location, cat, pkg))
+        return ','.join(l)
+
+
+def _dep_keys(pkg):
+    keys = set()
+    for attr in ('depends', 'rdepends', 'post_rdepends'):
+        for block in getattr(pkg, attr).cnf_solutions():
+            keys.update(x.key for x in block if getattr(x, 'key', None))
+    return sorted(keys)
+
+
+class PlanCache(_PlanRecord):
+
+    """
+    on disk record of the last plan resolved, reused by later resolutions
+
+    :ivar reused: number of recorded ops replayed by the last
+        :obj:`add_atoms` call
+    """
+
+    magic = 'pkgcore-plan-1'
+    description = 'plan cache'
+
+    def __init__(self, path, signature=''):
+        """
+        :param path: location of the cache file
+        :param signature: configuration signature the plan depends on,
+            usually from :obj:`pkgcore.repository.match_cache.domain_signature`
+        """
+        _PlanRecord.__init__(self, path, signature)
+        self.reused = 0
+
+    def key(self, resolver):
+        """Return the key identifying the setup a plan was resolved with,
+        or None if it can't be cached (some repo has no on disk location)."""
+        chksum = hashlib.md5()
+        cls = resolver.__class__
+        chksum.update('%s %s.%s %s %s %s %s %s %s\n' % (
+            self.signature, cls.__module__, cls.__name__,
+            _name(resolver.per_repo_strategy),
+            _name(resolver.total_ordering_strategy),
+            _name(resolver.depset_reorder),
+            resolver.process_built_depends, resolver.drop_cycles,
+            resolver.vdb_preloaded))
+        for db in resolver.all_raw_dbs:
+            location = getattr(db, 'location', None)
+            if not isinstance(location, basestring):
+                return None
+            stamp = '' if db.livefs else repo_stamp(location, sync=False)
+            chksum.update('%s %s %s %s\n' % (
+                db.repo_id, _name(db.__db__.__class__), location, stamp))
+        return chksum.hexdigest()
+
+    def add_atoms(self, resolver, restricts, finalize=False):
+        """Resolve restricts, reusing the recorded plan where still valid.
+
+        This behaves as ``resolver.add_atoms``; on success the resulting
+        plan is recorded for the next run.
+        """
+        start = resolver.state.current_state
+        self.reused = 0
+        ret = None
+        data = self._read()
+        if data is not None:
+            key = self.key(resolver)
+            if key is not None and data.get('key') == key:
+                ret = self._incremental(resolver, data, restricts, finalize)
+        if ret is None:
+            resolver.reset(start)
+            self.reused = 0
+            ret = resolver.add_atoms(restricts, finalize=finalize)
+        if not ret:
+            self.save(resolver, start)
+        return ret
+
+    def _incremental(self, resolver, data, restricts, finalize):
+        start = resolver.state.current_state
+        try:
+            pkgs, invalid = self._validate(resolver, data)
+            choices = [
+                None if pkgs[pkg] is None else
+                choice_point(atom(a), [pkgs[pkg]])
+                for a, pkg in data['choices']]
+            # targets are hardref'd anew, and blockers of removed packages
+            # are dropped by the removals themselves.
+            ops = [op for op in data['ops']
+                   if op[0] not in ('hardref', 'decref')]
+            for attempt in (0, 1):
+                replayed = self._replay_ops(
+                    resolver, ops, choices, pkgs, invalid)
+                if not replayed:
+                    return None
+                ret = resolver.add_atoms(restricts, finalize=finalize)
+                if ret:
+                    logger.debug("resolution seeded from %s failed: %s",
+                                 self.path, ret)
+                    return None
+                unreached = replayed.difference(
+                    self._reached(resolver, restricts))
+                if not unreached:
+                    return ret
+                resolver.reset(start)
+                invalid.update(unreached)
+        except (_Unsupported, LookupError, TypeError, ValueError) as e:
+            logger.warning("failed reusing plan cache %s: %s", self.path, e)
+        return None
+
+    def _validate(self, resolver, data):
+        """Look up the recorded packages, returning them and the keys
+        that have to be resolved again."""
+        stamps = _KeyStamps(resolver.all_raw_dbs)
+        invalid = set(key for key, stamp in data['stamps'].iteritems()
+                      if stamps(key) != stamp)
+        dbs = dict((db.repo_id, db) for db in resolver.all_raw_dbs)
+        pkgs = []
+        for (repo_id, cpv), key, use in zip(
+                data['pkgs'], data['keys'], data['use']):
+            pkg = None
+            if key not in invalid:
+                pkg = _find_pkg(dbs[repo_id], cpv)
+                if pkg is None or (use is not None and
+                                   sorted(getattr(pkg, 'use', ())) != use):
+                    invalid.add(key)
+                    pkg = None
+            pkgs.append(pkg)
+
+        rdeps = {}
+        for key, deps in zip(data['keys'], data['deps']):
+            for dep in deps:
+                rdeps.setdefault(dep, set()).add(key)
+        todo = list(invalid)
+        while todo:
+            for key in rdeps.get(todo.pop(), ()):
+                if key not in invalid:
+                    invalid.add(key)
+                    todo.append(key)
+        return pkgs, invalid
+
+    def _replay_ops(self, resolver, ops, choices, pkgs, invalid):
+        replayed = set()
+        count = 0
+        for op in ops:
+            c = choices[op[1]]
+            if c is None or c.current_pkg.key in invalid:
+                continue
+            self._apply(resolver, op, choices, pkgs)
+            replayed.add(c.current_pkg.key)
+            count += 1
+        self.reused = count
+        return replayed
+
+    @staticmethod
+    def _reached(resolver, restricts):
+        """Return the keys of the packages in the plan the targets depend
+        on, directly or not."""
+        plan = resolver.state
+        todo = []
+        for restrict in restricts:
+            if getattr(restrict, 'key', None) is None:
+                raise _Unsupported("non atom restriction %s" % (restrict,))
+            todo.extend(plan.match_atom(restrict))
+        seen = set()
+        while todo:
+            pkg = todo.pop()
+            if pkg in seen:
+                continue
+            seen.add(pkg)
+            choices = plan.pkg_choices.get(pkg)
+            if choices is None:
+                continue
+            attrs = ('depends', 'rdepends', 'post_rdepends')
+            if getattr(pkg, 'built', False) and \
+                    not resolver.process_built_depends:
+                attrs = attrs[1:]
+            for attr in attrs:
+                for block in getattr(choices, attr):
+                    for x in block:
+                        if getattr(x, 'key', None) is None or \
+                                getattr(x, 'blocks', False):
+                            continue
+                        todo.extend(plan.match_atom(x))
+        return set(pkg.key for pkg in seen)
+
+    def _serialize(self, resolver, start=0):
+        data = _PlanRecord._serialize(self, resolver, start)
+        known = {}
+        for op in resolver.state.plan[start:]:
+            for pkg in (getattr(op, 'pkg', None), getattr(
+                    getattr(op, 'choices', None), 'current_pkg', None)):
+                if pkg is not None:
+                    known[(pkg.repo.repo_id, pkg.cpvstr)] = pkg
+        keys, use, deps = [], [], []
+        referenced = set()
+        for ref in data['pkgs']:
+            pkg = known[tuple(ref)]
+            keys.append(pkg.key)
+            pkg_use = getattr(pkg, 'use', None)
+            use.append(None if pkg_use is None else sorted(pkg_use))
+            deps.append(_dep_keys(pkg))
+            referenced.add(pkg.key)
+            referenced.update(deps[-1])
+        stamps = _KeyStamps(resolver.all_raw_dbs)
+        data.update(
+            keys=keys, use=use, deps=deps,
+            stamps=dict((key, stamps(key)) for key in referenced))
+        return data
@@ -0,0 +1,580 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+SAT based resolver strategy
+
+:obj:`sat_merge_plan` is a drop in alternative to
+:obj:`pkgcore.resolver.plan.merge_plan` (pass it as ``resolver_cls`` to
+:obj:`pkgcore.ebuild.resolver.upgrade_resolver` or
+:obj:`pkgcore.ebuild.resolver.min_install_resolver`).  Instead of walking the
+dependency graph depth first, it collects every candidate package reachable
+from the targets, encodes the selection as a boolean satisfiability problem
+and solves it globally with a small CDCL solver (:obj:`Solver`):
+
+- each candidate package is a variable; a package in the plan already is
+  fixed, an installed one has to stay unless something replaces it in its
+  slot
+- each dependency or-block of a candidate is a clause requiring the
+  candidate to be unselected or one of the block's matches selected
+- blockers get an auxiliary variable that excludes everything they match
+- at most one package per key/slot (:obj:`PigeonHoledSlots` semantics)
+
+Decisions follow the repository strategy ordering, so the preferred match
+for each atom is tried first; the solution is then replayed into the
+:obj:`pkgcore.resolver.state.plan_state` using the same operations
+merge_plan generates.
+"""
+
+__all__ = ("Solver", "sat_merge_plan")
+
+from collections import deque
+from heapq import heappop, heappush
+
+from pkgcore.resolver import plan
+from pkgcore.resolver.choice_point import choice_point
+
+
+class Solver(object):
+
+    """
+    minimal CDCL SAT solver
+
+    Literals are non zero ints; a negative literal is the negation of the
+    variable.  Conflicts are analyzed to the first unique implication point,
+    learned clauses are kept and the search backjumps to the asserting level.
+    Decisions are made by the caller, see :obj:`solve`.
+
+    :ivar trail: assigned literals in assignment order
+    """
+
+    def __init__(self):
+        self.nvars = 0
+        self.clauses = []
+        self.watches = {}
+        self.units = []
+        self.unsat = False
+        self.values = {}
+        self.trail = []
+        self.conflicts = 0
+        self.decisions = 0
+        self.propagations = 0
+
+    def new_var(self):
+        self.nvars += 1
+        return self.nvars
+
+    def add_clause(self, lits):
+        lits = list(set(lits))
+        s = set(lits)
+        if any(-x in s for x in lits):
+            # tautology.
+            return
+        if not lits:
+            self.unsat = True
+        elif len(lits) == 1:
+            self.units.append(lits[0])
+        else:
+            self._watch(lits)
+
+    def _watch(self, clause):
+        self.clauses.append(clause)
+        self.watches.setdefault(-clause[0], []).append(clause)
+        self.watches.setdefault(-clause[1], []).append(clause)
+
+    def value(self, lit):
+        """Return True/False for an assigned literal, None if unassigned."""
+        val = self.values.get(abs(lit))
+        if val is None or lit > 0:
+            return val
+        return not val
+
+    def _enqueue(self, lit, reason):
+        self.values[abs(lit)] = lit > 0
+        self._level[abs(lit)] = len(self._trail_lim)
+        self._reason[abs(lit)] = reason
+        self.trail.append(lit)
+
+    def _propagate(self):
+        trail = self.trail
+        value = self.value
+        watches = self.watches
+        while self._qhead < len(trail):
+            lit = trail[self._qhead]
+            self._qhead += 1
+            self.propagations += 1
+            # clauses watching -lit, which just became false.
+            l = watches.get(lit)
+            if not l:
+                continue
+            false_lit = -lit
+            keep = []
+            for idx, clause in enumerate(l):
+                if clause[0] == false_lit:
+                    clause[0], clause[1] = clause[1], false_lit
+                if value(clause[0]) is True:
+                    keep.append(clause)
+                    continue
+                for i in xrange(2, len(clause)):
+                    if value(clause[i]) is not False:
+                        clause[1], clause[i] = clause[i], false_lit
+                        watches.setdefault(-clause[1], []).append(clause)
+                        break
+                else:
+                    keep.append(clause)
+                    if value(clause[0]) is False:
+                        keep.extend(l[idx + 1:])
+                        watches[lit] = keep
+                        return clause
+                    self._enqueue(clause[0], clause)
+            watches[lit] = keep
+        return None
+
+    def _analyze(self, conflict):
+        level = self._level
+        current = len(self._trail_lim)
+        seen = set()
+        learnt = [None]
+        pending = 0
+        idx = len(self.trail) - 1
+        clause, p = conflict, None
+        while True:
+            for q in (clause if p is None else clause[1:]):
+                var = abs(q)
+                if var in seen or not level[var]:
+                    continue
+                seen.add(var)
+                if level[var] >= current:
+                    pending += 1
+                else:
+                    learnt.append(q)
+            while abs(self.trail[idx]) not in seen:
+                idx -= 1
+            p = self.trail[idx]
+            idx -= 1
+            pending -= 1
+            if not pending:
+                break
+            clause = self._reason[abs(p)]
+        learnt[0] = -p
+        if len(learnt) == 1:
+            return learnt, 0
+        # watch the literal from the highest remaining level second.
+        best = max(xrange(1, len(learnt)), key=lambda i: level[abs(learnt[i])])
+        learnt[1], learnt[best] = learnt[best], learnt[1]
+        return learnt, level[abs(learnt[1])]
+
+    def _backtrack(self, to_level):
+        if len(self._trail_lim) <= to_level:
+            return
+        pos = self._trail_lim[to_level]
+        for lit in self.trail[pos:]:
+            var = abs(lit)
+            del self.values[var]
+            del self._reason[var]
+            del self._level[var]
+        del self.trail[pos:]
+        del self._trail_lim[to_level:]
+        self._qhead = pos
+
+    def solve(self, decide):
+        """Search for a satisfying assignment.
+
+        :param decide: callable taking the solver, returning the literal to
+            assign next or None once the caller is satisfied with the
+            assignment (unassigned variables are left out of the model)
+        :return: dict of variable to bool, or None if unsatisfiable
+        """
+        self.values = {}
+        self._level = {}
+        self._reason = {}
+        self.trail = []
+        self._trail_lim = []
+        self._qhead = 0
+        if self.unsat:
+            return None
+        for lit in self.units:
+            val = self.value(lit)
+            if val is False:
+                return None
+            elif val is None:
+                self._enqueue(lit, None)
+        while True:
+            conflict = self._propagate()
+            if conflict is not None:
+                self.conflicts += 1
+                if not self._trail_lim:
+                    return None
+                learnt, level = self._analyze(conflict)
+                self._backtrack(level)
+                if len(learnt) == 1:
+                    self.units.append(learnt[0])
+                    self._enqueue(learnt[0], None)
+                else:
+                    self._watch(learnt)
+                    self._enqueue(learnt[0], learnt)
+                continue
+            lit = decide(self)
+            if lit is None:
+                return dict(self.values)
+            self.decisions += 1
+            self._trail_lim.append(len(self.trail))
+            self._enqueue(lit, None)
+
+
+class _Problem(object):
+
+    """encoding of a resolution request as clauses"""
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.solver = None
+        self.pkgs = {}
+        self.var_pkgs = [None]
+        self.choices = {}
+        self.matches = {}
+        # vars that are in the plan or installed, and must stay unless
+        # replaced.
+        self.fixed = set()
+        self.kept = set()
+        # clauses are recorded first and loaded into a solver per solve.
+        self.clauses = []
+        # (trigger var or None, candidate literals) in discovery order.
+        self.requirements = []
+        self.deps = {}
+        self.blockers = []
+        self._queue = deque()
+
+    def var(self, pkg, atom=None):
+        key = (pkg.cpvstr, pkg.repo)
+        var = self.pkgs.get(key)
+        if var is None:
+            var = self.pkgs[key] = len(self.var_pkgs)
+            self.var_pkgs.append(pkg)
+            if pkg in self.resolver.state.state:
+                if pkg.repo.livefs:
+                    self.kept.add(var)
+                else:
+                    self.fixed.add(var)
+            else:
+                self.choices[var] = choice_point(atom, [pkg])
+                self._queue.append(var)
+        return var
+
+    def atom_vars(self, atom):
+        l = self.matches.get(atom)
+        if l is None:
+            resolver = self.resolver
+            l = [self.var(pkg, atom) for pkg in resolver.state.match_atom(atom)]
+            if atom not in resolver.insoluble:
+                l.extend(self.var(pkg, atom)
+                         for pkg in resolver.default_dbs.itermatch(atom))
+            l = self.matches[atom] = list(_unique(l))
+        return l
+
+    def build(self, restricts):
+        for restrict in restricts:
+            self.requirements.append((None, self.atom_vars(restrict)))
+        self._expand()
+        self._add_blockers()
+        self._add_slotting()
+
+    def _expand(self):
+        resolver = self.resolver
+        queue = self._queue
+        while queue:
+            var = queue.popleft()
+            choices = self.choices[var]
+            pkg = choices.current_pkg
+            attrs = ['rdepends', 'post_rdepends']
+            if not pkg.built or resolver.process_built_depends:
+                attrs.insert(0, 'depends')
+            deps = self.deps[var] = []
+            for attr in attrs:
+                for or_block in resolver.depset_reorder(
+                        getattr(choices, attr), attr):
+                    lits = []
+                    nodes = []
+                    for node in or_block:
+                        if node.blocks:
+                            aux = self.new_aux()
+                            self.blockers.append((var, aux, node))
+                            lits.append(aux)
+                            nodes.append((node, aux))
+                        else:
+                            l = self.atom_vars(node)
+                            lits.extend(l)
+                            nodes.append((node, l))
+                    deps.append((attr, nodes))
+                    self.clauses.append([-var] + lits)
+                    self.requirements.append((var, lits))
+
+    def new_aux(self):
+        self.var_pkgs.append(None)
+        return len(self.var_pkgs) - 1
+
+    def _add_blockers(self):
+        resolver = self.resolver
+        by_key = {}
+        for var, pkg in enumerate(self.var_pkgs):
+            if pkg is not None:
+                by_key.setdefault(pkg.key, []).append(var)
+        for var, aux, blocker in self.blockers:
+            restrict = resolver.generate_mangled_blocker(
+                self.choices[var], blocker)
+            # installed pkgs that aren't in the plan yet can be blocked too.
+            for pkg in resolver.livefs_dbs.itermatch(blocker):
+                new = (pkg.cpvstr, pkg.repo) not in self.pkgs
+                v = self.var(pkg, blocker)
+                if new:
+                    by_key.setdefault(pkg.key, []).append(v)
+                if v not in self.fixed:
+                    self.kept.add(v)
+            for v in by_key.get(blocker.key, ()):
+                if v != var and restrict.match(self.var_pkgs[v]):
+                    self.clauses.append([-aux, -v])
+        # installed pkgs pulled in by blockers stay as they are; their deps
+        # aren't part of the request.
+        while self._queue:
+            self.deps[self._queue.popleft()] = []
+        # candidates blocked by blockers already in the plan.
+        state = resolver.state.state
+        for var in self.choices:
+            if state.check_limiters(self.var_pkgs[var]):
+                self.clauses.append([-var])
+
+    def _add_slotting(self):
+        slots = {}
+        for var, pkg in enumerate(self.var_pkgs):
+            if pkg is not None:
+                slots.setdefault((pkg.key, pkg.slot), []).append(var)
+        for l in slots.itervalues():
+            for i, a in enumerate(l):
+                for b in l[i + 1:]:
+                    self.clauses.append([-a, -b])
+                if a in self.fixed:
+                    self.clauses.append([a])
+                elif a in self.kept:
+                    self.clauses.append([a] + [x for x in l if x != a])
+
+    def solve(self, nrequired=None):
+        """Solve for the first nrequired targets (all by default).
+
+        :return: the model, or None if unsatisfiable
+        """
+        solver = self.solver = Solver()
+        solver.nvars = len(self.var_pkgs) - 1
+        for clause in self.clauses:
+            solver.add_clause(clause)
+        targets = [lits for trigger, lits in self.requirements
+                   if trigger is None]
+        if nrequired is not None:
+            targets = targets[:nrequired]
+        for lits in targets:
+            solver.add_clause(lits)
+        return solver.solve(_Decider(self).decide)
+
+
+class _Decider(object):
+
+    """decision heuristic: satisfy requirements in discovery order, picking
+    the first (strategy preferred) candidate; then keep what's installed and
+    leave everything else out"""
+
+    def __init__(self, problem):
+        self.requirements = problem.requirements
+        self.targets = []
+        self.triggered = {}
+        for idx, (trigger, lits) in enumerate(self.requirements):
+            if trigger is None:
+                self.targets.append(idx)
+            else:
+                self.triggered.setdefault(trigger, []).append(idx)
+        self.keep = problem.fixed | problem.kept
+        self.nvars = len(problem.var_pkgs) - 1
+        self._conflicts = None
+
+    def _reset(self, solver):
+        self._conflicts = solver.conflicts
+        self._agenda = list(self.targets)
+        self._seen = 0
+        self._var = 1
+
+    def decide(self, solver):
+        if solver.conflicts != self._conflicts:
+            # backjumped; requirements may be unsatisfied again.
+            self._reset(solver)
+        agenda = self._agenda
+        trail = solver.trail
+        for lit in trail[self._seen:]:
+            if lit > 0:
+                for idx in self.triggered.get(lit, ()):
+                    heappush(agenda, idx)
+        self._seen = len(trail)
+        value = solver.value
+        while agenda:
+            unassigned = None
+            for lit in self.requirements[agenda[0]][1]:
+                val = value(lit)
+                if val:
+                    break
+                elif val is None and unassigned is None:
+                    unassigned = lit
+            else:
+                if unassigned is not None:
+                    return unassigned
+            heappop(agenda)
+        while self._var <= self.nvars:
+            var = self._var
+            self._var += 1
+            if value(var) is None:
+                if var in self.keep:
+                    return var
+                return -var
+        return None
+
+
+def _unique(iterable):
+    seen = set()
+    for x in iterable:
+        if x not in seen:
+            seen.add(x)
+            yield x
+
+
+class sat_merge_plan(plan.merge_plan):
+
+    """
+    merge_plan variant resolving each request as a whole via a SAT solver
+
+    :ivar solver_stats: dict of statistics from the last solve (variables,
+        clauses, decisions, conflicts, propagations), None prior to solving
+    """
+
+    solver_stats = None
+
+    def _load_vdb_state(self):
+        atoms = [pkg.versioned_atom for pkg in self.livefs_dbs]
+        ret = self.add_atoms(atoms)
+        if ret:
+            raise Exception("couldn't load vdb state, %s" % (ret[0][0],))
+
+    def add_atoms(self, restricts, finalize=False):
+        if restricts:
+            for restrict in restricts:
+                plan.state.add_hardref_op(restrict).apply(self.state)
+            problem = _Problem(self)
+            problem.build(restricts)
+            model = problem.solve()
+            self._record_stats(problem)
+            if model is None:
+                atom = self._unsatisfiable_target(problem, restricts)
+                return self._failure(atom, "no solution satisfies %s" % (atom,))
+            ret = self._apply(problem, model, restricts)
+            if ret:
+                return ret
+        if finalize:
+            self.process_finalize()
+        return ()
+
+    def _record_stats(self, problem):
+        solver = problem.solver
+        self.solver_stats = {
+            'variables': solver.nvars,
+            'clauses': len(solver.clauses) + len(solver.units),
+            'decisions': solver.decisions,
+            'conflicts': solver.conflicts,
+            'propagations': solver.propagations,
+        }
+        if self.stats is not None:
+            for key, val in self.solver_stats.iteritems():
+                key = 'sat %s' % (key,)
+                self.stats.extra[key] = self.stats.extra.get(key, 0) + val
+        self._dprint("sat: %s", (", ".join(
+            "%s %i" % x for x in sorted(self.solver_stats.iteritems())),))
+
+    @staticmethod
+    def _unsatisfiable_target(problem, restricts):
+        """Return the first target that makes the problem unsatisfiable."""
+        low, high = 1, len(restricts)
+        while low < high:
+            mid = (low + high) // 2
+            if problem.solve(mid) is None:
+                high = mid
+            else:
+                low = mid + 1
+        return restricts[low - 1]
+
+    def _failure(self, atom, msg):
+        # mimic merge_plan's failure frames so the usual reporting works.
+        stack = plan.resolver_stack()
+        frame = stack.add_frame(
+            'none', atom, choice_point(atom, []), self.default_dbs,
+            self.state.current_state, False)
+        self.notify_viable(stack, atom, False, msg)
+        stack.pop_frame(False)
+        return [atom], frame
+
+    def _apply(self, problem, model, restricts):
+        """Replay a solution into the plan state."""
+        start = self.state.current_state
+        chosen = set(var for var in problem.choices if model.get(var))
+        emitted = set()
+        blockers = []
+
+        def provider(lits):
+            for lit in lits:
+                if model.get(lit):
+                    return lit
+            return None
+
+        def visit(var, atom):
+            if var not in chosen or var in emitted:
+                return None
+            emitted.add(var)
+            choices = problem.choices[var]
+            post = []
+            for attr, nodes in problem.deps[var]:
+                for node, lits in nodes:
+                    if node.blocks:
+                        if model.get(lits):
+                            blockers.append((choices, node))
+                            break
+                        continue
+                    v = provider(lits)
+                    if v is not None:
+                        if attr == 'post_rdepends':
+                            post.append((v, node))
+                        else:
+                            ret = visit(v, node)
+                            if ret:
+                                return ret
+                        break
+            ret = self.insert_choice(atom, None, choices)
+            if ret:
+                return ret
+            for v, node in post:
+                ret = visit(v, node)
+                if ret:
+                    return ret
+            return None
+
+        for restrict in restricts:
+            v = provider(problem.matches[restrict])
+            if v is not None:
+                ret = visit(v, restrict)
+                if ret:
+                    self.state.backtrack(start)
+                    return self._failure(restrict, "failed inserting: %s" % (
+                        ", ".join(map(str, ret)),))
+        for choices, blocker in blockers:
+            if not choices.current_pkg.repo.livefs:
+                self._ensure_livefs_is_loaded(blocker)
+            l = self.state.add_blocker(
+                choices, self.generate_mangled_blocker(choices, blocker),
+                key=blocker.key)
+            if l:
+                self.state.backtrack(start)
+                return self._failure(choices.atom, "blocker %s hit %s" % (
+                    blocker, ", ".join(map(str, l))))
+        return None
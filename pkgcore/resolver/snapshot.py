@@ -0,0 +1,299 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+persistent snapshots of a resolver's preloaded vdb state
+
+:obj:`pkgcore.resolver.plan.merge_plan.load_vdb_state` resolves every
+installed package before the requested targets are looked at, which on
+hosts with thousands of installed packages dominates resolver startup.
+:obj:`StateSnapshot` records the resulting plan (the applied ops, the choice
+points and blockers they reference) and replays it directly into a fresh
+resolver, skipping the resolution.  The atoms found insoluble aren't
+recorded: the key of a source repo doesn't change when packages are added
+to it, so they may have become soluble since.
+
+A snapshot is only used if its key matches: a digest of the configuration
+signature (see :obj:`pkgcore.repository.match_cache.domain_signature`), the
+resolver class and strategies, and the state of each repository- the
+mtimes of the base and category directories for livefs repos, the repo
+wide stamp of :obj:`pkgcore.repository.match_cache.repo_stamp` for the
+rest.  Replaying fails over to a full load if anything referenced can't be
+found anymore.
+"""
+
+__all__ = ("StateSnapshot",)
+
+import errno
+import hashlib
+import json
+import os
+
+from snakeoil.demandload import demandload
+from snakeoil.osutils import listdir_dirs, pjoin
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.repository.match_cache import repo_stamp
+from pkgcore.resolver import state
+from pkgcore.resolver.choice_point import choice_point
+from pkgcore.restrictions import packages
+
+demandload(
+    'snakeoil.fileutils:AtomicWriteFile',
+    'pkgcore.log:logger',
+)
+
+
+def _vdb_stamp(location):
+    try:
+        paths = [location] + [
+            pjoin(location, x) for x in sorted(listdir_dirs(location))]
+        return ','.join(repr(os.stat(x).st_mtime) for x in paths)
+    except EnvironmentError:
+        return None
+
+
+def _find_pkg(db, cpv):
+    for pkg in db.itermatch(atom('=%s' % (cpv,))):
+        if pkg.cpvstr == cpv:
+            return pkg
+    return None
+
+
+def _name(obj):
+    return getattr(obj, '__name__', obj.__class__.__name__)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _PlanRecord(object):
+
+    """
+    on disk record of the ops of a resolver's plan
+
+    Only plans solely referencing atoms (rather than arbitrary
+    restrictions) are recorded.  Subclasses define :obj:`magic` and
+    :obj:`key`, identifying the setup a record is valid for.
+    """
+
+    magic = None
+    description = None
+
+    def __init__(self, path, signature=''):
+        """
+        :param path: location of the record
+        :param signature: configuration signature the plan depends on,
+            usually from :obj:`pkgcore.repository.match_cache.domain_signature`
+        """
+        self.path = path
+        self.signature = signature
+
+    def key(self, resolver):
+        """Return the key identifying the setup a plan was resolved with,
+        or None if it can't be recorded."""
+        raise NotImplementedError(self, 'key')
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                if f.readline().rstrip('\n') != self.magic:
+                    return None
+                return json.load(f)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning(
+                    "failed reading %s %s: %s", self.description, self.path, e)
+        except ValueError as e:
+            logger.warning(
+                "corrupt %s %s: %s", self.description, self.path, e)
+        return None
+
+    def _apply(self, resolver, op, choices, pkgs):
+        """Apply a serialized op to a resolver's plan."""
+        plan = resolver.state
+        kind = op[0]
+        if kind == 'hardref':
+            state.add_hardref_op(atom(op[1])).apply(plan)
+        elif kind in ('incref', 'decref'):
+            c = choices[op[1]]
+            blocker = atom(op[2])
+            if op[4]:
+                blocker = resolver.generate_mangled_blocker(c, blocker)
+            if kind == 'incref':
+                state.incref_forward_block_op(c, blocker, op[3]).apply(plan)
+            else:
+                state.decref_forward_block_op(c, blocker, op[3]).apply(plan)
+        else:
+            kls = self._pkg_ops[kind]
+            if kls(choices[op[1]], pkgs[op[2]], force=op[3]).apply(plan):
+                raise _Unsupported("conflict replaying %s" % (kind,))
+
+    _pkg_ops = {
+        'add': state.add_op,
+        'backref': state.add_backref_op,
+        'remove': state.remove_op,
+        'replace': state.replace_op,
+    }
+    _pkg_op_names = dict((v, k) for k, v in _pkg_ops.iteritems())
+
+    def save(self, resolver, start=0):
+        """Record a resolver's plan state.
+
+        :param start: position in the plan to record the ops from
+        :return: True if the snapshot was written
+        """
+        key = self.key(resolver)
+        if key is None:
+            return False
+        try:
+            data = self._serialize(resolver, start)
+        except _Unsupported as e:
+            logger.debug("not recording %s: %s", self.description, e)
+            return False
+        data['key'] = key
+        try:
+            f = AtomicWriteFile(self.path)
+            try:
+                f.write(self.magic + '\n')
+                json.dump(data, f)
+                f.close()
+            except:
+                f.discard()
+                raise
+        except EnvironmentError as e:
+            logger.warning(
+                "failed writing %s %s: %s", self.description, self.path, e)
+            return False
+        return True
+
+    def _serialize(self, resolver, start=0):
+        pkgs, pkg_ids = [], {}
+        choices, choice_ids = [], {}
+        repo_ids = [db.repo_id for db in resolver.all_raw_dbs]
+        if len(set(repo_ids)) != len(repo_ids):
+            raise _Unsupported("repo ids aren't unique")
+
+        def atom_str(restrict):
+            if not isinstance(restrict, atom):
+                raise _Unsupported("non atom restriction %s" % (restrict,))
+            return str(restrict)
+
+        def pkg_id(pkg):
+            ref = (pkg.repo.repo_id, pkg.cpvstr)
+            if ref[0] not in repo_ids:
+                raise _Unsupported("unknown repo for %s" % (pkg,))
+            idx = pkg_ids.get(ref)
+            if idx is None:
+                idx = pkg_ids[ref] = len(pkgs)
+                pkgs.append(ref)
+            return idx
+
+        def choice_id(c):
+            idx = choice_ids.get(id(c))
+            if idx is None:
+                idx = choice_ids[id(c)] = len(choices)
+                choices.append((atom_str(c.atom), pkg_id(c.current_pkg)))
+            return idx
+
+        ops = []
+        for op in resolver.state.plan[start:]:
+            if isinstance(op, state.add_hardref_op):
+                ops.append(('hardref', atom_str(op.restriction)))
+            elif isinstance(op, state.blocker_base_op):
+                blocker, mangled = op.blocker, False
+                if not isinstance(blocker, atom) and \
+                        isinstance(blocker, packages.AndRestriction):
+                    # see merge_plan.generate_mangled_blocker
+                    blocker, mangled = blocker.restrictions[0], True
+                ops.append((
+                    'incref' if isinstance(op, state.incref_forward_block_op)
+                    else 'decref',
+                    choice_id(op.choices), atom_str(blocker), op.key, mangled))
+            else:
+                kind = self._pkg_op_names.get(op.__class__)
+                if kind is None:
+                    raise _Unsupported("unknown op %r" % (op,))
+                ops.append((kind, choice_id(op.choices), pkg_id(op.pkg),
+                            op.force))
+        return {
+            'pkgs': pkgs,
+            'choices': choices,
+            'ops': ops,
+        }
+
+
+class StateSnapshot(_PlanRecord):
+
+    """
+    on disk snapshot of the plan state built by loading the vdb
+
+    Only plans solely referencing atoms (rather than arbitrary
+    restrictions) are recorded.
+    """
+
+    magic = 'pkgcore-vdb-state-1'
+    description = 'vdb state snapshot'
+
+    def key(self, resolver):
+        """Return the key identifying a resolver's vdb state, or None if it
+        can't be snapshotted (some repo has no on disk location)."""
+        chksum = hashlib.md5()
+        cls = resolver.__class__
+        chksum.update('%s %s.%s %s %s %s %s %s\n' % (
+            self.signature, cls.__module__, cls.__name__,
+            _name(resolver.per_repo_strategy),
+            _name(resolver.total_ordering_strategy),
+            _name(resolver.depset_reorder),
+            resolver.process_built_depends, resolver.drop_cycles))
+        for db in resolver.all_raw_dbs:
+            location = getattr(db, 'location', None)
+            if not isinstance(location, basestring):
+                return None
+            if db.livefs:
+                stamp = _vdb_stamp(location)
+            else:
+                stamp = repo_stamp(location)
+            if stamp is None:
+                return None
+            chksum.update('%s %s %s %s\n' % (
+                db.repo_id, _name(db.__db__.__class__), location, stamp))
+        return chksum.hexdigest()
+
+    def restore(self, resolver):
+        """Replay the snapshot into a resolver with an empty plan.
+
+        :return: True if the state was restored, False if the snapshot is
+            missing, stale, or couldn't be applied (the plan is left
+            untouched)
+        """
+        if resolver.state.current_state:
+            return False
+        data = self._read()
+        if data is None:
+            return False
+        key = self.key(resolver)
+        if key is None or data.get('key') != key:
+            return False
+        try:
+            self._replay(resolver, data)
+        except (_Unsupported, LookupError, TypeError, ValueError) as e:
+            logger.warning(
+                "failed restoring %s %s: %s", self.description, self.path, e)
+            resolver.reset()
+            return False
+        return True
+
+    def _replay(self, resolver, data):
+        dbs = dict((db.repo_id, db) for db in resolver.all_raw_dbs)
+        pkgs = []
+        for repo_id, cpv in data['pkgs']:
+            pkg = _find_pkg(dbs[repo_id], cpv)
+            if pkg is None:
+                raise _Unsupported("%s::%s no longer exists" % (cpv, repo_id))
+            pkgs.append(pkg)
+        choices = [choice_point(atom(a), [pkgs[idx]])
+                   for a, idx in data['choices']]
+        for op in data['ops']:
+            self._apply(resolver, op, choices, pkgs)
@@ -54,5 +54,8 @@ def main(options, out, err):
                 out.write("deleting %s" % (x,))
             del target[x]
 
+    if not target.autocommits:
+        target.commit(force=True)
+
     if options.verbose:
         out.write("took %i seconds" % int(time.time() - start))
@@ -21,6 +21,7 @@ demandload(
     'operator:attrgetter,itemgetter',
     'snakeoil.lists:iflatten_instance,unstable_unique',
     'pkgcore:fetch',
+    'pkgcore.operations:regen',
     'pkgcore.package:errors',
     'pkgcore.restrictions:packages',
 )
@@ -229,7 +230,26 @@ class eclass_usage_kls(histo_data):
 
     summary_format = "eclass: %(key)r %(val)s pkgs found, %(percent)s of all repositories"
 
+    @staticmethod
+    def _load_index(repo):
+        """Return the repo's eclass usage index, or None if it's missing or
+        out of date with the tree."""
+        path = regen.eclass_usage_path(repo)
+        if path is None or getattr(repo, 'eclass_cache', None) is None:
+            return None
+        try:
+            state = regen.RegenState(regen.regen_state_path(repo), path)
+        except EnvironmentError:
+            return None
+        if not state.current(repo):
+            return None
+        return state.usage
+
     def get_data(self, repo, options):
+        if not options.no_index:
+            index = self._load_index(repo)
+            if index is not None:
+                return {k: len(v) for k, v in index.iteritems()}, len(index.cpvs)
         pos, data = 0, defaultdict(lambda:0)
         for pos, pkg in enumerate(repo):
             for eclass in getattr(pkg, 'inherited', ()):
@@ -238,6 +258,13 @@ class eclass_usage_kls(histo_data):
 
 eclass_usage = subparsers.add_parser(
     "eclass_usage", description="report of eclass usage for targeted repositories")
+eclass_usage.add_argument(
+    "--no-index", action='store_true', default=False,
+    help="""
+        scan every package instead of using the eclass usage index
+        maintained by 'pmaint regen --incremental'; the index is only used
+        if the tree hasn't changed since it was last updated
+    """)
 eclass_usage.bind_class(eclass_usage_kls())
 
 
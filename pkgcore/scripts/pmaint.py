@@ -32,6 +32,7 @@ demandload(
     'pkgcore.operations:observer',
     'pkgcore.package:mutated',
     'pkgcore.repository:multiplex',
+    'pkgcore.util.repo_utils:get_raw_repos',
 )
 
 
@@ -254,6 +255,23 @@ regen_opts.add_argument(
     default=commandline.DelayedValue(_get_default_jobs, 100),
     help="number of threads to use for regeneration. Defaults to using all "
     "available processors")
+regen_opts.add_argument(
+    "-P", "--processes", action='store_true', default=False,
+    help="""
+        Use worker processes instead of threads for regeneration; the
+        --threads value sets the number of processes. Each worker owns its
+        ebuild processors and writes cache entries directly, avoiding
+        contention on the interpreter lock. Requires a cache backend that
+        supports concurrent writers, otherwise threads are used.
+    """)
+regen_opts.add_argument(
+    "-i", "--incremental", action='store_true', default=False,
+    help="""
+        Only revalidate packages whose ebuild or inherited eclasses changed
+        since the last incremental regen. The ebuild and eclass state is
+        recorded next to the repo's writable cache; if no state exists yet
+        every package is checked and the state is created.
+    """)
 regen_opts.add_argument(
     "--force", action='store_true', default=False,
     help="force regeneration to occur regardless of staleness checks")
@@ -277,10 +295,16 @@ def regen_main(options, out, err):
             continue
 
         start_time = time.time()
-        repo.operations.regen_cache(
-            threads=options.threads,
-            observer=observer.formatter_output(out), force=options.force,
-            eclass_caching=(not options.disable_eclass_caching))
+        try:
+            repo.operations.regen_cache(
+                threads=options.threads,
+                observer=observer.formatter_output(out), force=options.force,
+                eclass_caching=(not options.disable_eclass_caching),
+                processes=options.processes, incremental=options.incremental)
+        except OperationError as e:
+            err.write("failed regenerating %s: %s" % (repo, e.__cause__ or e))
+            ret.append(1)
+            continue
         end_time = time.time()
 
         if options.verbose:
@@ -333,7 +357,22 @@ def perl_rebuild_main(options, out, err):
         "/usr/lib(?:64|32)?/perl5/(?:%s|vendor_perl/%s)" %
         (subpattern, subpattern)).match
 
-    for pkg in options.domain.all_livefs_repos:
+    repos = options.domain.all_livefs_repos
+    owners = set()
+    for repo in get_raw_repos(repos):
+        index = getattr(repo, 'owners_index', None)
+        if index is None:
+            break
+        for path, rels in index.iter_owners(matcher, '/usr/lib'):
+            owners.update(rels)
+    else:
+        # every vdb is indexed; the owning packages are known already.
+        for pkg in repos:
+            if pkg.cpvstr in owners:
+                out.write("%s" % (pkg.unversioned_atom,))
+        return 0
+
+    for pkg in repos:
         contents = getattr(pkg, 'contents', ())
         if not contents:
             continue
@@ -14,20 +14,27 @@ __all__ = ("argparser", "AmbiguousQuery", "NoMatches")
 
 import argparse
 from functools import partial
+import json
+import os
 import sys
 from time import time
 
 from pkgcore.ebuild import resolver, restricts
 from pkgcore.ebuild.atom import atom
+from pkgcore.fetch import prefetch
 from pkgcore.merge import errors as merge_errors
-from pkgcore.operations import observer, format
+from pkgcore.operations import observer, format, scheduler
+from pkgcore.repository import match_cache
+from pkgcore.resolver import plan_cache, sat, snapshot
 from pkgcore.resolver.util import reduce_to_failures
 from pkgcore.restrictions import packages
 from pkgcore.restrictions.boolean import OrRestriction
 from pkgcore.util import commandline, parserestrict, repo_utils
 
 from snakeoil.compatibility import IGNORED_EXCEPTIONS
+from snakeoil.formatters import PlainTextFormatter
 from snakeoil.lists import stable_unique
+from snakeoil.osutils import ensure_dirs, pjoin
 
 
 class StoreTarget(argparse._AppendAction):
@@ -113,6 +120,37 @@ merge_mode.add_argument(
 merge_mode.add_argument(
     '-f', '--fetchonly', action='store_true',
     help="do only the fetch steps of the resolved plan")
+merge_mode.add_argument(
+    '-j', '--jobs', type=int, default=1, metavar='N',
+    help="run up to N builds concurrently",
+    docs="""
+        Builds whose dependencies are merged run in parallel, up to N at a
+        time; merging to the livefs still happens one package at a time.
+        The output of each build goes to its own log file (see
+        --job-logdir) while an aggregated progress display is shown.
+    """)
+merge_mode.add_argument(
+    '--load-average', type=float, metavar='LOAD',
+    help="don't start further concurrent builds while the system load "
+         "average is at least LOAD")
+merge_mode.add_argument(
+    '--job-logdir', metavar='DIR',
+    help="directory for the per build logs of --jobs; defaults to "
+         "PORT_LOGDIR if set, else a pmerge-jobs directory in the build "
+         "tempspace")
+merge_mode.add_argument(
+    '--prefetch', type=int, default=0, metavar='N',
+    help="fetch the files of the whole plan in the background, "
+         "N at a time",
+    docs="""
+        Once the plan is accepted, start fetching (and verifying) the files
+        of every package in it with N concurrent downloads; each build then
+        only waits for its own files.
+    """)
+merge_mode.add_argument(
+    '--prefetch-per-host', type=int, default=2, metavar='N',
+    help="maximum number of concurrent background fetches from one host "
+         "(default: %(default)s)")
 merge_mode.add_argument(
     '-1', '--oneshot', action='store_true',
     help="do not record changes in the world file; if a set is "
@@ -135,6 +173,56 @@ resolution_options.add_argument(
         already installed dependencies that aren't involved in the graph of
         the requested operation.
     """)
+resolution_options.add_argument(
+    '--sat-resolver', action='store_true',
+    help="resolve each request as a whole with the SAT based resolver",
+    docs="""
+        Instead of the default depth first search, encode the candidate
+        packages and their dependencies as a satisfiability problem and
+        solve it globally.  This finds solutions the default resolver can
+        miss due to early choices, at the cost of examining every candidate
+        reachable from the targets up front.
+    """)
+resolution_options.add_argument(
+    '--resolver-stats', action='store_true',
+    help="report resolver statistics once resolution finishes",
+    docs="""
+        Collect per atom timings, repository query counts, cache hits and
+        backtracking statistics while resolving and print a summary of them.
+    """)
+resolution_options.add_argument(
+    '--resolver-stats-file', metavar='FILE',
+    help="write resolver statistics to FILE as JSON")
+resolution_options.add_argument(
+    '--match-cache', metavar='FILE',
+    help="reuse repository query results across runs via FILE",
+    docs="""
+        Record which versions matched each atom the resolver looked up, and
+        reuse those results on later runs as long as the configuration and
+        the relevant repository directories are unchanged.  Repeated
+        --pretend/--ask runs then skip most repository queries.
+    """)
+resolution_options.add_argument(
+    '--vdb-state-cache', metavar='FILE',
+    help="reuse the preloaded vdb state across runs via FILE; "
+         "implies --preload-vdb-state",
+    docs="""
+        Record the resolver state built by preloading the installed
+        packages database, and restore it directly on later runs as long as
+        the installed packages, the repositories and the configuration are
+        unchanged.
+    """)
+resolution_options.add_argument(
+    '--plan-cache', metavar='FILE',
+    help="reuse the unaffected parts of the last resolved plan via FILE",
+    docs="""
+        Record the plan of each successful resolution, and on later runs
+        only resolve again the packages affected by changes since: new or
+        modified ebuilds, changed USE flags, or installed packages added or
+        removed, along with everything depending on them.  The rest of the
+        plan is reused as is.  Changes to the profiles, eclasses or other
+        configuration discard the recorded plan.
+    """)
 resolution_options.add_argument(
     '-i', '--ignore-cycles', action='store_true',
     help="Ignore cycles if they're found to be unbreakable; "
@@ -310,6 +398,176 @@ def display_failures(out, sequence, first_level=True, debug=False):
             out.first_prefix.pop()
 
 
+def build_op(options, out, domain, op, build_obs, cleanup, logfile=None):
+    """Fetch and build the package of a plan op.
+
+    :param cleanup: list to append the callables releasing the build's
+        resources to
+    :param logfile: if given, file to send the build's output to unless
+        PORT_LOGDIR already directs it somewhere
+    :return: the package to merge, True if only fetching was requested, or
+        False on failure (reported to out)
+    """
+    cleanup.append(op.pkg.release_cached_data)
+
+    if not options.fetchonly and options.debug:
+        out.write("Forcing a clean of workdir")
+
+    pkg_ops = domain.pkg_operations(op.pkg, observer=build_obs)
+    out.write("\n%i files required-" % len(op.pkg.fetchables))
+    try:
+        ret = pkg_ops.run_if_supported("fetch", or_return=True)
+    except IGNORED_EXCEPTIONS:
+        raise
+    except Exception as e:
+        ret = e
+    if ret is not True:
+        if ret is False:
+            ret = None
+        commandline.dump_error(out, ret, "\nfetching failed for %s" % (op.pkg.cpvstr,))
+        return False
+    if options.fetchonly:
+        return True
+
+    buildop = pkg_ops.run_if_supported("build", or_return=None)
+    pkg = op.pkg
+    if buildop is not None:
+        if logfile is not None and getattr(buildop, 'logging', None) is False:
+            buildop.logging = logfile
+        out.write("building %s" % (op.pkg.cpvstr,))
+        result = False
+        try:
+            result = buildop.finalize()
+        except format.errors as e:
+            out.error("caught exception building %s: % s" % (op.pkg.cpvstr, e))
+        else:
+            if result is False:
+                out.error("failed building %s" % (op.pkg.cpvstr,))
+        if result is False:
+            return False
+        pkg = result
+        cleanup.append(pkg.release_cached_data)
+        pkg_ops = domain.pkg_operations(pkg, observer=build_obs)
+        cleanup.append(buildop.cleanup)
+
+    cleanup.append(partial(pkg_ops.run_if_supported, "cleanup"))
+    return pkg_ops.run_if_supported("localize", or_return=pkg)
+
+
+def merge_op(out, domain, op, pkg, repo_obs, cleanup):
+    """Merge the package of a plan op to the livefs, or unmerge it.
+
+    :param pkg: the built package to merge, unused for removals
+    :return: True on success, False on failure (reported to out)
+    """
+    if op.desc == "remove":
+        out.write(">>> Removing %s" % op.pkg.cpvstr)
+        i = domain.uninstall_pkg(op.pkg, repo_obs)
+    elif op.desc == "replace":
+        if op.old_pkg == pkg:
+            out.write(">>> Reinstalling %s" % (pkg.cpvstr))
+        else:
+            out.write(">>> Replacing %s with %s" % (
+                op.old_pkg.cpvstr, pkg.cpvstr))
+        i = domain.replace_pkg(op.old_pkg, pkg, repo_obs)
+        cleanup.append(op.old_pkg.release_cached_data)
+    else:
+        out.write(">>> Installing %s" % (pkg.cpvstr,))
+        i = domain.install_pkg(pkg, repo_obs)
+    try:
+        i.finish()
+    except merge_errors.BlockModification as e:
+        out.error("Failed to merge %s: %s" % (op.pkg, e))
+        return False
+    return True
+
+
+def run_jobs(options, out, domain, changes, record_world):
+    """Build the ops of a plan concurrently via
+    :obj:`pkgcore.operations.scheduler.Scheduler`.
+
+    :return: True if every op succeeded
+    """
+    logdir = options.job_logdir
+    if logdir is None:
+        logdir = pjoin(
+            domain.settings.get("PORT_LOGDIR") or
+            domain._get_tempspace() or "/var/tmp", "pmerge-jobs")
+    logs = {}
+    cleanups = {}
+    change_count = len(changes)
+
+    def build(job):
+        cleanups[job.index] = cleanup = []
+        if job.op.desc == "remove":
+            return None
+        path = pjoin(logdir, "%s.log" % (job.op.pkg.cpvstr,))
+        if not ensure_dirs(os.path.dirname(path)):
+            raise EnvironmentError(
+                "failed creating %s" % (os.path.dirname(path),))
+        log = PlainTextFormatter(open(path, "a", 1))
+        logs[job.index] = log.stream
+        build_obs = observer.build_observer(
+            observer.formatter_output(log), not options.debug)
+        return build_op(options, log, domain, job.op, build_obs, cleanup,
+                        logfile=path)
+
+    def merge(job):
+        if job.result is True:
+            return True
+        f = logs.get(job.index)
+        if f is None:
+            log = out
+        else:
+            log = PlainTextFormatter(f)
+        repo_obs = observer.repo_observer(
+            observer.formatter_output(log), not options.debug)
+        if not merge_op(log, domain, job.op, job.result, repo_obs,
+                        cleanups[job.index]):
+            return False
+        record_world(job.op)
+        return True
+
+    def notify(sched, job):
+        done = sched.count("merged", "failed", "skipped")
+        if job.state == "failed":
+            status = [out.fg("red"), "failed"]
+            if job.error is not None:
+                status.append(" (%s)" % (job.error,))
+        elif job.state == "skipped":
+            status = [out.fg("yellow"), "skipped, a dependency failed"]
+        elif job.state in ("building", "merged"):
+            status = [job.state]
+        else:
+            return
+        out.write(out.bold, " * ", out.reset,
+                  "[%i/%i, %i running] %s: " % (
+                      done, change_count, sched.running, job.op.pkg.cpvstr),
+                  *(status + [out.reset]))
+        f = logs.get(job.index)
+        if job.state == "failed" and f is not None:
+            out.write("   log: %s" % (f.name,))
+        if job.state in ("merged", "failed", "skipped"):
+            for func in cleanups.pop(job.index, ()):
+                func()
+            if f is not None:
+                f.close()
+                del logs[job.index]
+        out.title("%i/%i merged, %i running" % (
+            sched.count("merged"), change_count, sched.running))
+
+    out.write(out.bold, " * ", out.reset,
+              "running up to %i builds concurrently, logs in %s" % (
+                  options.jobs, logdir))
+    sched = scheduler.Scheduler(
+        changes, build, merge, jobs=options.jobs,
+        load_average=options.load_average, notify=notify)
+    failed = sched.run(keep_going=options.ignore_failures)
+    for f in logs.itervalues():
+        f.close()
+    return not failed
+
+
 def slotatom_if_slotted(repos, checkatom):
     """check repos for more than one slot of given atom"""
 
@@ -371,6 +629,14 @@ def _validate(parser, namespace):
     elif (namespace.usepkgonly or namespace.usepkg) and namespace.source_only:
         parser.error("--source-only cannot be used with --usepkg nor --usepkgonly")
 
+    if namespace.plan_cache and namespace.sat_resolver:
+        parser.error("--plan-cache can't be used with --sat-resolver")
+
+    if namespace.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if namespace.prefetch < 0:
+        parser.error("--prefetch can't be negative")
+
     if namespace.sets:
         unknown_sets = set(namespace.sets).difference(namespace.config.pkgset)
         if unknown_sets:
@@ -541,9 +807,22 @@ def main(options, out, err):
 
     extra_kwargs = {}
     if options.empty:
-        extra_kwargs['resolver_cls'] = resolver.empty_tree_merge_plan
+        if options.sat_resolver:
+            extra_kwargs['resolver_cls'] = resolver.empty_tree_sat_merge_plan
+        else:
+            extra_kwargs['resolver_cls'] = resolver.empty_tree_merge_plan
+    elif options.sat_resolver:
+        extra_kwargs['resolver_cls'] = sat.sat_merge_plan
     if options.debug:
         extra_kwargs['debug'] = True
+    if options.resolver_stats or options.resolver_stats_file:
+        extra_kwargs['stats'] = True
+    signature = None
+    if options.match_cache or options.vdb_state_cache:
+        signature = match_cache.domain_signature(domain)
+    if options.match_cache:
+        extra_kwargs['match_cache'] = match_cache.MatchCache(
+            options.match_cache, signature)
 
     # XXX: This should recurse on deep
     if options.newuse:
@@ -572,10 +851,14 @@ def main(options, out, err):
         drop_cycles=options.ignore_cycles, force_replace=options.replace,
         process_built_depends=options.with_bdeps, **extra_kwargs)
 
-    if options.preload_vdb_state:
+    if options.preload_vdb_state or options.vdb_state_cache:
         out.write(out.bold, ' * ', out.reset, 'Preloading vdb... ')
         vdb_time = time()
-        resolver_inst.load_vdb_state()
+        vdb_snapshot = None
+        if options.vdb_state_cache:
+            vdb_snapshot = snapshot.StateSnapshot(
+                options.vdb_state_cache, signature)
+        resolver_inst.load_vdb_state(snapshot=vdb_snapshot)
         vdb_time = time() - vdb_time
     else:
         vdb_time = 0.0
@@ -585,7 +868,16 @@ def main(options, out, err):
     if sys.stdout.isatty():
         out.title('Resolving...')
         out.write(out.bold, ' * ', out.reset, 'Resolving...')
-    ret = resolver_inst.add_atoms(atoms, finalize=True)
+    if options.plan_cache:
+        # USE changes are checked per package.
+        cache = plan_cache.PlanCache(
+            options.plan_cache, match_cache.domain_signature(domain, use=False))
+        ret = cache.add_atoms(resolver_inst, atoms, finalize=True)
+        if cache.reused:
+            out.write(out.bold, ' * ', out.reset,
+                      'reused %i ops from the plan cache' % (cache.reused,))
+    else:
+        ret = resolver_inst.add_atoms(atoms, finalize=True)
     while ret:
         out.error('resolution failed')
         restrict = ret[0][0]
@@ -600,6 +892,20 @@ def main(options, out, err):
         ret = resolver_inst.add_atoms(atoms, finalize=True)
     resolve_time = time() - resolve_time
 
+    if options.resolver_stats:
+        out.write()
+        for line in resolver_inst.stats.summary():
+            out.write(line)
+        out.write()
+    if options.resolver_stats_file:
+        try:
+            with open(options.resolver_stats_file, 'w') as f:
+                json.dump(resolver_inst.stats.to_dict(), f, indent=1,
+                          sort_keys=True)
+        except EnvironmentError as e:
+            err.write("failed writing resolver stats to %r: %s" % (
+                options.resolver_stats_file, e))
+
     if options.debug:
         out.write(out.bold, " * ", out.reset, "resolution took %.2f seconds" % resolve_time)
 
@@ -702,12 +1008,46 @@ def main(options, out, err):
     if (options.ask and not formatter.ask("Would you like to merge these packages?")):
         return
 
+    def record_world(op):
+        if world_set is None:
+            return
+        if op.desc == "remove":
+            out.write('>>> Removing %s from world file' % op.pkg.cpvstr)
+            removal_pkg = slotatom_if_slotted(source_repos.combined, op.pkg.versioned_atom)
+            update_worldset(world_set, removal_pkg, remove=True)
+        elif not options.oneshot and any(x.match(op.pkg) for x in atoms):
+            if not options.upgrade:
+                out.write('>>> Adding %s to world file' % op.pkg.cpvstr)
+                add_pkg = slotatom_if_slotted(source_repos.combined, op.pkg.versioned_atom)
+                update_worldset(world_set, add_pkg)
+
+    prefetcher = None
+    if options.prefetch:
+        # files are only prefetched for packages using the domain's fetcher.
+        prefetcher = prefetch.Prefetcher(
+            domain.fetcher, jobs=options.prefetch,
+            per_host=options.prefetch_per_host)
+        for op in changes:
+            if op.desc != "remove" and \
+                    getattr(op.pkg.repo, 'fetcher', None) is None:
+                prefetcher.submit(op.pkg.fetchables)
+        domain.fetcher = prefetcher
+
     change_count = len(changes)
 
     # left in place for ease of debugging.
     cleanup = []
     try:
-        for count, op in enumerate(changes):
+        serial = changes
+        if options.jobs > 1:
+            # failures are handled per --ignore-failures as in the serial
+            # case; completion is shared with it.
+            if not run_jobs(options, out, domain, changes, record_world) and \
+                    not options.ignore_failures:
+                return 1
+            serial = ()
+
+        for count, op in enumerate(serial):
             for func in cleanup:
                 func()
 
@@ -715,80 +1055,19 @@ def main(options, out, err):
 
             out.write("\nProcessing %i of %i: %s" % (count + 1, change_count, op.pkg.cpvstr))
             out.title("%i/%i: %s" % (count + 1, change_count, op.pkg.cpvstr))
+            pkg = None
             if op.desc != "remove":
-                cleanup = [op.pkg.release_cached_data]
-
-                if not options.fetchonly and options.debug:
-                    out.write("Forcing a clean of workdir")
-
-                pkg_ops = domain.pkg_operations(op.pkg, observer=build_obs)
-                out.write("\n%i files required-" % len(op.pkg.fetchables))
-                try:
-                    ret = pkg_ops.run_if_supported("fetch", or_return=True)
-                except IGNORED_EXCEPTIONS:
-                    raise
-                except Exception as e:
-                    ret = e
-                if ret is not True:
-                    if ret is False:
-                        ret = None
-                    commandline.dump_error(out, ret, "\nfetching failed for %s" % (op.pkg.cpvstr,))
+                pkg = build_op(options, out, domain, op, build_obs, cleanup)
+                if pkg is False:
                     if not options.ignore_failures:
                         return 1
                     continue
-                if options.fetchonly:
+                if pkg is True:
+                    # fetch only.
                     continue
-
-                buildop = pkg_ops.run_if_supported("build", or_return=None)
-                pkg = op.pkg
-                if buildop is not None:
-                    out.write("building %s" % (op.pkg.cpvstr,))
-                    result = False
-                    try:
-                        result = buildop.finalize()
-                    except format.errors as e:
-                        out.error("caught exception building %s: % s" % (op.pkg.cpvstr, e))
-                    else:
-                        if result is False:
-                            out.error("failed building %s" % (op.pkg.cpvstr,))
-                    if result is False:
-                        if not options.ignore_failures:
-                            return 1
-                        continue
-                    pkg = result
-                    cleanup.append(pkg.release_cached_data)
-                    pkg_ops = domain.pkg_operations(pkg, observer=build_obs)
-                    cleanup.append(buildop.cleanup)
-
-                cleanup.append(partial(pkg_ops.run_if_supported, "cleanup"))
-                pkg = pkg_ops.run_if_supported("localize", or_return=pkg)
-                # wipe this to ensure we don't inadvertantly use it further down;
-                # we aren't resetting it after localizing, so could have the wrong
-                # set of ops.
-                del pkg_ops
-
                 out.write()
-                if op.desc == "replace":
-                    if op.old_pkg == pkg:
-                        out.write(">>> Reinstalling %s" % (pkg.cpvstr))
-                    else:
-                        out.write(">>> Replacing %s with %s" % (
-                            op.old_pkg.cpvstr, pkg.cpvstr))
-                    i = domain.replace_pkg(op.old_pkg, pkg, repo_obs)
-                    cleanup.append(op.old_pkg.release_cached_data)
-                else:
-                    out.write(">>> Installing %s" % (pkg.cpvstr,))
-                    i = domain.install_pkg(pkg, repo_obs)
-
-                # force this explicitly- can hold onto a helluva lot more
-                # then we would like.
-            else:
-                out.write(">>> Removing %s" % op.pkg.cpvstr)
-                i = domain.uninstall_pkg(op.pkg, repo_obs)
-            try:
-                ret = i.finish()
-            except merge_errors.BlockModification as e:
-                out.error("Failed to merge %s: %s" % (op.pkg, e))
+
+            if not merge_op(out, domain, op, pkg, repo_obs, cleanup):
                 if not options.ignore_failures:
                     return 1
                 continue
@@ -799,16 +1078,7 @@ def main(options, out, err):
             # mainly to protect against any code following triggering reloads
             # basically, be protective
 
-            if world_set is not None:
-                if op.desc == "remove":
-                    out.write('>>> Removing %s from world file' % op.pkg.cpvstr)
-                    removal_pkg = slotatom_if_slotted(source_repos.combined, op.pkg.versioned_atom)
-                    update_worldset(world_set, removal_pkg, remove=True)
-                elif not options.oneshot and any(x.match(op.pkg) for x in atoms):
-                    if not options.upgrade:
-                        out.write('>>> Adding %s to world file' % op.pkg.cpvstr)
-                        add_pkg = slotatom_if_slotted(source_repos.combined, op.pkg.versioned_atom)
-                        update_worldset(world_set, add_pkg)
+            record_world(op)
 
 
 #    again... left in place for ease of debugging.
@@ -817,7 +1087,9 @@ def main(options, out, err):
 #    else:
 #        import pdb;pdb.set_trace()
     finally:
-        pass
+        if prefetcher is not None:
+            domain.fetcher = prefetcher.fetcher
+            prefetcher.shutdown()
 
     # the final run from the loop above doesn't invoke cleanups;
     # we could ignore it, but better to run it to ensure nothing is
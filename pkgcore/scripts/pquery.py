@@ -9,7 +9,7 @@ from functools import partial
 from snakeoil.demandload import demandload
 from snakeoil.formatters import decorate_forced_wrapping
 
-from pkgcore.ebuild import conditionals, atom
+from pkgcore.ebuild import conditionals, atom, restricts
 from pkgcore.restrictions import packages, values, boolean
 from pkgcore.util import (
     commandline, repo_utils, parserestrict, packages as pkgutils)
@@ -299,8 +299,8 @@ def print_package(options, out, err, pkg):
                         green, '     revdep: ', out.fg(), name, ' on ',
                         str(revdep))
                     continue
-                for key, restricts in depset.find_cond_nodes(depset.restrictions, True):
-                    if not restricts and key.intersects(revdep):
+                for key, conds in depset.find_cond_nodes(depset.restrictions, True):
+                    if not conds and key.intersects(revdep):
                         out.write(
                             green, '     revdep: ', out.fg(), name, ' on ',
                             autoline=False)
@@ -311,7 +311,7 @@ def print_package(options, out, err, pkg):
                             out.write(
                                 str(revdep), ' through dep ', out.bold,
                                 str(key))
-                for key, restricts in depset.node_conds.iteritems():
+                for key, conds in depset.node_conds.iteritems():
                     if key.intersects(revdep):
                         out.write(
                             green, '     revdep: ', out.fg(), name, ' on ',
@@ -325,7 +325,7 @@ def print_package(options, out, err, pkg):
                                 str(revdep), ' through dep ', out.bold,
                                 str(key), out.reset, autoline=False)
                         out.write(' if USE matches one of:')
-                        for r in restricts:
+                        for r in conds:
                             out.write('                  ', str(r))
         out.write()
         out.later_prefix = []
@@ -357,14 +357,14 @@ def print_package(options, out, err, pkg):
                     # triggered by virtuals currently).
                     out.write(' %s on %s' % (name, revdep))
                     continue
-                for key, restricts in depset.find_cond_nodes(depset.restrictions, True):
-                    if not restricts and key.intersects(revdep):
+                for key, conds in depset.find_cond_nodes(depset.restrictions, True):
+                    if not conds and key.intersects(revdep):
                         out.write(' %s on %s through %s' % (name, revdep, key))
-                for key, restricts in depset.node_conds.iteritems():
+                for key, conds in depset.node_conds.iteritems():
                     if key.intersects(revdep):
                         out.write(' %s on %s through %s if USE %s,' %
                                   (name, revdep, key, ' or '.join(
-                                      str(r) for r in restricts)))
+                                      str(r) for r in conds)))
         # If we printed anything at all print the newline now
         out.autoline = True
         if printed_something:
@@ -586,14 +586,11 @@ def parse_revdep(value):
         raise parserestrict.ParseError(str(e))
     val_restrict = values.FlatteningRestriction(
         atom.atom,
-        values.AnyMatch(values.FunctionRestriction(targetatom.intersects)))
+        values.AnyMatch(restricts.DepIntersects(targetatom)))
     return packages.OrRestriction(*list(
         packages.PackageRestriction(dep, val_restrict)
         for dep in ('depends', 'rdepends', 'post_rdepends')))
 
-def _revdep_pkgs_match(pkgs, value):
-    return any(value.match(pkg) for pkg in pkgs)
-
 @bind_add_query(
     '--restrict-revdep-pkgs', action='append', type=atom.atom,
     default=[], dest='restrict_revdep_pkgs',
@@ -607,8 +604,7 @@ def revdep_pkgs_finalize(sequence, namespace):
         for repo in namespace.repos:
             l.extend(repo.itermatch(atom_inst))
     # have our pkgs; now build the restrict.
-    any_restrict = values.AnyMatch(
-        values.FunctionRestriction(partial(_revdep_pkgs_match, tuple(l))))
+    any_restrict = values.AnyMatch(restricts.DepMatchesPkgs(l))
     r = values.FlatteningRestriction(atom.atom, any_restrict)
     return list(packages.PackageRestriction(dep, r)
                 for dep in ('depends', 'rdepends', 'post_rdepends'))
@@ -860,6 +856,12 @@ def main(options, out, err):
             out.write('repo: %r' % (repo,))
         out.write('restrict: %r' % (options.query,))
         out.write()
+        if options.query is not None:
+            for repo in options.repos:
+                explain = getattr(repo, 'explain', None)
+                if explain is not None:
+                    out.write(explain(options.query))
+            out.write()
 
     if options.query is None:
         return 0
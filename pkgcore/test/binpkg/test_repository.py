@@ -0,0 +1,118 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import errno
+import os
+
+from snakeoil.osutils import ensure_dirs, pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.binpkg import repository
+from pkgcore.binpkg.xpak import Xpak
+from pkgcore.ebuild.atom import atom
+from pkgcore.restrictions import packages
+from pkgcore.test import TestCase
+
+
+class TestTrustedIndex(TempDirMixin, TestCase):
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.repos = []
+        os.chmod(self.dir, 0755)
+        for cpv in ('dev-libs/foo-1', 'app-misc/bar-2'):
+            self.mk_binpkg(cpv)
+        # write the index.
+        repo = self.mk_repo()
+        for pkg in repo.itermatch(packages.AlwaysTrue):
+            pkg.description
+        repo.cache.commit()
+        self.assertTrue(os.path.exists(repo.cache_location))
+
+    def tearDown(self):
+        # write out pending index updates while the repo still exists.
+        for repo in self.repos:
+            repo.cache.commit()
+        TempDirMixin.tearDown(self)
+
+    def mk_binpkg(self, cpv, mtime=1000):
+        cat, pf = cpv.split('/')
+        ensure_dirs(pjoin(self.dir, cat))
+        path = pjoin(self.dir, cat, pf + '.tbz2')
+        open(path, 'w').close()
+        Xpak.write_xpak(path, {
+            'EAPI': '5', 'SLOT': '0', 'DESCRIPTION': 'package %s' % (cpv,)})
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def mk_repo(self, **kwds):
+        repo = repository.tree(self.dir, **kwds)
+        self.repos.append(repo)
+        return repo
+
+    def cpvs(self, repo):
+        return sorted(pkg.cpvstr for pkg in repo.itermatch(packages.AlwaysTrue))
+
+    def test_trusted(self):
+        # binpkgs aren't touched; removed ones are still listed and new
+        # ones aren't until the index is updated.
+        os.unlink(pjoin(self.dir, 'dev-libs', 'foo-1.tbz2'))
+        self.mk_binpkg('dev-libs/foo-2')
+        repo = self.mk_repo(trust_index=True)
+        self.assertEqual(self.cpvs(repo), ['app-misc/bar-2', 'dev-libs/foo-1'])
+        pkg = repo.match(atom('=dev-libs/foo-1'))[0]
+        self.assertEqual(pkg.description, 'package dev-libs/foo-1')
+
+        self.assertEqual(self.cpvs(self.mk_repo()), [
+            'app-misc/bar-2', 'dev-libs/foo-2'])
+
+    def test_missing_index(self):
+        os.unlink(pjoin(self.dir, 'Packages'))
+        repo = self.mk_repo(trust_index=True)
+        self.assertIdentical(repo._indexed, None)
+        self.assertEqual(self.cpvs(repo), ['app-misc/bar-2', 'dev-libs/foo-1'])
+
+    def test_reconcile(self):
+        os.unlink(pjoin(self.dir, 'dev-libs', 'foo-1.tbz2'))
+        self.mk_binpkg('dev-libs/foo-2')
+        index = pjoin(self.dir, 'Packages')
+        # recent indexes aren't reconciled.
+        repo = self.mk_repo(trust_index=True, reconcile_interval=3600)
+        self.assertEqual(self.cpvs(repo), ['app-misc/bar-2', 'dev-libs/foo-1'])
+
+        os.utime(index, (1000, 1000))
+        repo = self.mk_repo(trust_index=True, reconcile_interval=3600)
+        self.assertEqual(self.cpvs(repo), ['app-misc/bar-2', 'dev-libs/foo-2'])
+        self.assertEqual(repo.match(atom('=dev-libs/foo-2'))[0].description,
+                         'package dev-libs/foo-2')
+        self.assertNotEqual(os.stat(index).st_mtime, 1000)
+        repo = self.mk_repo(trust_index=True)
+        self.assertEqual(self.cpvs(repo), ['app-misc/bar-2', 'dev-libs/foo-2'])
+
+    def test_read_only_index(self):
+        os.unlink(pjoin(self.dir, 'dev-libs', 'foo-1.tbz2'))
+        index = pjoin(self.dir, 'Packages')
+        os.utime(index, (1000, 1000))
+        # stale indexes that can't be written back are trusted as is.
+        repo = self.mk_repo(trust_index=True, reconcile_interval=3600)
+        repo._index_writable = lambda: False
+        self.assertEqual(self.cpvs(repo), ['app-misc/bar-2', 'dev-libs/foo-1'])
+        # explicit reconciling happens in memory only.
+        repo.reconcile()
+        self.assertEqual(sorted(repo.cache.iterkeys()), ['app-misc/bar-2'])
+        repo.cache.commit()
+        self.assertEqual(os.stat(index).st_mtime, 1000)
+
+    def test_failed_write(self):
+        os.unlink(pjoin(self.dir, 'dev-libs', 'foo-1.tbz2'))
+        index = pjoin(self.dir, 'Packages')
+        os.utime(index, (1000, 1000))
+        repo = self.mk_repo(trust_index=True, reconcile_interval=3600)
+
+        def _write_data():
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS))
+        repo.cache._write_data = _write_data
+        # listing still works, from the entries reconciled in memory.
+        self.assertEqual(self.cpvs(repo), ['app-misc/bar-2'])
+        repo.cache.discard_pending()
+        self.assertEqual(os.stat(index).st_mtime, 1000)
@@ -0,0 +1,143 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import os
+import threading
+import time
+
+from snakeoil.chksum import LazilyHashedPath
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.cache import indexed, errors
+from pkgcore.test.cache import util
+
+
+def _mk_chf_obj(md5):
+    return LazilyHashedPath('/nonexistent/path', md5=md5)
+
+
+class db(indexed.database):
+
+    def __setitem__(self, cpv, data):
+        data['_chf_'] = _mk_chf_obj(0xdeadbeef)
+        return indexed.database.__setitem__(self, cpv, data)
+
+    def __getitem__(self, cpv):
+        d = dict(indexed.database.__getitem__(self, cpv).iteritems())
+        d.pop('_%s_' % self.chf_type, None)
+        return d
+
+
+class TestIndexed(util.GenericCacheMixin, TempDirMixin):
+
+    cache_keys = ("DEPEND", "RDEPEND", "SLOT", "_eclasses_")
+    test_data = (
+        ("sys-libs/libtrash-2.4",
+            (('DEPEND', 'virtual/libc dev-lang/perl'),
+            ('RDEPEND', 'virtual/libc dev-lang/perl'),
+            ('SLOT', '0'),
+            ('_eclasses_', {'eutils': _mk_chf_obj(0x1234)}))),
+        ("dev-util/bsdiff-4.3",
+            (('DEPEND', 'app-arch/bzip2'),
+            ('SLOT', '0'))),
+    )
+
+    def get_db(self, readonly=False):
+        return db(self.dir, auxdbkeys=self.cache_keys, readonly=readonly)
+
+    def populate(self):
+        cache = self.get_db()
+        for key, raw_data in self.test_data:
+            cache[key] = dict(raw_data)
+        cache.commit()
+        return cache
+
+    def test_roundtrip(self):
+        self.populate()
+        self.assertEqual(
+            sorted(os.listdir(self.dir)), [db.filename, db.lockname])
+        cache = self.get_db(True)
+        self.assertEqual(sorted(cache), sorted(x[0] for x in self.test_data))
+        self.assertEqual(
+            cache["dev-util/bsdiff-4.3"],
+            {'DEPEND': 'app-arch/bzip2', 'SLOT': '0'})
+        self.assertEqual(
+            cache["sys-libs/libtrash-2.4"]['_eclasses_'],
+            [('eutils', (('md5', 0x1234L),))])
+        self.assertRaises(KeyError, cache.__getitem__, "dev-util/foo-1")
+
+    def test_pending(self):
+        cache = self.populate()
+        cache["dev-util/bsdiff-4.3"] = {'SLOT': '1'}
+        del cache["sys-libs/libtrash-2.4"]
+        self.assertEqual(cache["dev-util/bsdiff-4.3"], {'SLOT': '1'})
+        self.assertNotIn("sys-libs/libtrash-2.4", cache)
+        self.assertEqual(list(cache), ["dev-util/bsdiff-4.3"])
+        # nothing hits the disk till commit
+        other = self.get_db(True)
+        self.assertEqual(other["dev-util/bsdiff-4.3"]['SLOT'], '0')
+        cache.commit()
+        self.assertEqual(other["dev-util/bsdiff-4.3"]['SLOT'], '0')
+        other = self.get_db(True)
+        self.assertEqual(other["dev-util/bsdiff-4.3"], {'SLOT': '1'})
+        self.assertEqual(list(other), ["dev-util/bsdiff-4.3"])
+
+    def test_concurrent_append(self):
+        first, second = self.get_db(), self.get_db()
+        first["dev-util/bsdiff-4.3"] = {'SLOT': '0'}
+        second["dev-util/foo-1"] = {'SLOT': '1'}
+        first.commit()
+        second.commit()
+        first["dev-util/bar-2"] = {'SLOT': '2'}
+        first.commit()
+        cache = self.get_db(True)
+        self.assertEqual(
+            sorted(cache), ["dev-util/bar-2", "dev-util/bsdiff-4.3", "dev-util/foo-1"])
+        self.assertEqual(cache["dev-util/foo-1"], {'SLOT': '1'})
+
+    def test_compact(self):
+        cache = self.populate()
+        for x in range(50):
+            cache["dev-util/bsdiff-4.3"] = {'SLOT': str(x)}
+            cache.commit()
+        size = os.stat(cache.path).st_size
+        cache.commit(force=True)
+        self.assertTrue(os.stat(cache.path).st_size < size)
+        self.assertEqual(cache["dev-util/bsdiff-4.3"], {'SLOT': '49'})
+        self.assertEqual(len(cache.keys()), 2)
+        self.assertRaises(errors.ReadOnly, self.get_db(True).compact)
+
+    def test_compact_lock(self):
+        cache = self.populate()
+        cache["dev-util/bsdiff-4.3"] = {'SLOT': '1'}
+        cache.commit()
+        # compaction waits for appenders holding the lock, and picks up
+        # what they appended.
+        other = self.get_db()
+        lock = other._lock()
+        thread = threading.Thread(target=cache.compact)
+        thread.start()
+        try:
+            time.sleep(0.1)
+            self.assertTrue(thread.is_alive())
+            other["dev-util/diffball-0.7"] = {'SLOT': '3'}
+            fd = os.open(other.path, os.O_WRONLY|os.O_APPEND)
+            os.write(fd, ''.join(other._serialize(other._pending.iteritems())))
+            os.close(fd)
+        finally:
+            os.close(lock)
+            thread.join()
+        cache = self.get_db(True)
+        self.assertEqual(cache["dev-util/diffball-0.7"], {'SLOT': '3'})
+        self.assertEqual(cache["dev-util/bsdiff-4.3"], {'SLOT': '1'})
+
+    def test_truncated(self):
+        self.populate()
+        with open(os.path.join(self.dir, db.filename), 'a') as f:
+            f.write("dev-util/foo-1\t100\nSLOT=")
+        cache = self.get_db(True)
+        self.assertEqual(len(cache.keys()), 2)
+        with open(os.path.join(self.dir, db.filename), 'w') as f:
+            f.write("garbage")
+        self.assertRaises(errors.GeneralCacheCorruption,
+                          list, self.get_db(True))
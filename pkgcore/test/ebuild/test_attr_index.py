@@ -0,0 +1,232 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import os
+
+from snakeoil.osutils import ensure_dirs, pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.ebuild import eclass_cache
+from pkgcore.ebuild.attr_index import AttrIndex
+from pkgcore.ebuild.cpv import versioned_CPV_cls
+from pkgcore.ebuild.repo_objs import Maintainer
+from pkgcore.repository.util import SimpleTree
+from pkgcore.restrictions import packages, values
+from pkgcore.test import TestCase
+
+
+metadata = {
+    'dev-util/diffball-1.0': {
+        'keywords': ('x86', '~amd64'), 'license': ('GPL-2',),
+        'inherited': ('eutils',)},
+    'dev-util/diffball-1.1': {
+        'keywords': ('~x86', '~amd64'), 'license': ('GPL-3',),
+        'inherited': ('eutils',)},
+    'dev-libs/bsdiff-2.0': {
+        'keywords': ('amd64',), 'license': ('BSD', 'GPL-2'),
+        'inherited': ()},
+}
+
+
+class IndexedPkg(versioned_CPV_cls):
+
+    __slots__ = ()
+    instantiated = []
+
+    def __init__(self, *args):
+        versioned_CPV_cls.__init__(self, *args)
+        self.instantiated.append(self.cpvstr)
+
+    def __getattr__(self, attr):
+        if attr == 'maintainers':
+            if self.package == 'diffball':
+                return (Maintainer(email=u'foo@gentoo.org', name=u'Foo'),)
+            return ()
+        try:
+            return metadata[self.cpvstr][attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+
+class IndexedTree(SimpleTree):
+
+    extension = '.ebuild'
+
+
+class TestAttrIndex(TempDirMixin, TestCase):
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        d = {}
+        for cpv in metadata:
+            cat, pv = cpv.split('/')
+            pkg, ver = pv.split('-', 1)
+            d.setdefault(cat, {}).setdefault(pkg, []).append(ver)
+            self.write(cat, pkg, '%s.ebuild' % (pv,))
+        ensure_dirs(pjoin(self.dir, 'eclass'))
+        self.write('eclass', 'eutils.eclass')
+        IndexedPkg.instantiated[:] = []
+        self.path = pjoin(self.dir, 'attr-index')
+        self.repo = self.mk_repo(d)
+
+    def mk_repo(self, d=None):
+        if d is None:
+            d = self.repo.cpv_dict
+        repo = IndexedTree(d, pkg_klass=IndexedPkg)
+        repo.location = self.dir
+        repo.eclass_cache = eclass_cache.cache(pjoin(self.dir, 'eclass'))
+        return repo
+
+    def write(self, *path):
+        path = pjoin(self.dir, *path)
+        ensure_dirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(path)
+        os.utime(path, (1000, 1000))
+
+    def match(self, restrict):
+        del IndexedPkg.instantiated[:]
+        return sorted(x.cpvstr for x in self.repo.itermatch(restrict))
+
+    def test_queries(self):
+        index = AttrIndex(self.path)
+        index.update(self.repo)
+        index.write()
+        self.repo.attr_index = AttrIndex.load(self.path)
+        self.assertEqual(index.values, self.repo.attr_index.values)
+        self.assertEqual(index.ebuilds, self.repo.attr_index.ebuilds)
+
+        r = packages.PackageRestriction(
+            'license', values.ContainmentMatch('BSD'))
+        self.assertEqual(self.match(r), ['dev-libs/bsdiff-2.0'])
+        self.assertEqual(IndexedPkg.instantiated, ['dev-libs/bsdiff-2.0'])
+
+        r = packages.PackageRestriction(
+            'keywords', values.ContainmentMatch('~amd64', 'amd64', all=True))
+        self.assertEqual(self.match(r), [])
+        self.assertEqual(IndexedPkg.instantiated, [])
+
+        r = packages.PackageRestriction(
+            'maintainers', values.AnyMatch(values.GetAttrRestriction(
+                'email', values.StrExactMatch('foo@gentoo.org'))))
+        self.assertEqual(
+            self.match(r), ['dev-util/diffball-1.0', 'dev-util/diffball-1.1'])
+        self.assertLen(IndexedPkg.instantiated, 2)
+        self.assertIn("indexed on maintainers", self.repo.explain(r))
+
+        # combined with category constraints and ORs.
+        r = packages.OrRestriction(
+            packages.AndRestriction(
+                packages.PackageRestriction(
+                    'category', values.StrExactMatch('dev-util')),
+                packages.PackageRestriction(
+                    'license', values.ContainmentMatch('GPL-2'))),
+            packages.PackageRestriction(
+                'inherited', values.ContainmentMatch('nonexistent')))
+        self.assertEqual(self.match(r), ['dev-util/diffball-1.0'])
+        self.assertEqual(IndexedPkg.instantiated, ['dev-util/diffball-1.0'])
+
+        # unindexable terms fall back to a scan.
+        r = packages.PackageRestriction(
+            'license', values.ContainmentMatch('BSD', negate=True))
+        self.assertLen(self.match(r), 2)
+        self.assertLen(IndexedPkg.instantiated, 3)
+
+    def test_stale(self):
+        index = AttrIndex(self.path)
+        index.update(self.repo)
+        self.assertEqual(index.stale(self.repo), frozenset())
+        index.write()
+
+        # queries don't look at ebuilds besides the candidates'; in place
+        # edits are picked up when the index is updated.
+        path = pjoin(self.dir, 'dev-libs', 'bsdiff', 'bsdiff-2.0.ebuild')
+        os.utime(path, (2000, 2000))
+        index = self.repo.attr_index = AttrIndex.load(self.path)
+        stats = []
+        orig_stat = AttrIndex.__dict__['_stat']
+        AttrIndex._stat = staticmethod(
+            lambda path: stats.append(path) or orig_stat.__func__(path))
+        try:
+            self.assertEqual(index.stale(self.repo), frozenset())
+            r = packages.PackageRestriction(
+                'license', values.ContainmentMatch('GPL-3'))
+            self.assertEqual(self.match(r), ['dev-util/diffball-1.1'])
+        finally:
+            AttrIndex._stat = orig_stat
+        self.assertEqual(IndexedPkg.instantiated, ['dev-util/diffball-1.1'])
+        self.assertEqual(
+            len([x for x in stats if x.endswith('.ebuild')]), 1)
+        index.update(self.repo)
+        self.assertEqual(index.stale(self.repo), frozenset())
+        index.write()
+
+        # packages added, or versions added to or replaced in a package
+        # directory, can't be answered for until the index is updated.
+        self.write('dev-libs', 'new', 'new-1.ebuild')
+        self.write('dev-libs', 'bsdiff', 'bsdiff-2.1.ebuild')
+        os.utime(pjoin(self.dir, 'dev-libs', 'bsdiff'), (2000, 2000))
+        d = self.repo.cpv_dict
+        d['dev-libs']['new'] = ['1']
+        d['dev-libs']['bsdiff'].append('2.1')
+        self.repo = self.mk_repo(d)
+        index = self.repo.attr_index = AttrIndex.load(self.path)
+        self.assertEqual(
+            sorted(index.stale(self.repo)),
+            ['dev-libs/bsdiff-2.0', 'dev-libs/bsdiff-2.1', 'dev-libs/new-1'])
+        metadata['dev-libs/new-1'] = {'license': ('GPL-3',)}
+        metadata['dev-libs/bsdiff-2.1'] = {'license': ('GPL-3',)}
+        try:
+            self.assertEqual(
+                self.match(r), ['dev-libs/bsdiff-2.1', 'dev-libs/new-1',
+                                'dev-util/diffball-1.1'])
+            # removed candidates are dropped.
+            os.unlink(pjoin(self.dir, 'dev-libs', 'new', 'new-1.ebuild'))
+            self.assertEqual(
+                {k: tuple(sorted(v)) for k, v in
+                 index.candidates(self.repo, [r]).iteritems()},
+                {('dev-libs', 'bsdiff'): ('2.0', '2.1'),
+                 ('dev-util', 'diffball'): ('1.1',)})
+        finally:
+            del metadata['dev-libs/new-1']
+            del metadata['dev-libs/bsdiff-2.1']
+        del d['dev-libs']['new']
+        os.unlink(pjoin(self.dir, 'dev-libs', 'bsdiff', 'bsdiff-2.1.ebuild'))
+        d['dev-libs']['bsdiff'].remove('2.1')
+        self.repo = self.mk_repo(d)
+        index.update(self.repo)
+        self.assertEqual(index.stale(self.repo), frozenset())
+        index.write()
+
+        # as are packages inheriting modified eclasses.
+        os.utime(pjoin(self.dir, 'eclass', 'eutils.eclass'), (2000, 2000))
+        self.repo = self.mk_repo()
+        index = AttrIndex.load(self.path)
+        self.assertEqual(
+            sorted(index.stale(self.repo)),
+            ['dev-util/diffball-1.0', 'dev-util/diffball-1.1'])
+
+    def test_unindexed(self):
+        # packages failing indexing are candidates for every query.
+        orig = metadata.pop('dev-libs/bsdiff-2.0')
+        try:
+            index = AttrIndex(self.path)
+            index.update(self.repo)
+        finally:
+            metadata['dev-libs/bsdiff-2.0'] = orig
+        self.assertEqual(index.unindexed, set(['dev-libs/bsdiff-2.0']))
+        index.write()
+        index = self.repo.attr_index = AttrIndex.load(self.path)
+        self.assertEqual(index.unindexed, set(['dev-libs/bsdiff-2.0']))
+        self.assertEqual(index.stale(self.repo), frozenset())
+        r = packages.PackageRestriction(
+            'license', values.ContainmentMatch('BSD'))
+        self.assertEqual(
+            index.candidates(self.repo, [r]), {('dev-libs', 'bsdiff'): ('2.0',)})
+        self.assertEqual(self.match(r), ['dev-libs/bsdiff-2.0'])
+
+        # and are retried on update.
+        index.update(self.repo)
+        self.assertEqual(index.unindexed, set())
+        self.assertEqual(
+            index.candidates(self.repo, [r]), {('dev-libs', 'bsdiff'): ('2.0',)})
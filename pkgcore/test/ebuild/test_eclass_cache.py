@@ -40,6 +40,17 @@ class TestBase(TestCase):
         assertRebuildResults(True, 'eclass1', 100)
         assertRebuildResults(False, 'eclass1', 200)
 
+    def test_rebuild_cache_entry_memoized(self):
+        entry = [(x, (('mtime', self.ec.eclasses[x].mtime),))
+                 for x in ('eclass1', 'eclass2')]
+        got = self.ec.rebuild_cache_entry(entry)
+        self.assertEqual(sorted(got), ['eclass1', 'eclass2'])
+        self.assertIdentical(got, self.ec.rebuild_cache_entry(list(entry)))
+        self.assertIdentical(
+            got['eclass1'], self.ec.rebuild_cache_entry(entry[:1])['eclass1'])
+        self.assertIdentical(
+            None, self.ec.rebuild_cache_entry([('eclass1', (('mtime', 1),))]))
+
     def test_get_eclass_data(self):
         keys = self.ec.eclasses.keys()
         data = self.ec.get_eclass_data([])
@@ -63,6 +74,18 @@ class TestEclassCache(TempDirMixin, TestBase):
         self.ec = eclass_cache.cache(self.dir)
         self.ec_locs = {x: self.dir for x in ("eclass1", "eclass2")}
 
+    def test_invalidate_if_modified(self):
+        entry = [('eclass3', (('mtime', 100),))]
+        self.assertIdentical(None, self.ec.rebuild_cache_entry(entry))
+        self.assertFalse(self.ec.invalidate_if_modified())
+        path = pjoin(self.ec_locs['eclass1'], 'eclass3.eclass')
+        open(path, 'w').close()
+        os.utime(path, (100, 100))
+        os.utime(os.path.dirname(path), (1, 1))
+        self.assertTrue(self.ec.invalidate_if_modified())
+        self.assertIn('eclass3', self.ec.eclasses)
+        self.assertEqual(['eclass3'], list(self.ec.rebuild_cache_entry(entry)))
+
     def test_get_eclass(self):
         for x in ("eclass1", "eclass2"):
             handle = self.ec.get_eclass(x)
@@ -95,3 +118,45 @@ class TestStackedCaches(TestEclassCache):
         self.ec_locs = {"eclass1":self.loc1, "eclass2":self.loc2}
         # make a shadowed file to verify it's not seen
         open(pjoin(self.loc2, 'eclass1.eclass'), 'w').close()
+
+
+class TestUsageIndex(TempDirMixin, TestCase):
+
+    caches = (
+        {'dev-util/diffball-1.0': {'_eclasses_': [('eutils', ()), ('flag-o-matic', ())]},
+         'dev-util/bsdiff-1.0': {}},
+        {'dev-util/diffball-1.0': {'_eclasses_': [('toolchain', ())]},
+         'dev-libs/foo-2': {'_eclasses_': [('eutils', ())]}},
+    )
+
+    def test_from_caches(self):
+        index = eclass_cache.UsageIndex.from_caches(
+            ['dev-util/diffball-1.0', 'dev-util/bsdiff-1.0', 'dev-libs/foo-2',
+             'dev-libs/missing-1'],
+            self.caches)
+        self.assertEqual(sorted(index), ['eutils', 'flag-o-matic'])
+        self.assertEqual(index['eutils'],
+                         frozenset(['dev-util/diffball-1.0', 'dev-libs/foo-2']))
+        self.assertEqual(index['toolchain'], frozenset())
+        self.assertEqual(index.inherited('dev-util/bsdiff-1.0'), frozenset())
+        self.assertNotIn('dev-libs/missing-1', index.cpvs)
+        self.assertEqual(index.dependents(['flag-o-matic', 'toolchain']),
+                         set(['dev-util/diffball-1.0']))
+
+        index.update('dev-util/diffball-1.0', ['toolchain'])
+        self.assertNotIn('flag-o-matic', index)
+        self.assertEqual(index['eutils'], frozenset(['dev-libs/foo-2']))
+        index.discard('dev-libs/foo-2')
+        self.assertEqual(sorted(index), ['toolchain'])
+
+    def test_persistence(self):
+        path = pjoin(self.dir, 'index')
+        self.assertIdentical(eclass_cache.UsageIndex.load(path), None)
+        index = eclass_cache.UsageIndex.from_caches(
+            ['dev-util/diffball-1.0', 'dev-util/bsdiff-1.0', 'dev-libs/foo-2'],
+            self.caches, path=path)
+        index.write()
+        loaded = eclass_cache.UsageIndex.load(path)
+        self.assertEqual(loaded.cpvs, index.cpvs)
+        self.assertEqual(dict(loaded.iteritems()), dict(index.iteritems()))
+        self.assertEqual(loaded.inherited('dev-util/bsdiff-1.0'), frozenset())
@@ -179,6 +179,69 @@ class UnconfiguredTreeTest(TempDirMixin):
             sorted(repo.default_visibility_limiters))
 
 
+class ListingIndexTest(TempDirMixin):
+
+    def mk_tree(self):
+        return repository._UnconfiguredTree(
+            self.repo_dir, eclass_cache.cache(pjoin(self.repo_dir, 'eclass')),
+            listing_index=self.index_path)
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.repo_dir = pjoin(self.dir, 'repo')
+        self.index_path = pjoin(self.dir, 'listing')
+        ensure_dirs(pjoin(self.repo_dir, 'profiles'))
+        ensure_dirs(pjoin(self.repo_dir, 'cat', 'pkg'))
+        touch(pjoin(self.repo_dir, 'cat', 'pkg', 'pkg-1.ebuild'))
+        self.set_mtimes(1000)
+
+    def set_mtimes(self, mtime):
+        for path in (self.repo_dir, pjoin(self.repo_dir, 'cat'),
+                     pjoin(self.repo_dir, 'cat', 'pkg')):
+            os.utime(path, (mtime, mtime))
+
+    @silence_logging
+    def test_listing_index(self):
+        repo = self.mk_tree()
+        self.assertEqual({('cat', 'pkg'): ('1',)}, dict(repo.versions))
+        repo.listing_index.write()
+        self.assertEqual(
+            sorted(repo.listing_index.entries),
+            ['', 'cat', 'cat/pkg'])
+
+        # unchanged mtimes; the recorded listings are trusted.
+        touch(pjoin(self.repo_dir, 'cat', 'pkg', 'pkg-2.ebuild'))
+        self.set_mtimes(1000)
+        repo = self.mk_tree()
+        self.assertEqual({('cat', 'pkg'): ('1',)}, dict(repo.versions))
+
+        # only the modified dir is relisted.
+        os.utime(pjoin(self.repo_dir, 'cat', 'pkg'), (2000, 2000))
+        repo = self.mk_tree()
+        self.assertEqual(
+            {('cat', 'pkg'): ('1', '2')},
+            dict((k, tuple(sorted(v))) for k, v in repo.versions.iteritems()))
+        repo.listing_index.flush()
+        repo = self.mk_tree()
+        self.assertEqual(
+            sorted(repo.listing_index.entries['cat/pkg'][1]),
+            ['pkg-1.ebuild', 'pkg-2.ebuild'])
+
+        # recently modified dirs aren't recorded.
+        ensure_dirs(pjoin(self.repo_dir, 'cat', 'new'))
+        repo = self.mk_tree()
+        self.assertEqual(('new', 'pkg'), tuple(sorted(repo.packages['cat'])))
+        self.assertNotIn('cat', repo.listing_index.entries)
+
+        # garbage is ignored.
+        with open(self.index_path, 'w') as f:
+            f.write('garbage\n')
+        repo = self.mk_tree()
+        self.assertEqual(('new', 'pkg'), tuple(sorted(repo.packages['cat'])))
+        self.assertEqual({}, dict(repo.listing_index.entries))
+        repo.listing_index.flush()
+
+
 class SlavedTreeTest(UnconfiguredTreeTest):
 
     def mk_tree(self, path, *args, **kwds):
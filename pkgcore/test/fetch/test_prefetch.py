@@ -0,0 +1,108 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import threading
+
+from pkgcore.fetch import errors, fetchable
+from pkgcore.fetch.prefetch import Prefetcher
+from pkgcore.test import TestCase
+
+
+class BlockingFetcher(object):
+
+    """fetcher whose fetches only finish once released"""
+
+    distdir = '/distfiles'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.started = []
+        self.active = {}
+        self.peak = {}
+
+    def __call__(self, target):
+        host = target.uri[0].split('/')[2]
+        with self.lock:
+            self.started.append(target.filename)
+            self.active[host] = self.active.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+        self.release.wait()
+        with self.lock:
+            self.active[host] -= 1
+        if target.filename.startswith('bad'):
+            raise errors.FetchFailed(target.filename, 'bad checksum')
+        return '%s/%s' % (self.distdir, target.filename)
+
+
+def mk_fetchable(filename, host='mirror'):
+    return fetchable(filename, uri=['http://%s/%s' % (host, filename)])
+
+
+class TestPrefetcher(TestCase):
+
+    def setUp(self):
+        self.fetcher = BlockingFetcher()
+        self.prefetcher = Prefetcher(self.fetcher, jobs=4, per_host=2)
+
+    def tearDown(self):
+        self.fetcher.release.set()
+        self.prefetcher.shutdown(wait=True)
+
+    def wait_started(self, count):
+        for x in xrange(100):
+            with self.fetcher.lock:
+                if len(self.fetcher.started) >= count:
+                    return
+            threading.Event().wait(0.01)
+        self.fail("only %r started" % (self.fetcher.started,))
+
+    def test_fetch(self):
+        files = [mk_fetchable('a-%i.tar' % x) for x in xrange(3)]
+        files.append(mk_fetchable('b.tar', host='other'))
+        # duplicates and files without uris aren't fetched in the background.
+        self.prefetcher.submit(files + [files[0], fetchable('local')])
+        self.wait_started(3)
+        self.assertEqual(
+            sorted(self.fetcher.started), ['a-0.tar', 'a-1.tar', 'b.tar'])
+        # the per host limit only applies to background fetches.
+        self.assertEqual(self.fetcher.peak, {'mirror': 2, 'other': 1})
+        self.fetcher.release.set()
+        self.assertEqual(self.prefetcher(files[2]), '/distfiles/a-2.tar')
+        self.assertEqual(self.prefetcher(files[0]), '/distfiles/a-0.tar')
+        self.prefetcher.shutdown(wait=True)
+        # each file is only fetched once.
+        self.assertEqual(len(self.fetcher.started), 4)
+        # unknown files go straight to the fetcher.
+        self.assertEqual(self.prefetcher(mk_fetchable('c')), '/distfiles/c')
+        # other attributes are proxied.
+        self.assertEqual(self.prefetcher.distdir, '/distfiles')
+
+    def test_claim(self):
+        files = [mk_fetchable('a-%i.tar' % x) for x in xrange(3)]
+        self.prefetcher.submit(files)
+        self.wait_started(2)
+        # a queued file is fetched by the caller, ahead of the queue.
+        t = threading.Thread(target=self.prefetcher, args=(files[2],))
+        t.start()
+        self.wait_started(3)
+        self.assertEqual(self.fetcher.started[-1], 'a-2.tar')
+        self.fetcher.release.set()
+        t.join()
+
+    def test_failure(self):
+        target = mk_fetchable('bad.tar')
+        self.prefetcher.submit([target])
+        self.fetcher.release.set()
+        self.assertRaises(errors.FetchFailed, self.prefetcher, target)
+
+    def test_shutdown(self):
+        files = [mk_fetchable('a-%i.tar' % x) for x in xrange(3)]
+        self.prefetcher.submit(files)
+        self.wait_started(2)
+        self.prefetcher.shutdown()
+        self.fetcher.release.set()
+        self.prefetcher.shutdown(wait=True)
+        self.assertEqual(sorted(self.fetcher.started), ['a-0.tar', 'a-1.tar'])
+        # files dropped from the queue are fetched on demand.
+        self.assertEqual(self.prefetcher(files[2]), '/distfiles/a-2.tar')
@@ -0,0 +1,225 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import os
+
+from snakeoil.chksum import LazilyHashedPath
+from snakeoil.osutils import pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.ebuild import eclass_cache
+from pkgcore.ebuild.cpv import versioned_CPV_cls
+from pkgcore.operations import regen
+from pkgcore.operations.observer import null_output
+from pkgcore.repository.util import SimpleTree
+from pkgcore.test import TestCase
+
+
+class Helper(object):
+
+    def __init__(self, location):
+        self.location = location
+
+    def __call__(self, pkg):
+        if pkg.package == 'broken':
+            raise ValueError("failed sourcing %s" % pkg.cpvstr)
+        open(pjoin(self.location, pkg.cpvstr.replace('/', '_')), 'w').close()
+
+
+class RegenTree(SimpleTree):
+
+    location = None
+
+    def _regen_operation_helper(self, **options):
+        return Helper(self.location)
+
+
+class RecordingObserver(null_output):
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg, *args):
+        self.errors.append(msg % args)
+
+
+class TestRegen(TempDirMixin, TestCase):
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.repo = RegenTree({
+            'dev-util': {'diffball': ['1.0', '1.1'], 'broken': ['1']},
+            'dev-libs': {'bsdiff': ['2.0']}})
+        self.repo.location = self.dir
+
+    def assertRegenerated(self, observer):
+        self.assertEqual(
+            sorted(os.listdir(self.dir)),
+            ['dev-libs_bsdiff-2.0', 'dev-util_diffball-1.0',
+             'dev-util_diffball-1.1'])
+        self.assertEqual(len(observer.errors), 1)
+        self.assertIn('dev-util/broken-1', observer.errors[0])
+
+    def test_serial(self):
+        observer = RecordingObserver()
+        regen.regen_repository(self.repo, observer)
+        self.assertRegenerated(observer)
+
+    def test_processes(self):
+        observer = RecordingObserver()
+        regen.regen_repository(self.repo, observer, threads=2, processes=True)
+        self.assertRegenerated(observer)
+
+    def test_dead_worker(self):
+        class Tree(RegenTree):
+            def _regen_operation_helper(self, **options):
+                helper = Helper(self.location)
+                def crash(pkg):
+                    if pkg.package == 'bsdiff':
+                        os._exit(1)
+                    helper(pkg)
+                return crash
+        repo = Tree({'dev-libs': {'bsdiff': ['2.0']}})
+        repo.location = self.dir
+        observer = RecordingObserver()
+        self.assertRaises(
+            regen.RegenError, regen.regen_processes, repo,
+            repo._regen_operation_helper, observer, 2, poll_interval=0.1)
+        self.assertEqual(len(observer.errors), 1)
+        self.assertIn('died with exit status 1', observer.errors[0])
+
+    def test_unsafe_cache(self):
+        class cache(object):
+            readonly = False
+            concurrent_writes = False
+        self.repo.cache = (cache(),)
+        observer = RecordingObserver()
+        regen.regen_repository(self.repo, observer, threads=2, processes=True)
+        self.assertRegenerated(observer)
+
+
+class FakeCache(dict):
+
+    readonly = False
+    autocommits = True
+    concurrent_writes = True
+
+    def __init__(self, location):
+        dict.__init__(self)
+        self.location = location
+
+
+class FakeEclassCache(object):
+
+    def __init__(self, eclassdir):
+        self.eclassdir = eclassdir
+
+    def invalidate_if_modified(self):
+        return False
+
+    @property
+    def eclasses(self):
+        return {x[:-len('.eclass')]: LazilyHashedPath(pjoin(self.eclassdir, x))
+                for x in os.listdir(self.eclassdir)}
+
+
+class TestIncrementalRegen(TempDirMixin, TestCase):
+
+    inherits = {'dev-util/diffball-1.0': ('eutils',), 'dev-libs/bsdiff-2.0': ()}
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.eclassdir = pjoin(self.dir, 'eclass')
+        os.mkdir(self.eclassdir)
+        self.write(pjoin(self.eclassdir, 'eutils.eclass'), 'eutils')
+        for cpv in self.inherits:
+            self.write(self.ebuild(cpv), cpv)
+
+        parent = self
+
+        class pkg(versioned_CPV_cls):
+            @property
+            def path(self):
+                return parent.ebuild(self.cpvstr)
+
+        self.regenerated = []
+
+        class Tree(SimpleTree):
+            def _regen_operation_helper(tree, **options):
+                return self.helper
+
+        self.repo = Tree({'dev-util': {'diffball': ['1.0']},
+                          'dev-libs': {'bsdiff': ['2.0']}}, pkg_klass=pkg)
+        self.repo.eclass_cache = FakeEclassCache(self.eclassdir)
+        self.repo.cache = (FakeCache(pjoin(self.dir, 'cache')),)
+
+    def helper(self, pkg):
+        self.regenerated.append(pkg.cpvstr)
+        self.repo.cache[0][pkg.cpvstr] = {
+            '_eclasses_': [(x, ()) for x in self.inherits[pkg.cpvstr]]}
+
+    def ebuild(self, cpv):
+        return pjoin(self.dir, cpv.replace('/', '_'))
+
+    def write(self, path, data, mtime=None):
+        with open(path, 'w') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def regen(self):
+        self.regenerated = []
+        regen.regen_repository(self.repo, RecordingObserver(), incremental=True)
+        return sorted(self.regenerated)
+
+    def test_incremental(self):
+        self.assertEqual(self.regen(), sorted(self.inherits))
+        self.assertTrue(os.path.exists(pjoin(self.dir, 'cache.regen-state')))
+        self.assertEqual(
+            eclass_cache.UsageIndex.load(regen.eclass_usage_path(self.repo))['eutils'],
+            frozenset(['dev-util/diffball-1.0']))
+        self.assertEqual(self.regen(), [])
+
+        # modified eclass invalidates its consumers only
+        self.write(pjoin(self.eclassdir, 'eutils.eclass'), 'eutils2', 1)
+        self.assertEqual(self.regen(), ['dev-util/diffball-1.0'])
+        self.assertEqual(self.regen(), [])
+
+        # touched but unchanged ebuilds are left alone
+        self.write(self.ebuild('dev-libs/bsdiff-2.0'), 'dev-libs/bsdiff-2.0', 1)
+        self.assertEqual(self.regen(), [])
+        self.write(self.ebuild('dev-libs/bsdiff-2.0'), 'modified', 1)
+        self.assertEqual(self.regen(), ['dev-libs/bsdiff-2.0'])
+
+        # removed ebuilds have their cache entries dropped
+        self.repo.notify_remove_package(
+            self.repo.package_class('dev-libs', 'bsdiff', '2.0'))
+        self.assertEqual(self.regen(), [])
+        self.assertEqual(list(self.repo.cache[0]), ['dev-util/diffball-1.0'])
+
+    def test_current(self):
+        def current():
+            return regen.RegenState(
+                regen.regen_state_path(self.repo),
+                regen.eclass_usage_path(self.repo)).current(self.repo)
+
+        self.assertFalse(current())
+        self.regen()
+        self.assertTrue(current())
+
+        # touched but unchanged ebuilds don't invalidate the state.
+        self.write(self.ebuild('dev-libs/bsdiff-2.0'), 'dev-libs/bsdiff-2.0', 1)
+        self.assertTrue(current())
+        self.write(self.ebuild('dev-libs/bsdiff-2.0'), 'modified', 1)
+        self.assertFalse(current())
+        self.regen()
+        self.assertTrue(current())
+
+        self.write(pjoin(self.eclassdir, 'eutils.eclass'), 'eutils2', 1)
+        self.assertFalse(current())
+        self.regen()
+        self.assertTrue(current())
+
+        self.repo.notify_remove_package(
+            self.repo.package_class('dev-libs', 'bsdiff', '2.0'))
+        self.assertFalse(current())
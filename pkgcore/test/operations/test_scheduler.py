@@ -0,0 +1,114 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import threading
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.operations.scheduler import Scheduler, dependency_graph
+from pkgcore.resolver import plan
+from pkgcore.test import TestCase
+from pkgcore.test.misc import FakeRepo
+from pkgcore.test.resolver.test_plan import DepPkg
+
+
+class TestDependencyGraph(TestCase):
+
+    def test_plan(self):
+        repo = FakeRepo(livefs=False, repo_id='fake')
+        repo.pkgs = [DepPkg(cpv, deps, repo=repo) for cpv, deps in (
+            ('dev-libs/z-1', ''),
+            ('dev-libs/y-1', 'dev-libs/z'),
+            ('dev-libs/x-1', ''),
+            ('app-misc/a-1', 'dev-libs/y || ( dev-libs/w dev-libs/x )'),
+            )]
+        resolver = plan.merge_plan(
+            [repo, FakeRepo(livefs=True, repo_id='vdb')],
+            plan.pkg_sort_highest, plan.merge_plan.prefer_highest_version_strategy)
+        self.assertFalse(resolver.add_atom(atom('app-misc/a')))
+        ops = resolver.state.ops()
+        names = [op.pkg.cpvstr for op in ops]
+        graph = dict(
+            (names[idx], sorted(names[x] for x in deps))
+            for idx, deps in enumerate(dependency_graph(ops)))
+        self.assertEqual(graph, {
+            'dev-libs/z-1': [],
+            'dev-libs/y-1': ['dev-libs/z-1'],
+            'dev-libs/x-1': [],
+            'app-misc/a-1': ['dev-libs/x-1', 'dev-libs/y-1'],
+        })
+
+
+class FakeOp(object):
+
+    desc = 'add'
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class TestScheduler(TestCase):
+
+    def mk_scheduler(self, graph, fail=(), jobs=2, **kwds):
+        ops = [FakeOp(str(x)) for x in xrange(len(graph))]
+        self.merged = []
+        self.events = []
+        self.lock = threading.Lock()
+        self.active = self.peak = 0
+
+        def build(job):
+            with self.lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+            # let sibling builds start before finishing.
+            threading.Event().wait(0.05)
+            with self.lock:
+                self.active -= 1
+            if job.index in fail:
+                raise ValueError(job.index)
+            return job.index
+
+        def merge(job):
+            self.merged.append(job.result)
+
+        def notify(sched, job):
+            self.events.append((job.index, job.state))
+
+        return Scheduler(ops, build, merge, jobs=jobs, notify=notify,
+                         graph=graph, **kwds)
+
+    def test_order(self):
+        graph = [set(), set(), set([0, 1]), set(), set([2])]
+        sched = self.mk_scheduler(graph)
+        self.assertEqual(sched.run(), [])
+        self.assertEqual(sorted(self.merged), range(5))
+        for idx, deps in enumerate(graph):
+            for dep in deps:
+                self.assertTrue(
+                    self.merged.index(dep) < self.merged.index(idx))
+        self.assertEqual(self.peak, 2)
+        self.assertEqual(sched.count('merged'), 5)
+
+    def test_sequential(self):
+        sched = self.mk_scheduler([set(), set(), set()], jobs=1)
+        self.assertEqual(sched.run(), [])
+        self.assertEqual(self.peak, 1)
+        self.assertEqual(self.merged, [0, 1, 2])
+
+    def test_failure(self):
+        graph = [set(), set([0]), set(), set()]
+        sched = self.mk_scheduler(graph, fail=(0,), jobs=1)
+        failed = sched.run()
+        self.assertEqual([x.index for x in failed], [0])
+        self.assertIsInstance(failed[0].error, ValueError)
+        # nothing further is started.
+        self.assertEqual(self.merged, [])
+        self.assertEqual(sched.count('pending'), 3)
+
+        sched = self.mk_scheduler(graph, fail=(0,), jobs=1)
+        self.assertLen(sched.run(keep_going=True), 1)
+        # dependents of a failed job are skipped.
+        self.assertEqual(self.merged, [2, 3])
+        self.assertIn((1, 'skipped'), self.events)
@@ -0,0 +1,155 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import os
+
+from snakeoil.osutils import ensure_dirs, pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.ebuild.cpv import versioned_CPV_cls
+from pkgcore.repository.match_cache import MatchCache
+from pkgcore.repository.misc import caching_repo
+from pkgcore.repository.util import SimpleTree
+from pkgcore.restrictions import packages, values
+from pkgcore.test import TestCase
+
+
+class CountingPkg(versioned_CPV_cls):
+
+    __slots__ = ()
+    instantiated = []
+
+    def __init__(self, *args):
+        versioned_CPV_cls.__init__(self, *args)
+        self.instantiated.append(self.cpvstr)
+
+
+class TestMatchCache(TempDirMixin, TestCase):
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.location = pjoin(self.dir, 'repo')
+        for path in ('dev-util/diffball', 'dev-libs/bsdiff', 'dev-util',
+                     'dev-libs', ''):
+            self.mkdir(path)
+        self.repo = self.mk_repo({
+            'dev-util': {'diffball': ['1.0', '0.7', '1.1']},
+            'dev-libs': {'bsdiff': ['2.0']}})
+        self.path = pjoin(self.dir, 'match-cache')
+        self.caches = []
+        self.cache = self.mk_cache()
+
+    def tearDown(self):
+        # pending writes are registered to run at exit; do them while the
+        # temp dir still exists.
+        for cache in self.caches:
+            cache.flush()
+        TempDirMixin.tearDown(self)
+
+    def mk_repo(self, d):
+        repo = SimpleTree(d, pkg_klass=CountingPkg)
+        repo.location = self.location
+        repo.extension = '.ebuild'
+        return repo
+
+    def mk_cache(self, signature='sig'):
+        cache = MatchCache(self.path, signature)
+        self.caches.append(cache)
+        return cache
+
+    def mkdir(self, path):
+        path = pjoin(self.location, path)
+        ensure_dirs(path)
+        os.utime(path, (1000, 1000))
+
+    def match(self, restrict, cache=None):
+        if cache is None:
+            cache = self.cache
+        del CountingPkg.instantiated[:]
+        view = cache.for_repo(self.repo)
+        return sorted(x.cpvstr for x in view.itermatch(self.repo, restrict, iter))
+
+    def test_roundtrip(self):
+        a = atom('>=dev-util/diffball-1.0')
+        expected = ['dev-util/diffball-1.0', 'dev-util/diffball-1.1']
+        self.assertEqual(self.match(a), expected)
+        self.assertLen(CountingPkg.instantiated, 3)
+        self.assertEqual(self.match(atom('dev-util/foo')), [])
+        self.cache.write()
+
+        cache = self.mk_cache()
+        self.assertEqual(self.match(a, cache), expected)
+        # only the previously matching versions are examined.
+        self.assertEqual(sorted(CountingPkg.instantiated), expected)
+        self.assertEqual(self.match(atom('dev-util/foo'), cache), [])
+
+        # entries for a different configuration aren't used.
+        cache = self.mk_cache('other')
+        self.assertEqual(cache.repos, {})
+        self.assertEqual(self.match(a, cache), expected)
+        self.assertLen(CountingPkg.instantiated, 3)
+
+    def test_invalidation(self):
+        a = atom('dev-util/diffball')
+        self.match(a)
+        self.cache.write()
+        # a version was added.
+        self.repo.cpv_dict['dev-util']['diffball'].append('2.0')
+        self.repo = self.mk_repo(self.repo.cpv_dict)
+        os.utime(pjoin(self.location, 'dev-util', 'diffball'), (2000, 2000))
+        cache = self.mk_cache()
+        self.assertLen(self.match(a, cache), 4)
+        self.assertLen(CountingPkg.instantiated, 4)
+
+        # an ebuild was modified in place.
+        cache.write()
+        path = pjoin(self.location, 'dev-libs', 'bsdiff', 'bsdiff-2.0.ebuild')
+        with open(path, 'w') as f:
+            f.write('')
+        os.utime(path, (1000, 1000))
+        os.utime(pjoin(self.location, 'dev-libs', 'bsdiff'), (1000, 1000))
+        b = atom('dev-libs/bsdiff')
+        self.match(b, cache)
+        cache.write()
+        cache = self.mk_cache()
+        self.assertEqual(self.match(b, cache), ['dev-libs/bsdiff-2.0'])
+        self.assertLen(CountingPkg.instantiated, 1)
+        stamp = cache.for_repo(self.repo).entries['dev-libs/bsdiff'][0]
+        os.utime(path, (2000, 2000))
+        cache = self.mk_cache()
+        view = cache.for_repo(self.repo)
+        self.assertNotEqual(view._stamp(self.repo, b), stamp)
+        self.match(b, cache)
+        self.assertNotEqual(view.entries['dev-libs/bsdiff'][0], stamp)
+
+        # repo wide changes drop every entry.
+        cache.write()
+        self.mkdir('profiles')
+        cache = self.mk_cache()
+        view = cache.for_repo(self.repo)
+        self.assertEqual(view.entries, {})
+
+    def test_racy(self):
+        # directories modified just now aren't trusted.
+        os.utime(pjoin(self.location, 'dev-libs'), None)
+        self.match(atom('dev-libs/bsdiff'))
+        self.assertEqual(self.cache.for_repo(self.repo).entries, {})
+
+    def test_passthrough(self):
+        # only atoms are cached.
+        r = packages.PackageRestriction('package', values.StrExactMatch('bsdiff'))
+        self.assertEqual(self.match(r), ['dev-libs/bsdiff-2.0'])
+        self.assertEqual(self.cache.for_repo(self.repo).entries, {})
+        # nor are repos without an on disk location.
+        self.assertIdentical(self.cache.for_repo(SimpleTree({})), None)
+
+    def test_caching_repo(self):
+        repo = caching_repo(
+            self.repo, iter, persistent=self.cache.for_repo(self.repo))
+        self.assertEqual(
+            [x.cpvstr for x in repo.match(atom('dev-libs/bsdiff'))],
+            ['dev-libs/bsdiff-2.0'])
+        self.assertEqual(
+            self.cache.for_repo(self.repo).entries['dev-libs/bsdiff'][1],
+            ('2.0',))
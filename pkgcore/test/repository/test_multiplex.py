@@ -4,6 +4,8 @@
 from collections import OrderedDict
 from functools import partial
 
+from pkgcore.ebuild.atom import atom
+from pkgcore.repository.misc import caching_repo
 from pkgcore.repository.multiplex import tree
 from pkgcore.repository.util import SimpleTree
 from pkgcore.restrictions import packages, values
@@ -63,6 +65,59 @@ class TestMultiplex(TestCase):
             self.ctree.itermatch(packages.AlwaysTrue, sorter=rev_sorted)),
             rev_sorted(self.tree1_list + self.tree2_list))
 
+    def test_shared_candidates(self):
+        calls = []
+        def wrap(repo):
+            orig = repo.itermatch
+            def itermatch(restrict, **kwds):
+                calls.append((repo, kwds.get('candidates')))
+                return orig(restrict, **kwds)
+            repo.itermatch = itermatch
+        wrap(self.tree1)
+        wrap(self.tree2)
+        imatch = self.ctree.itermatch
+
+        self.assertEqual(
+            [x.cpvstr for x in imatch(atom('dev-lib/bsdiff'))],
+            ['dev-lib/bsdiff-1.0', 'dev-lib/bsdiff-2.0'])
+        self.assertEqual(calls, [(self.tree2, [('dev-lib', 'bsdiff')])])
+
+        del calls[:]
+        p = packages.PackageRestriction(
+            "package", values.StrExactMatch("diffball"))
+        self.assertEqual(
+            list(x.cpvstr for x in imatch(p, sorter=sorted)),
+            ['dev-util/diffball-0.7', 'dev-util/diffball-1.0',
+             'dev-util/diffball-1.0', 'dev-util/diffball-1.1'])
+        self.assertEqual(calls, [
+            (self.tree1, [('dev-util', 'diffball')]),
+            (self.tree2, [('dev-util', 'diffball')])])
+
+        # nothing to dispatch to.
+        del calls[:]
+        self.assertEqual(list(imatch(atom('dev-util/nonexistent'))), [])
+        self.assertEqual(calls, [])
+
+        # full walks are left to the trees.
+        del calls[:]
+        self.assertLen(list(imatch(packages.AlwaysTrue)), 8)
+        self.assertEqual(calls, [(self.tree1, None), (self.tree2, None)])
+
+    def test_wrapped_trees(self):
+        # wrappers like caching_repo proxy packages, but their itermatch
+        # doesn't take candidates.
+        ctree = self.kls(
+            caching_repo(self.tree1, sorted), caching_repo(self.tree2, sorted))
+        self.assertEqual(
+            [x.cpvstr for x in ctree.itermatch(atom('dev-lib/bsdiff'))],
+            ['dev-lib/bsdiff-1.0', 'dev-lib/bsdiff-2.0'])
+        p = packages.PackageRestriction(
+            "package", values.StrExactMatch("diffball"))
+        self.assertEqual(
+            sorted(x.cpvstr for x in ctree.itermatch(p)),
+            ['dev-util/diffball-0.7', 'dev-util/diffball-1.0',
+             'dev-util/diffball-1.0', 'dev-util/diffball-1.1'])
+
     def test_install(self):
         raise Exception()
     test_install.todo = "need to implement tests for multiplexing down repo_ops"
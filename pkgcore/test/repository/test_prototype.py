@@ -3,6 +3,7 @@
 
 from collections import OrderedDict
 from functools import partial
+import threading
 
 from snakeoil.currying import post_curry
 
@@ -160,6 +161,34 @@ class TestPrototype(TestCase):
                 "dev-lib/fake-1.0", "dev-lib/fake-1.0-r1")))
 
 
+    def test_plan(self):
+        rp = packages.PackageRestriction(
+            "package", values.StrExactMatch("diffball"))
+        rc = packages.PackageRestriction(
+            "category", values.StrGlobMatch("dev-l"))
+        r = packages.OrRestriction(rp, packages.AndRestriction(
+            rc, packages.PackageRestriction(
+                "package", values.StrExactMatch("fake"))))
+        plan = self.repo.plan(r)
+        self.assertIdentical(plan, self.repo.plan(r))
+        self.assertFalse(plan.full_scan)
+        self.assertLen(plan.solutions, 2)
+        self.assertEqual(
+            sorted(plan.candidates(self.repo, iter)),
+            [("dev-lib", "diffball"), ("dev-lib", "fake"),
+             ("dev-util", "diffball")])
+        explain = self.repo.explain(r)
+        self.assertIn("package: exact diffball", explain)
+        self.assertIn("category: filter dev-l*", explain)
+        self.assertIn("estimated cost", explain)
+
+        # conflicting exact matches can't match anything.
+        r = packages.AndRestriction(rp, packages.PackageRestriction(
+            "package", values.StrExactMatch("fake")))
+        self.assertEqual(self.repo.plan(r).solutions, ())
+        self.assertEqual(self.repo.match(r), [])
+        self.assertTrue(self.repo.plan(packages.AlwaysTrue).full_scan)
+
     def test_iter(self):
         self.assertEqual(
             sorted(self.repo),
@@ -168,6 +197,31 @@ class TestPrototype(TestCase):
                     "dev-util/bsdiff-0.4.1", "dev-util/bsdiff-0.4.2",
                     "dev-lib/fake-1.0", "dev-lib/fake-1.0-r1")))
 
+    def test_prefetch(self):
+        pulls = []
+
+        class PrefetchTree(SimpleTree):
+            def _get_versions(self, cp_key):
+                pulls.append((cp_key, threading.current_thread()))
+                if cp_key[1] == "bsdiff":
+                    raise ValueError(cp_key)
+                return SimpleTree._get_versions(self, cp_key)
+
+        repo = PrefetchTree(self.repo.cpv_dict)
+        repo.prefetch_threads = 2
+        self.assertEqual(
+            sorted(x.cpvstr for x in repo.itermatch(atom("dev-lib/fake"))),
+            ["dev-lib/fake-1.0", "dev-lib/fake-1.0-r1"])
+        self.assertLen(pulls, 1)
+        # full walks populate the rest up front from worker threads; failed
+        # lookups are retried lazily so the error surfaces to the caller.
+        self.assertRaises(ValueError, list, repo)
+        main = threading.current_thread()
+        self.assertEqual(
+            sorted(cp for cp, thread in pulls[1:3] if thread is not main),
+            [("dev-util", "bsdiff"), ("dev-util", "diffball")])
+        self.assertEqual(pulls[3:], [(("dev-util", "bsdiff"), main)])
+
     def test_notify_remove(self):
         pkg = versioned_CPV("dev-util/diffball-1.0")
         self.repo.notify_remove_package(pkg)
@@ -1,9 +1,11 @@
 # Copyright: 2006-2007 Brian Harring <ferringb@gmail.com>
 # License: GPL2/BSD
 
+from pkgcore.ebuild.atom import atom
 from pkgcore.resolver.pigeonholes import PigeonHoledSlots
-from pkgcore.restrictions import restriction
+from pkgcore.restrictions import packages, restriction
 from pkgcore.test import TestCase
+from pkgcore.test.misc import FakePkg
 from pkgcore.test.resolver.test_choice_point import fake_package
 
 
@@ -62,3 +64,60 @@ class SlotTesting(TestCase):
         self.assertFalse([], c.fill_slotting(p2))
         c.remove_slotting(p)
         c.remove_slotting(p2)
+
+    def test_versioned_limiters(self):
+        c = PigeonHoledSlots()
+        limiters = [atom(x) for x in (
+            '!dev-libs/foo', '!<dev-libs/foo-1.2', '!<=dev-libs/foo-1.2-r1',
+            '!>dev-libs/foo-2', '!>=dev-libs/foo-1.2', '!=dev-libs/foo-1.2',
+            '!=dev-libs/foo-1.2-r1', '!~dev-libs/foo-1.2', '!=dev-libs/foo-1*',
+            '!dev-libs/foo:2', '!<dev-libs/foo-3:1', '!>=dev-libs/bar-1')]
+        # non atoms are matched as is.
+        limiters.append(packages.AndRestriction(
+            atom('!<dev-libs/foo-2'), atom('dev-libs/foo:1')))
+        for x in reversed(limiters):
+            self.assertFalse(c.add_limiter(x, 'dev-libs/foo'))
+        limiters.reverse()
+        for cpv, slot in (
+                ('dev-libs/foo-1', '1'), ('dev-libs/foo-1.2', '1'),
+                ('dev-libs/foo-1.2-r1', '1'), ('dev-libs/foo-1.2-r2', '2'),
+                ('dev-libs/foo-2', '2'), ('dev-libs/foo-2.1', '2')):
+            pkg = FakePkg(cpv, slot=slot)
+            self.assertEqual(c.check_limiters(pkg),
+                             [x for x in limiters if x.match(pkg)])
+        pkg = FakePkg('dev-libs/foo-1.2-r1', slot='1')
+        self.assertEqual(len(c.fill_slotting(pkg)), 8)
+
+        removed = atom('!=dev-libs/foo-1.2-r1')
+        self.assertIn(removed, c)
+        c.remove_limiter(removed, 'dev-libs/foo')
+        self.assertNotIn(removed, c)
+        self.assertRaises(KeyError, c.remove_limiter, removed, 'dev-libs/foo')
+        self.assertIn(atom('!=dev-libs/foo-1.2'), c)
+        self.assertEqual(c.check_limiters(pkg),
+                         [x for x in limiters if x.match(pkg)
+                          and x is not removed])
+        for x in limiters:
+            if x is not removed:
+                c.remove_limiter(x, 'dev-libs/foo')
+        self.assertFalse(c.limiters)
+        self.assertEqual(c.fill_slotting(pkg), [])
+
+    def test_slot_index(self):
+        c = PigeonHoledSlots()
+        pkgs = [FakePkg('dev-libs/foo-%i' % x, slot=str(x)) for x in (1, 2)]
+        for pkg in pkgs:
+            self.assertEqual(c.fill_slotting(pkg), [])
+        self.assertIdentical(
+            c.get_conflicting_slot(FakePkg('dev-libs/foo-2.1', slot='2')),
+            pkgs[1])
+        self.assertIdentical(
+            c.get_conflicting_slot(FakePkg('dev-libs/foo-3', slot='3')), None)
+        self.assertEqual(c.find_atom_matches(atom('dev-libs/foo')), pkgs)
+        self.assertEqual(c.find_atom_matches(atom('dev-libs/foo:2')), pkgs[1:])
+        self.assertEqual(c.find_atom_matches(atom('<dev-libs/foo-2:2')), [])
+        self.assertIn(pkgs[0], c)
+        c.remove_slotting(pkgs[0])
+        self.assertNotIn(pkgs[0], c)
+        self.assertRaises(KeyError, c.remove_slotting, pkgs[0])
+        self.assertEqual(c.find_atom_matches(atom('dev-libs/foo')), pkgs[1:])
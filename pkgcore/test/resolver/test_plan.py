@@ -3,9 +3,11 @@
 
 from snakeoil.currying import post_curry
 
+from pkgcore.ebuild.atom import atom
+from pkgcore.ebuild.conditionals import DepSet
 from pkgcore.resolver import plan
 from pkgcore.test import TestCase
-from pkgcore.test.misc import FakePkg
+from pkgcore.test.misc import FakePkg, FakeRepo
 
 
 class TestPkgSorting(TestCase):
@@ -30,3 +32,111 @@ class TestPkgSorting(TestCase):
 
     test_pkg_sort_lowest = post_curry(check_it, plan.pkg_sort_lowest,
         [11,9,1,6], [1,6,9,11])
+
+
+class DepPkg(FakePkg):
+
+    __slots__ = ()
+
+    def __init__(self, cpv, rdepends='', repo=None):
+        FakePkg.__init__(self, cpv, repo=repo)
+        object.__setattr__(self, 'depends', DepSet.parse('', atom))
+        object.__setattr__(self, 'rdepends', DepSet.parse(rdepends, atom))
+        object.__setattr__(self, 'post_rdepends', DepSet.parse('', atom))
+
+
+class TestNoGoods(TestCase):
+
+    def setUp(self):
+        self.repo = repo = FakeRepo(livefs=False, repo_id='fake')
+        self.vdb = FakeRepo(livefs=True, repo_id='vdb')
+        repo.pkgs = [DepPkg(cpv, deps, repo=repo) for cpv, deps in (
+            ('dev-libs/z-1', ''),
+            ('dev-libs/z-2', ''),
+            ('dev-libs/y-1', '>=dev-libs/z-2'),
+            ('dev-libs/x-1', 'dev-libs/y'),
+            ('dev-libs/x-2', 'dev-libs/y'),
+            ('app-misc/a-1', 'dev-libs/x'),
+            ('app-misc/a-2', '>=dev-libs/x-1'),
+            )]
+        self.vdb.pkgs = []
+        self.resolver = plan.merge_plan(
+            [repo, self.vdb], plan.pkg_sort_highest,
+            plan.merge_plan.prefer_highest_version_strategy)
+        self.tried = []
+        orig = self.resolver.notify_trying_choice
+        def notify_trying_choice(stack, atom, choices):
+            self.tried.append(choices.current_pkg.cpvstr)
+            return orig(stack, atom, choices)
+        self.resolver.notify_trying_choice = notify_trying_choice
+
+    def test_learning(self):
+        resolver = self.resolver
+        self.assertFalse(resolver.add_atoms([atom('=dev-libs/z-1')]))
+        del self.tried[:]
+        self.assertTrue(resolver.add_atoms([atom('app-misc/a')]))
+        # the slot conflict with z-1 is only explored once; a-1 and the
+        # versions of x it pulls in fail on the learned no-goods.
+        self.assertEqual(self.tried.count('dev-libs/z-2'), 1)
+        self.assertEqual(self.tried.count('dev-libs/y-1'), 1)
+        z1 = resolver.state.match_atom(atom('=dev-libs/z-1'))
+        self.assertEqual(
+            resolver.nogoods[atom('dev-libs/y')], set([frozenset(z1)]))
+        self.assertEqual(resolver._nogood(atom('dev-libs/x')), frozenset(z1))
+        self.assertEqual(resolver.nogoods[atom('app-misc/a')],
+                         set([frozenset(z1)]))
+
+        # once the responsible entries are gone, the no-goods don't apply.
+        resolver.reset()
+        self.assertIdentical(resolver._nogood(atom('dev-libs/x')), None)
+        self.assertFalse(resolver.add_atoms([atom('app-misc/a')]))
+        self.assertEqual(
+            sorted(op.pkg.cpvstr for op in resolver.state.iter_ops()),
+            ['app-misc/a-2', 'dev-libs/x-2', 'dev-libs/y-1', 'dev-libs/z-2'])
+
+
+class TestResolverStats(TestCase):
+
+    def mk_resolver(self, **kwds):
+        repo = FakeRepo(livefs=False, repo_id='fake')
+        repo.pkgs = [DepPkg(cpv, deps, repo=repo) for cpv, deps in (
+            ('dev-libs/z-1', ''),
+            ('dev-libs/y-1', '>=dev-libs/z-2'),
+            ('dev-libs/y-2', 'dev-libs/z'),
+            ('app-misc/a-1', 'dev-libs/y dev-libs/z'),
+            )]
+        vdb = FakeRepo(livefs=True, repo_id='vdb')
+        return plan.merge_plan(
+            [repo, vdb], plan.pkg_sort_highest,
+            plan.merge_plan.prefer_highest_version_strategy, **kwds)
+
+    def test_disabled(self):
+        resolver = self.mk_resolver()
+        self.assertIdentical(resolver.stats, None)
+        self.assertNotIsInstance(
+            resolver.all_raw_dbs[0], plan._instrumented_caching_repo)
+
+    def test_collection(self):
+        resolver = self.mk_resolver(stats=True)
+        self.assertFalse(resolver.add_atoms([atom('app-misc/a')]))
+        stats = resolver.stats
+        self.assertEqual(stats.atoms[atom('app-misc/a')][0], 1)
+        # a's own dep on z is answered from the plan.
+        self.assertEqual(stats.viable, {'viable': 3, 'pre-solved': 1})
+        self.assertEqual(stats.queries['fake'][:2], [0, 3])
+        self.assertEqual(stats.queries['fake'][3], 3)
+        self.assertEqual(stats.backtracks, {})
+
+        # y-1 fails on its dependency, exhausting its choices.
+        self.assertTrue(resolver.add_atoms([atom('=dev-libs/y-1')]))
+        self.assertEqual(stats.viable['no matches'], 1)
+        self.assertEqual(stats.backtracks, {1: 1})
+        self.assertEqual(stats.exhausted, {1: 1})
+        self.assertEqual(stats.atoms[atom('=dev-libs/y-1')][2:], [1, 1])
+
+        # repeated queries are served from the cache.
+        resolver.reset()
+        self.assertFalse(resolver.add_atoms([atom('app-misc/a')]))
+        self.assertEqual(stats.queries['fake'][:2], [3, 5])
+        self.assertEqual(stats.to_dict()['backtracks'], {'1': 1})
+        self.assertIn('=dev-libs/y-1', '\n'.join(stats.summary()))
@@ -0,0 +1,114 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import os
+
+from snakeoil.osutils import ensure_dirs, pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.resolver import plan
+from pkgcore.resolver.plan_cache import PlanCache
+from pkgcore.test import TestCase
+from pkgcore.test.misc import FakeRepo
+from pkgcore.test.resolver.test_plan import DepPkg
+
+
+class TestPlanCache(TempDirMixin, TestCase):
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        vdb_path = pjoin(self.dir, 'vdb')
+        repo_path = pjoin(self.dir, 'repo')
+        for path in (pjoin(vdb_path, 'dev-libs'), repo_path):
+            ensure_dirs(path)
+            os.utime(path, (1000, 1000))
+        self.repo = FakeRepo(livefs=False, repo_id='fake', location=repo_path)
+        self.vdb = FakeRepo(livefs=True, repo_id='vdb', location=vdb_path)
+        self.repo.pkgs = []
+        for cpv, deps in (
+                ('dev-libs/z-1', ''),
+                ('dev-libs/y-1', 'dev-libs/z'),
+                ('dev-libs/w-1', ''),
+                ('app-misc/a-1', 'dev-libs/y'),
+                ('app-misc/b-1', 'dev-libs/w'),
+                ):
+            self.add_pkg(cpv, deps)
+        self.path = pjoin(self.dir, 'plan')
+
+    def add_pkg(self, cpv, deps, mtime=1000):
+        pkg = DepPkg(cpv, deps, repo=self.repo)
+        self.repo.pkgs.append(pkg)
+        base = pjoin(self.repo.location, pkg.category, pkg.package)
+        ensure_dirs(base)
+        path = pjoin(base, '%s-%s.ebuild' % (pkg.package, pkg.fullver))
+        open(path, 'w').close()
+        for x in (path, base):
+            os.utime(x, (mtime, mtime))
+        return pkg
+
+    def resolve(self, targets, cache=None):
+        resolver = plan.merge_plan(
+            [self.vdb, self.repo], plan.pkg_sort_highest,
+            plan.merge_plan.prefer_reuse_strategy)
+        if cache is None:
+            cache = PlanCache(self.path)
+        ret = cache.add_atoms(resolver, map(atom, targets), finalize=True)
+        self.assertFalse(ret)
+        return cache, sorted(op.pkg.cpvstr for op in resolver.state.iter_ops())
+
+    def test_reuse(self):
+        cache, expected = self.resolve(['app-misc/a', 'app-misc/b'])
+        self.assertEqual(cache.reused, 0)
+        self.assertEqual(expected, [
+            'app-misc/a-1', 'app-misc/b-1', 'dev-libs/w-1', 'dev-libs/y-1',
+            'dev-libs/z-1'])
+        self.assertTrue(os.path.exists(self.path))
+        cache, pkgs = self.resolve(['app-misc/a', 'app-misc/b'])
+        self.assertTrue(cache.reused)
+        self.assertEqual(pkgs, expected)
+
+        # a different configuration discards the whole plan.
+        cache, pkgs = self.resolve(
+            ['app-misc/a', 'app-misc/b'], PlanCache(self.path, 'other'))
+        self.assertEqual(cache.reused, 0)
+        self.assertEqual(pkgs, expected)
+
+    def test_changed(self):
+        self.resolve(['app-misc/a', 'app-misc/b'])
+        reused = self.resolve(['app-misc/a', 'app-misc/b'])[0].reused
+        # a new version invalidates the key and everything depending on it;
+        # the rest of the plan is still reused.
+        self.add_pkg('dev-libs/z-2', '', mtime=2000)
+        cache, pkgs = self.resolve(['app-misc/a', 'app-misc/b'])
+        self.assertTrue(0 < cache.reused < reused)
+        self.assertEqual(pkgs, [
+            'app-misc/a-1', 'app-misc/b-1', 'dev-libs/w-1', 'dev-libs/y-1',
+            'dev-libs/z-2'])
+
+    def test_use_changed(self):
+        self.resolve(['app-misc/a', 'app-misc/b'])
+        cache, pkgs = self.resolve(['app-misc/a', 'app-misc/b'])
+        reused = cache.reused
+        pkg = self.repo.pkgs[2]
+        self.assertEqual(pkg.cpvstr, 'dev-libs/w-1')
+        object.__setattr__(pkg, 'use', set(['foo']))
+        cache, pkgs2 = self.resolve(['app-misc/a', 'app-misc/b'])
+        self.assertTrue(0 < cache.reused < reused)
+        self.assertEqual(pkgs, pkgs2)
+
+    def test_dropped_targets(self):
+        self.resolve(['app-misc/a', 'app-misc/b'])
+        # packages only the dropped target pulled in aren't kept.
+        cache, pkgs = self.resolve(['app-misc/a'])
+        self.assertTrue(cache.reused)
+        self.assertEqual(pkgs, ['app-misc/a-1', 'dev-libs/y-1', 'dev-libs/z-1'])
+
+    def test_vanished(self):
+        self.resolve(['app-misc/a', 'app-misc/b'])
+        del self.repo.pkgs[2]
+        del self.repo.pkgs[-1]
+        self.add_pkg('app-misc/b-1', '')
+        cache, pkgs = self.resolve(['app-misc/a', 'app-misc/b'])
+        self.assertEqual(pkgs, [
+            'app-misc/a-1', 'app-misc/b-1', 'dev-libs/y-1', 'dev-libs/z-1'])
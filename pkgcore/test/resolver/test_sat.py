@@ -0,0 +1,118 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.resolver import plan, sat
+from pkgcore.resolver.util import reduce_to_failures
+from pkgcore.test import TestCase
+from pkgcore.test.misc import FakeRepo
+from pkgcore.test.resolver.test_plan import DepPkg
+
+
+def assign_false(solver):
+    for var in xrange(1, solver.nvars + 1):
+        if solver.value(var) is None:
+            return -var
+    return None
+
+
+class TestSolver(TestCase):
+
+    def test_sat(self):
+        s = sat.Solver()
+        a, b, c = s.new_var(), s.new_var(), s.new_var()
+        s.add_clause([a, b])
+        s.add_clause([-a, c])
+        s.add_clause([-c, -b])
+        s.add_clause([-b, a])
+        model = s.solve(assign_false)
+        self.assertTrue(model[a])
+        self.assertFalse(model[b])
+        self.assertTrue(model[c])
+
+    def test_unsat(self):
+        # three pigeons, two holes.
+        s = sat.Solver()
+        holes = [[s.new_var(), s.new_var()] for x in xrange(3)]
+        for pigeon in holes:
+            s.add_clause(pigeon)
+        for hole in xrange(2):
+            for i in xrange(3):
+                for j in xrange(i + 1, 3):
+                    s.add_clause([-holes[i][hole], -holes[j][hole]])
+        self.assertIdentical(s.solve(assign_false), None)
+        self.assertTrue(s.conflicts)
+
+    def test_decisions(self):
+        s = sat.Solver()
+        a, b = s.new_var(), s.new_var()
+        s.add_clause([a, b])
+        # decisions are honoured where the clauses allow.
+        model = s.solve(lambda solver: -a if solver.value(a) is None else None)
+        self.assertFalse(model[a])
+        self.assertTrue(model[b])
+        model = s.solve(assign_false)
+        self.assertTrue(model[a] or model[b])
+
+
+class TestSatMergePlan(TestCase):
+
+    def setUp(self):
+        self.repo = repo = FakeRepo(livefs=False, repo_id='fake')
+        self.vdb = FakeRepo(livefs=True, repo_id='vdb')
+        repo.pkgs = [DepPkg(cpv, deps, repo=repo) for cpv, deps in (
+            ('dev-libs/z-1', ''),
+            ('dev-libs/z-2', ''),
+            ('dev-libs/y-1', '>=dev-libs/z-2'),
+            ('dev-libs/x-1', 'dev-libs/y'),
+            ('dev-libs/x-2', 'dev-libs/y'),
+            ('dev-libs/w-1', ''),
+            ('app-misc/a-1', 'dev-libs/x'),
+            ('app-misc/a-2', '>=dev-libs/x-1'),
+            ('app-misc/b-1', '|| ( dev-libs/x dev-libs/w )'),
+            ('app-misc/c-1', '!dev-libs/x'),
+            )]
+        self.vdb.pkgs = []
+
+    def mk_resolver(self, kls=sat.sat_merge_plan):
+        return kls(
+            [self.repo, self.vdb], plan.pkg_sort_highest,
+            plan.merge_plan.prefer_highest_version_strategy)
+
+    def ops(self, resolver):
+        return sorted(op.pkg.cpvstr for op in resolver.state.iter_ops())
+
+    def test_parity(self):
+        resolver = self.mk_resolver()
+        self.assertFalse(resolver.add_atoms([atom('app-misc/a')]))
+        expected = self.mk_resolver(plan.merge_plan)
+        self.assertFalse(expected.add_atoms([atom('app-misc/a')]))
+        self.assertEqual(self.ops(resolver), self.ops(expected))
+        self.assertEqual(
+            self.ops(resolver),
+            ['app-misc/a-2', 'dev-libs/x-2', 'dev-libs/y-1', 'dev-libs/z-2'])
+        # deps are inserted ahead of what needs them.
+        self.assertEqual(
+            [op.pkg.cpvstr for op in resolver.state.iter_ops()],
+            ['dev-libs/z-2', 'dev-libs/y-1', 'dev-libs/x-2', 'app-misc/a-2'])
+        self.assertTrue(resolver.solver_stats['variables'])
+
+    def test_global_choice(self):
+        # merge_plan takes the first or-block alternative for b and then
+        # runs into c's blocker; the SAT encoding sees both up front.
+        targets = [atom('app-misc/b'), atom('app-misc/c')]
+        self.assertTrue(self.mk_resolver(plan.merge_plan).add_atoms(targets))
+        resolver = self.mk_resolver()
+        self.assertFalse(resolver.add_atoms(targets))
+        self.assertEqual(
+            self.ops(resolver), ['app-misc/b-1', 'app-misc/c-1', 'dev-libs/w-1'])
+
+    def test_failure(self):
+        resolver = self.mk_resolver()
+        self.assertFalse(resolver.add_atoms([atom('=dev-libs/z-1')]))
+        ret = resolver.add_atoms([atom('dev-libs/w'), atom('app-misc/a')])
+        self.assertTrue(ret)
+        self.assertEqual(ret[0], [atom('app-misc/a')])
+        self.assertTrue(reduce_to_failures(ret[1]))
+        # a failed request leaves the plan untouched.
+        self.assertEqual(self.ops(resolver), ['dev-libs/z-1'])
@@ -0,0 +1,105 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import os
+
+from snakeoil.osutils import ensure_dirs, pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.resolver import plan, sat
+from pkgcore.resolver.snapshot import StateSnapshot
+from pkgcore.test import TestCase
+from pkgcore.test.misc import FakeRepo
+from pkgcore.test.resolver.test_plan import DepPkg
+
+
+class TestStateSnapshot(TempDirMixin, TestCase):
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        vdb_path = pjoin(self.dir, 'vdb')
+        repo_path = pjoin(self.dir, 'repo')
+        for path in (pjoin(vdb_path, 'dev-libs'), repo_path):
+            ensure_dirs(path)
+            os.utime(path, (1000, 1000))
+        self.repo = FakeRepo(livefs=False, repo_id='fake', location=repo_path)
+        self.vdb = FakeRepo(livefs=True, repo_id='vdb', location=vdb_path)
+        self.repo.pkgs = [DepPkg(cpv, deps, repo=self.repo) for cpv, deps in (
+            ('dev-libs/y-2', ''),
+            ('dev-libs/w-1', ''),
+            ('app-misc/a-1', 'dev-libs/y dev-libs/w'),
+            )]
+        self.vdb.pkgs = [DepPkg(cpv, deps, repo=self.vdb) for cpv, deps in (
+            ('dev-libs/y-1', ''),
+            ('dev-libs/x-1', 'dev-libs/y !dev-libs/w'),
+            )]
+        self.path = pjoin(self.dir, 'vdb-state')
+
+    def mk_resolver(self, kls=plan.merge_plan):
+        return kls(
+            [self.vdb, self.repo], plan.pkg_sort_highest,
+            plan.merge_plan.prefer_reuse_strategy)
+
+    def ops(self, resolver):
+        return [(op.__class__.__name__, getattr(op, 'pkg', None),
+                 getattr(op, 'blocker', None)) for op in resolver.state.plan]
+
+    def test_roundtrip(self):
+        for kls in (plan.merge_plan, sat.sat_merge_plan):
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            expected = self.mk_resolver(kls)
+            self.assertFalse(StateSnapshot(self.path).restore(expected))
+            expected.load_vdb_state(snapshot=StateSnapshot(self.path))
+            self.assertTrue(os.path.exists(self.path))
+
+            self.assertTrue(StateSnapshot(self.path).restore(self.mk_resolver(kls)))
+            resolver = self.mk_resolver(kls)
+            resolver.load_vdb_state(snapshot=StateSnapshot(self.path))
+            self.assertTrue(resolver.vdb_preloaded)
+            self.assertEqual(self.ops(resolver), self.ops(expected))
+            self.assertEqual(
+                sorted(resolver.state.blockers_refcnt),
+                sorted(expected.state.blockers_refcnt))
+            # the restored state behaves as the loaded one does.
+            for r in (resolver, expected):
+                self.assertTrue(r.add_atom(atom('app-misc/a')))
+                self.assertFalse(r.add_atom(atom('dev-libs/y')))
+                self.assertEqual(r.state.match_atom(atom('dev-libs/y')),
+                                 [self.vdb.pkgs[0]])
+
+    def test_insoluble(self):
+        resolver = self.mk_resolver()
+        resolver.load_vdb_state()
+        resolver.insoluble.add(atom('dev-libs/new'))
+        self.assertTrue(StateSnapshot(self.path).save(resolver))
+        # packages may be added to source repos without changing the key,
+        # so atoms found insoluble aren't recorded.
+        self.repo.pkgs.append(DepPkg('dev-libs/new-1', '', repo=self.repo))
+        resolver = self.mk_resolver()
+        self.assertTrue(StateSnapshot(self.path).restore(resolver))
+        self.assertFalse(resolver.insoluble)
+        self.assertFalse(resolver.add_atom(atom('dev-libs/new')))
+
+    def test_invalidation(self):
+        self.mk_resolver().load_vdb_state(snapshot=StateSnapshot(self.path))
+        # a different configuration.
+        self.assertFalse(StateSnapshot(self.path, 'other').restore(
+            self.mk_resolver()))
+        # an installed package was added.
+        os.utime(pjoin(self.vdb.location, 'dev-libs'), (2000, 2000))
+        self.assertFalse(StateSnapshot(self.path).restore(self.mk_resolver()))
+
+    def test_unavailable(self):
+        self.mk_resolver().load_vdb_state(snapshot=StateSnapshot(self.path))
+        # referenced packages are looked up again; a vanished one fails
+        # over to a full load leaving the plan untouched.
+        self.vdb.pkgs = self.vdb.pkgs[1:]
+        resolver = self.mk_resolver()
+        self.assertFalse(StateSnapshot(self.path).restore(resolver))
+        self.assertEqual(resolver.state.plan, [])
+
+        # repos without an on disk location can't be snapshotted.
+        self.vdb.location = None
+        self.assertIdentical(StateSnapshot(self.path).key(self.mk_resolver()), None)
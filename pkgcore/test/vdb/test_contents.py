@@ -0,0 +1,95 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+from snakeoil.osutils import pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.fs import fs
+from pkgcore.fs.contents import contentsSet
+from pkgcore.test import TestCase
+from pkgcore.vdb.contents import ContentsFile, _ContentsTable
+
+
+class TestContentsFile(TempDirMixin, TestCase):
+
+    lines = [
+        'dir /usr',
+        'dir /usr/bin',
+        'obj /usr/bin/foo 0a0b0c0d0e0f00112233445566778899 1000',
+        'obj /usr/bin/with space d41d8cd98f00b204e9800998ecf8427e 1001',
+        'sym /usr/bin/bar -> foo 1002',
+        'fif /var/run/fifo',
+    ]
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.path = pjoin(self.dir, 'CONTENTS')
+        with open(self.path, 'w') as f:
+            f.write(''.join('%s\n' % x for x in self.lines))
+
+    def expected(self):
+        return contentsSet([
+            fs.fsDir('/usr', strict=False),
+            fs.fsDir('/usr/bin', strict=False),
+            fs.fsFile('/usr/bin/foo', strict=False, mtime=1000, chksums={
+                'md5': 0x0a0b0c0d0e0f00112233445566778899}),
+            fs.fsFile('/usr/bin/with space', strict=False, mtime=1001,
+                      chksums={'md5': 0xd41d8cd98f00b204e9800998ecf8427e}),
+            fs.fsLink('/usr/bin/bar', 'foo', strict=False, mtime=1002),
+            fs.fsFifo('/var/run/fifo', strict=False),
+        ])
+
+    def test_load(self):
+        cset = ContentsFile(self.path)
+        self.assertIsInstance(cset._dict, _ContentsTable)
+        self.assertEqual(len(cset), 6)
+        self.assertEqual(cset, self.expected())
+        self.assertEqual(self.expected(), cset)
+        self.assertIn('/usr/bin/foo', cset)
+        self.assertIn('/usr//bin', cset)
+        self.assertNotIn('/usr/bin/missing', cset)
+        obj = cset['/usr/bin/foo']
+        self.assertTrue(obj.is_reg)
+        self.assertEqual(obj.mtime, 1000)
+        self.assertEqual(obj.chksums, {'md5': 0x0a0b0c0d0e0f00112233445566778899})
+        obj = cset['/usr/bin/bar']
+        self.assertTrue(obj.is_sym)
+        self.assertEqual((obj.target, obj.mtime), ('foo', 1002))
+        self.assertTrue(cset['/var/run/fifo'].is_fifo)
+        self.assertEqual(
+            [x.location for x in cset.iterdirs()], ['/usr', '/usr/bin'])
+        self.assertEqual(
+            [x.location for x in cset.iterlinks()], ['/usr/bin/bar'])
+        self.assertEqual(len(cset.files()), 2)
+        self.assertEqual(len(cset.files(invert=True)), 4)
+        self.assertEqual(
+            sorted(x.location for x in cset.difference(iter(
+                ['/usr', '/usr/bin', fs.fsFile('/usr/bin/foo', strict=False)]))),
+            ['/usr/bin/bar', '/usr/bin/with space', '/var/run/fifo'])
+        self.assertEqual(
+            sorted(x.location for x in cset.intersection(
+                [fs.fsFile('/usr/bin/foo', strict=False), '/nonexistent'])),
+            ['/usr/bin/foo'])
+        self.assertFalse(cset.isdisjoint(['/usr']))
+        self.assertRaises(KeyError, cset.__getitem__, '/nonexistent')
+
+    def test_modify(self):
+        cset = ContentsFile(self.path, mutable=True)
+        cset.remove('/usr/bin/foo')
+        self.assertNotIsInstance(cset._dict, _ContentsTable)
+        self.assertNotIn('/usr/bin/foo', cset)
+        self.assertEqual(len(cset), 5)
+        cset.add(fs.fsDir('/opt', strict=False))
+        self.assertIn('/opt', cset)
+
+        cset = ContentsFile(self.path)
+        self.assertRaises(AttributeError, cset.clear)
+        self.assertEqual(len(cset), 6)
+
+    def test_flush(self):
+        cset = ContentsFile(self.path, mutable=True)
+        cset.flush()
+        with open(self.path) as f:
+            self.assertEqual(
+                sorted(f.read().splitlines()), sorted(self.lines))
+        self.assertEqual(cset, self.expected())
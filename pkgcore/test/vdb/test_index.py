@@ -0,0 +1,336 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+import os
+import shutil
+
+from snakeoil.osutils import ensure_dirs, pjoin
+from snakeoil.test.mixins import TempDirMixin
+
+from pkgcore.ebuild import restricts
+from pkgcore.ebuild.atom import atom
+from pkgcore.fs.contents import contentsSet
+from pkgcore.fs.fs import fsBase
+from pkgcore.restrictions import packages, values
+from pkgcore.test import TestCase
+from pkgcore.vdb import ondisk
+from pkgcore.vdb.index import MetadataIndex, OwnersIndex, RevdepIndex
+
+
+class VdbMixin(TempDirMixin):
+
+    """temporary vdb fixture; :obj:`pkg_files` maps the data passed to
+    :obj:`mk_pkg` to the files of the package's vdb entry"""
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.location = pjoin(self.dir, 'vdb')
+        self.cache_location = pjoin(self.dir, 'cache')
+
+    def pkg_files(self, metadata):
+        return metadata
+
+    def mk_pkg(self, cpv, data, mtime=1000):
+        path = pjoin(self.location, cpv)
+        ensure_dirs(path)
+        for name, val in self.pkg_files(data).iteritems():
+            with open(pjoin(path, name), 'w') as f:
+                f.write(val)
+            os.utime(pjoin(path, name), (mtime, mtime))
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def mk_tree(self):
+        return ondisk.tree(self.location, cache_location=self.cache_location)
+
+
+class TestMetadataIndex(VdbMixin, TestCase):
+
+    def setUp(self):
+        VdbMixin.setUp(self)
+        self.pkg_path = self.mk_pkg('dev-libs/foo-1', {
+            'SLOT': '1\n', 'EAPI': '5\n', 'USE': 'x\ty\n',
+            'RDEPEND': 'dev-libs/bar\n', 'COUNTER': '1\n'})
+
+    def test_lookup(self):
+        vdb = self.mk_tree()
+        index = vdb.metadata_index
+        pkg = vdb.match(atom('dev-libs/foo'))[0]
+        self.assertEqual(pkg.slot, '1')
+        self.assertEqual(sorted(pkg.use), ['x', 'y'])
+        self.assertEqual(str(pkg.rdepends), 'dev-libs/bar')
+        self.assertFalse(pkg.post_rdepends)
+        self.assertIdentical(index.get(self.pkg_path, 'PDEPEND'), None)
+        index.flush()
+        self.assertTrue(os.path.exists(index.path))
+
+        # keys are served from the index, as long as the package directory
+        # is unchanged.
+        os.unlink(pjoin(self.pkg_path, 'SLOT'))
+        os.utime(self.pkg_path, (1000, 1000))
+        index = MetadataIndex(index.path, self.location)
+        self.assertEqual(index.get(self.pkg_path, 'SLOT'), '1\n')
+        self.assertEqual(index.get(self.pkg_path, 'USE'), 'x\ty\n')
+        # keys not indexed are read from the vdb.
+        self.assertEqual(self.mk_tree().metadata_index.keys, index.keys)
+        self.assertNotIn('COUNTER', index.keys)
+
+        os.utime(self.pkg_path, (2000, 2000))
+        index = MetadataIndex(index.path, self.location)
+        self.assertIdentical(index.get(self.pkg_path, 'SLOT'), None)
+        self.assertEqual(index.get(self.pkg_path, 'EAPI'), '5\n')
+
+    def test_ops(self):
+        index = MetadataIndex(pjoin(self.cache_location, 'idx'), self.location)
+        path = self.mk_pkg('dev-libs/bar-2', {'SLOT': '0\n'})
+        # vdb ops record packages right away, racy or not.
+        os.utime(path, None)
+        index.add(path)
+        index.flush()
+        os.unlink(pjoin(path, 'SLOT'))
+        os.utime(path, (os.stat(index.path).st_mtime,) * 2)
+        index2 = MetadataIndex(index.path, self.location)
+        self.assertEqual(index2.get(path, 'SLOT'), None)
+
+        index.remove(path)
+        index.flush()
+        self.assertNotIn('dev-libs/bar-2', MetadataIndex(
+            index.path, self.location).entries)
+
+    def test_disabled(self):
+        vdb = ondisk.tree(self.location, disable_cache=True)
+        self.assertIdentical(vdb.metadata_index, None)
+        self.assertEqual(vdb.match(atom('dev-libs/foo'))[0].slot, '1')
+
+
+class TestOwnersIndex(VdbMixin, TestCase):
+
+    def setUp(self):
+        VdbMixin.setUp(self)
+        self.mk_pkg('dev-libs/foo-1', [
+            'dir /usr', 'dir /usr/lib', 'obj /usr/lib/libfoo.so 0 1',
+            'obj /usr/lib/with space 0 1', 'sym /usr/lib/foo -> libfoo.so 1'])
+        self.mk_pkg('app-misc/bar-2', [
+            'dir /usr', 'dir /usr/bin', 'obj /usr/bin/bar 0 1'])
+
+    def pkg_files(self, contents):
+        return {'CONTENTS': ''.join('%s\n' % x for x in contents)}
+
+    def owners(self, index, paths):
+        return dict((k, sorted(v)) for k, v in index.owners(paths).iteritems())
+
+    def test_owners(self):
+        vdb = self.mk_tree()
+        index = vdb.owners_index
+        self.assertEqual(self.owners(index, [
+            '/usr', '/usr/lib/with space', '/usr/lib/foo', '/usr/bin/foo']), {
+                '/usr': ['app-misc/bar-2', 'dev-libs/foo-1'],
+                '/usr/lib/with space': ['dev-libs/foo-1'],
+                '/usr/lib/foo': ['dev-libs/foo-1']})
+        self.assertEqual(
+            dict((k, [pkg.cpvstr for pkg in v]) for k, v in
+                 vdb.owners(['/usr/bin//bar', '/usr/bin']).iteritems()),
+            {'/usr/bin/bar': ['app-misc/bar-2'],
+             '/usr/bin': ['app-misc/bar-2']})
+        self.assertEqual(
+            sorted((k, sorted(v)) for k, v in index.iter_owners(
+                lambda x: x.endswith('foo'), '/usr/lib')),
+            [('/usr/lib/foo', ['dev-libs/foo-1'])])
+        index.flush()
+
+        # packages are validated against the vdb.
+        self.mk_pkg('dev-libs/foo-1', ['dir /opt'], mtime=2000)
+        self.mk_pkg('dev-libs/baz-1', ['obj /usr/bin/bar 0 1'])
+        index = self.mk_tree().owners_index
+        self.assertEqual(self.owners(index, ['/usr/bin/bar', '/opt', '/usr']), {
+            '/usr/bin/bar': ['app-misc/bar-2', 'dev-libs/baz-1'],
+            '/opt': ['dev-libs/foo-1'], '/usr': ['app-misc/bar-2']})
+
+    def test_disabled(self):
+        vdb = ondisk.tree(self.location, disable_cache=True)
+        self.assertIdentical(vdb.owners_index, None)
+        self.assertEqual(
+            dict((k, [pkg.cpvstr for pkg in v]) for k, v in
+                 vdb.owners(['/usr/lib/foo', '/nonexistent']).iteritems()),
+            {'/usr/lib/foo': ['dev-libs/foo-1']})
+
+    def test_ops(self):
+        index = OwnersIndex(pjoin(self.cache_location, 'idx'), self.location)
+        path = self.mk_pkg('dev-libs/new-1', ['obj /usr/bin/new 0 1'])
+        index.add(path)
+        index.flush()
+        # recorded entries are used as long as the package is unchanged.
+        self.mk_pkg('dev-libs/new-1', ['obj /usr/bin/other 0 1'])
+        index2 = OwnersIndex(index.path, self.location)
+        self.assertEqual(self.owners(index2, ['/usr/bin/new', '/usr/bin/bar']), {
+            '/usr/bin/new': ['dev-libs/new-1'],
+            '/usr/bin/bar': ['app-misc/bar-2']})
+
+        shutil.rmtree(path)
+        index.remove(path)
+        index.flush()
+        self.assertNotIn('dev-libs/new-1', OwnersIndex(
+            index.path, self.location).stamps)
+        self.assertEqual(self.owners(index, ['/usr/bin/new']), {})
+
+    def test_itermatch(self):
+        vdb = self.mk_tree()
+        index = vdb.owners_index
+
+        def check(value_restrict, expected, candidates=None):
+            restrict = packages.PackageRestriction('contents', value_restrict)
+            if candidates is None:
+                candidates = expected
+            self.assertEqual(
+                sorted(pkg.cpvstr for pkg in vdb.itermatch(restrict)), expected)
+            d = index.candidates(vdb, [restrict])
+            self.assertEqual(sorted(
+                '%s/%s-%s' % (k + (ver,)) for k, l in d.iteritems()
+                for ver in l), candidates)
+
+        owns = values.ContainmentMatch2(contentsSet(
+            [fsBase('/usr/bin/bar', strict=False),
+             fsBase('/usr/lib', strict=False)]))
+        check(owns, ['app-misc/bar-2', 'dev-libs/foo-1'])
+        owns = values.ContainmentMatch2(contentsSet(
+            [fsBase('/usr/bin/bar', strict=False),
+             fsBase('/usr', strict=False)]), match_all=True)
+        check(owns, ['app-misc/bar-2'])
+        for regex, expected in (
+                ('^/usr/l', ['dev-libs/foo-1']),
+                ('bar$', ['app-misc/bar-2']),
+                ('^/usr/(lib|bin)/', ['app-misc/bar-2', 'dev-libs/foo-1']),
+                ('^/opt', [])):
+            check(values.AnyMatch(values.GetAttrRestriction(
+                'location', values.StrRegex(regex))), expected)
+
+        # restrictions the index can't answer are left to matching.
+        restrict = packages.PackageRestriction('contents', values.AnyMatch(
+            values.GetAttrRestriction('location', values.StrRegex(
+                '^/usr/bin'))), negate=True)
+        self.assertIdentical(index.candidates(vdb, [restrict]), None)
+        self.assertEqual(
+            sorted(pkg.cpvstr for pkg in vdb.itermatch(restrict)),
+            ['dev-libs/foo-1'])
+
+    def test_regex_prefix(self):
+        prefix = OwnersIndex._regex_prefix
+        for regex, kwds, expected in (
+                ('^/usr/lib', {}, '/usr/lib'),
+                ('/usr/lib', {}, ''),
+                ('/usr/lib', {'match': True}, '/usr/lib'),
+                ('^/usr/lib64?/', {}, '/usr/lib6'),
+                ('^/usr/lib+', {}, '/usr/lib'),
+                ('^/usr/.*', {}, '/usr/'),
+                ('^/usr|/opt', {}, ''),
+                ('^/USR', {'case_sensitive': False}, ''),
+                ('^/usr', {'negate': True}, ''),
+                ):
+            self.assertEqual(
+                prefix(values.StrRegex(regex, **kwds)), expected, regex)
+
+
+class TestRevdepIndex(VdbMixin, TestCase):
+
+    def setUp(self):
+        VdbMixin.setUp(self)
+        self.mk_pkg('dev-libs/foo-1', {})
+        self.mk_pkg('dev-libs/foo-2', {})
+        self.mk_pkg('app-misc/bar-1', {
+            'RDEPEND': '>=dev-libs/foo-2 x? ( dev-libs/baz )\n',
+            'DEPEND': 'dev-libs/foo\n', 'USE': 'x\n'})
+        self.mk_pkg('app-misc/baz-1', {'RDEPEND': '<dev-libs/foo-2\n'})
+
+    def pkg_files(self, metadata):
+        metadata.setdefault('EAPI', '5\n')
+        metadata.setdefault('SLOT', '0\n')
+        metadata.setdefault('USE', '\n')
+        return metadata
+
+    def test_dependents(self):
+        vdb = self.mk_tree()
+        index = vdb.revdep_index
+        self.assertEqual(sorted(index.dependents('dev-libs/foo')), [
+            ('app-misc/bar-1', 'depends', 'dev-libs/foo'),
+            ('app-misc/bar-1', 'rdepends', '>=dev-libs/foo-2'),
+            ('app-misc/baz-1', 'rdepends', '<dev-libs/foo-2')])
+        self.assertEqual(index.dependents('dev-libs/baz'), [
+            ('app-misc/bar-1', 'rdepends', 'dev-libs/baz')])
+        self.assertEqual(index.dependents('dev-libs/fo'), [])
+        expected = sorted(
+            (pkg.cpvstr, attr, str(dep)) for pkg, attr, dep in
+            ondisk.tree(self.location, disable_cache=True).dependents(
+                'dev-libs/foo'))
+        self.assertEqual(sorted(
+            (pkg.cpvstr, attr, str(dep)) for pkg, attr, dep in
+            vdb.dependents('dev-libs/foo')), expected)
+        self.assertEqual(len(expected), 3)
+        index.flush()
+
+        # packages are validated against the vdb.
+        self.mk_pkg('app-misc/baz-1', {'RDEPEND': 'dev-libs/qux\n'}, mtime=2000)
+        index = self.mk_tree().revdep_index
+        self.assertEqual(sorted(x[0] for x in index.dependents('dev-libs/foo')),
+                         ['app-misc/bar-1', 'app-misc/bar-1'])
+        self.assertEqual(index.dependents('dev-libs/qux'), [
+            ('app-misc/baz-1', 'rdepends', 'dev-libs/qux')])
+
+    def test_ops(self):
+        index = RevdepIndex(pjoin(self.cache_location, 'idx'), self.mk_tree())
+        path = self.mk_pkg('app-misc/new-1', {'RDEPEND': 'dev-libs/new\n'})
+        index.add(path)
+        self.assertEqual([x[0] for x in index.dependents('dev-libs/new')],
+                         ['app-misc/new-1'])
+        index.flush()
+        shutil.rmtree(path)
+        index.remove(path)
+        self.assertEqual(index.dependents('dev-libs/new'), [])
+
+    def test_itermatch(self):
+        vdb = self.mk_tree()
+
+        def check(value_restrict, expected, attrs=(
+                'depends', 'rdepends', 'post_rdepends')):
+            restrict = packages.OrRestriction(*[
+                packages.PackageRestriction(attr, values.FlatteningRestriction(
+                    atom, values.AnyMatch(value_restrict)))
+                for attr in attrs])
+            self.assertEqual(
+                sorted(pkg.cpvstr for pkg in vdb.itermatch(restrict)), expected)
+            for attr in attrs:
+                restrict = packages.PackageRestriction(
+                    attr, values.FlatteningRestriction(
+                        atom, values.AnyMatch(value_restrict)))
+                d = vdb.attr_index.candidates(vdb, [restrict])
+                self.assertNotIdentical(d, None)
+                self.assertEqual(
+                    sorted(pkg.cpvstr for pkg in vdb.itermatch(restrict)),
+                    sorted('%s/%s-%s' % (k + (ver,))
+                           for k, l in d.iteritems() for ver in l))
+
+        check(restricts.DepIntersects(atom('dev-libs/foo')),
+              ['app-misc/bar-1', 'app-misc/baz-1'])
+        check(restricts.DepIntersects(atom('=dev-libs/foo-1')),
+              ['app-misc/bar-1', 'app-misc/baz-1'])
+        check(restricts.DepIntersects(atom('=dev-libs/foo-1')),
+              ['app-misc/baz-1'], attrs=('rdepends',))
+        check(restricts.DepIntersects(atom('dev-libs/nonexistent')), [])
+        foo2 = vdb.match(atom('=dev-libs/foo-2'))
+        check(restricts.DepMatchesPkgs(foo2), ['app-misc/bar-1'])
+        check(restricts.DepMatchesPkgs(foo2), [], attrs=('post_rdepends',))
+
+        # equal restrictions hash alike, so repeated queries hit caches.
+        for kls, arg in ((restricts.DepIntersects, atom('dev-libs/foo')),
+                         (restricts.DepMatchesPkgs, foo2)):
+            self.assertEqual(kls(arg), kls(arg))
+            self.assertEqual(hash(kls(arg)), hash(kls(arg)))
+            self.assertNotEqual(kls(arg), kls(arg, negate=True))
+
+        # negations are left to matching.
+        restrict = packages.PackageRestriction(
+            'rdepends', values.FlatteningRestriction(atom, values.AnyMatch(
+                restricts.DepIntersects(atom('dev-libs/foo'), negate=True))))
+        self.assertIdentical(vdb.attr_index.candidates(vdb, [restrict]), None)
+        self.assertEqual(
+            sorted(pkg.cpvstr for pkg in vdb.itermatch(restrict)),
+            ['app-misc/bar-1'])
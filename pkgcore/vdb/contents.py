@@ -3,9 +3,14 @@
 
 __all__ = ("LookupFsDev", "ContentsFile")
 
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+
 from snakeoil import data_source
 from snakeoil.demandload import demandload
 from snakeoil.fileutils import AtomicWriteFile
+from snakeoil.osutils import normpath
 
 from pkgcore.fs import fs
 from pkgcore.fs.contents import contentsSet
@@ -43,8 +48,166 @@ class LookupFsDev(fs.fsDev):
         fs.fsDev.__init__(self, path, **kwds)
 
 
+class _ContentsTable(object):
+
+    """
+    read-only mapping of location to fs object for the entries of a CONTENTS
+    file, stored compactly
+
+    Entries are kept as a sorted table of paths with columns for the entry
+    type, mtime and md5 (symlink targets are kept aside); fs objects are
+    only created as entries are accessed, and aren't retained.
+    """
+
+    __slots__ = ("_paths", "_kinds", "_mtimes", "_md5s", "_targets")
+
+    kinds = ("obj", "dir", "sym", "dev", "fif")
+    _md5_len = 16
+    _no_md5 = b'\0' * _md5_len
+
+    def __init__(self, lines):
+        """
+        :param lines: iterable of CONTENTS lines
+        """
+        entries = {}
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            s = line.split(" ")
+            if s[0] in ("dir", "dev", "fif"):
+                entries[normpath(' '.join(s[1:]))] = (s[0], 0, None)
+            elif s[0] == "obj":
+                entries[normpath(' '.join(s[1:-2]))] = (
+                    "obj", long(s[-1]), s[-2])
+            elif s[0] == "sym":
+                try:
+                    p = s.index("->")
+                except ValueError:
+                    # XXX throw a corruption error
+                    raise
+                entries[normpath(' '.join(s[1:p]))] = (
+                    "sym", long(s[-1]), ' '.join(s[p+1:-1]))
+            else:
+                raise Exception(
+                    "unknown entry type %r" % (line,))
+
+        self._paths = sorted(entries)
+        kind_idx = dict((x, i) for i, x in enumerate(self.kinds))
+        kinds = bytearray()
+        mtimes = array('d')
+        md5s = []
+        targets = {}
+        for idx, path in enumerate(self._paths):
+            kind, mtime, extra = entries[path]
+            kinds.append(kind_idx[kind])
+            mtimes.append(mtime)
+            if kind == "obj":
+                md5 = unhexlify('%032x' % (long(extra, 16),))
+                if len(md5) != self._md5_len:
+                    raise ValueError("invalid md5 %r for %r" % (extra, path))
+                md5s.append(md5)
+            else:
+                md5s.append(self._no_md5)
+                if kind == "sym":
+                    targets[idx] = extra
+        self._kinds = kinds
+        self._mtimes = mtimes
+        self._md5s = b''.join(md5s)
+        self._targets = targets
+
+    def _index(self, location):
+        idx = bisect_left(self._paths, location)
+        if idx < len(self._paths) and self._paths[idx] == location:
+            return idx
+        return None
+
+    def _entry(self, idx):
+        path = self._paths[idx]
+        kind = self.kinds[self._kinds[idx]]
+        if kind == "obj":
+            offset = idx * self._md5_len
+            md5 = self._md5s[offset:offset + self._md5_len]
+            return fs.fsFile(
+                path, chksums={"md5": long(hexlify(md5), 16)},
+                mtime=long(self._mtimes[idx]), strict=False)
+        elif kind == "dir":
+            return fs.fsDir(path, strict=False)
+        elif kind == "sym":
+            return fs.fsLink(path, self._targets[idx],
+                mtime=long(self._mtimes[idx]), strict=False)
+        elif kind == "dev":
+            return LookupFsDev(path, strict=False)
+        return fs.fsFifo(path, strict=False)
+
+    def __getitem__(self, location):
+        idx = self._index(location)
+        if idx is None:
+            raise KeyError(location)
+        return self._entry(idx)
+
+    def get(self, location, default=None):
+        idx = self._index(location)
+        if idx is None:
+            return default
+        return self._entry(idx)
+
+    def __contains__(self, location):
+        return self._index(location) is not None
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    iterkeys = __iter__
+
+    def itervalues(self, kind=None, invert=False, exclude=None):
+        """Iterate over the fs objects of the entries.
+
+        :param kind: only entries of this type (see :obj:`kinds`)
+        :param invert: if True, only entries not of that type
+        :param exclude: container of locations to skip
+        """
+        code = None if kind is None else self.kinds.index(kind)
+        kinds, paths = self._kinds, self._paths
+        for idx in xrange(len(paths)):
+            if code is not None and (kinds[idx] == code) == invert:
+                continue
+            if exclude is not None and paths[idx] in exclude:
+                continue
+            yield self._entry(idx)
+
+    def iteritems(self):
+        return ((self._paths[idx], self._entry(idx))
+                for idx in xrange(len(self._paths)))
+
+    def keys(self):
+        return list(self._paths)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, _ContentsTable):
+            other = dict(other.iteritems())
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class ContentsFile(contentsSet):
-    """class wrapping a contents file"""
+    """class wrapping a contents file
+
+    Entries read from the file are held in a compact table, materializing
+    fs objects on access; modifying the set converts it to a plain dict of
+    fs objects first.
+    """
 
     def __init__(self, source, mutable=False, create=False):
 
@@ -54,10 +217,14 @@ class ContentsFile(contentsSet):
         self._source = source
 
         if not create:
-            self.update(self._iter_contents())
+            self._dict = _ContentsTable(self._get_fd())
 
         self.mutable = mutable
 
+    def _materialize(self):
+        if isinstance(self._dict, _ContentsTable):
+            self._dict = dict(self._dict.iteritems())
+
     def clone(self, empty=False):
         # create is used to block it from reading.
         cset = self.__class__(self._source, mutable=True, create=True)
@@ -71,8 +238,26 @@ class ContentsFile(contentsSet):
             if obj.chksums is None or "md5" not in obj.chksums:
                 raise TypeError("fsFile objects need to be strict")
 
+        self._materialize()
         contentsSet.add(self, obj)
 
+    def __delitem__(self, obj):
+        self._materialize()
+        contentsSet.__delitem__(self, obj)
+
+    def discard(self, obj):
+        self._materialize()
+        contentsSet.discard(self, obj)
+
+    def clear(self):
+        if self.mutable and isinstance(self._dict, _ContentsTable):
+            self._dict = {}
+        contentsSet.clear(self)
+
+    def update(self, iterable):
+        self._materialize()
+        contentsSet.update(self, iterable)
+
     def _get_fd(self, write=False):
         if isinstance(self._source, basestring):
             if write:
@@ -85,42 +270,37 @@ class ContentsFile(contentsSet):
             fobj.truncate(0)
         return fobj
 
+    def difference(self, other):
+        if not isinstance(self._dict, _ContentsTable):
+            return contentsSet.difference(self, other)
+        if not hasattr(other, '__contains__'):
+            other = set(self._convert_loc(other))
+        return contentsSet(self._dict.itervalues(exclude=other),
+            mutable=self.mutable)
+
+    # filter on the entry type before creating fs objects.
+    def _kind_filter(kind, name):
+        func = getattr(contentsSet, name)
+        def _filter(self, invert=False):
+            if isinstance(self._dict, _ContentsTable):
+                return self._dict.itervalues(kind, invert)
+            return func(self, invert=invert)
+        _filter.__name__ = name
+        _filter.__doc__ = func.__doc__
+        return _filter
+
+    for _kind, _name in (("obj", "iterfiles"), ("dir", "iterdirs"),
+                         ("sym", "itersymlinks"), ("dev", "iterdevs"),
+                         ("fif", "iterfifos")):
+        locals()[_name] = _kind_filter(_kind, _name)
+    del _kind, _name, _kind_filter
+
     def flush(self):
         return self._write()
 
     def _iter_contents(self):
         self.clear()
-        for line in self._get_fd():
-            if not line:
-                continue
-            s = line.split(" ")
-            if s[0] in ("dir", "dev", "fif"):
-                path = ' '.join(s[1:])
-                if s[0] == 'dir':
-                    obj = fs.fsDir(path, strict=False)
-                elif s[0] == 'dev':
-                    obj = LookupFsDev(path, strict=False)
-                else:
-                    obj = fs.fsFifo(path, strict=False)
-            elif s[0] == "obj":
-                path = ' '.join(s[1:-2])
-                obj = fs.fsFile(
-                    path, chksums={"md5":long(s[-2], 16)},
-                        mtime=long(s[-1]), strict=False)
-            elif s[0] == "sym":
-                try:
-                    p = s.index("->")
-                    obj = fs.fsLink(' '.join(s[1:p]), ' '.join(s[p+1:-1]),
-                        mtime=long(s[-1]), strict=False)
-
-                except ValueError:
-                    # XXX throw a corruption error
-                    raise
-            else:
-                raise Exception(
-                    "unknown entry type %r" % (line,))
-
-            yield obj
+        return _ContentsTable(self._get_fd()).itervalues()
 
     def _write(self):
         md5_handler = get_handler('md5')
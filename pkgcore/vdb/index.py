@@ -0,0 +1,684 @@
+# Copyright: 2015 pkgcore contributors
+# License: GPL2/BSD
+
+"""
+persistent indexes over the installed packages database
+
+The vdb stores each metadata key of an installed package in a file of its
+own, so loading the metadata of every installed package costs one open per
+key and package.  :obj:`MetadataIndex` keeps the commonly needed keys of
+all installed packages in a single file instead.  Likewise, finding the
+owner of a file means parsing the CONTENTS of every installed package;
+:obj:`OwnersIndex` keeps a sorted table of all installed paths and their
+owners, and :obj:`RevdepIndex` one of the dependencies of all installed
+packages by the key they depend on, so the dependents of a package don't
+have to be found by loading the dependencies of everything installed.
+
+Entries are validated against the mtime of their package's directory, so
+packages added, removed or rewritten by other tools are detected and read
+from the vdb again; editing the files of a package in place without
+touching its directory isn't (the owners index checks the mtime of
+CONTENTS too).  The vdb repo operations update the indexes as they install
+and remove packages.
+"""
+
+__all__ = ("MetadataIndex", "OwnersIndex", "RevdepIndex", "CombinedIndex")
+
+from bisect import bisect_left
+import errno
+import os
+import re
+import time
+
+from snakeoil import compatibility
+from snakeoil.demandload import demandload
+from snakeoil.fileutils import readfile
+from snakeoil.lists import iflatten_instance
+from snakeoil.osutils import ensure_dirs, listdir_dirs, pjoin
+
+from pkgcore.ebuild.atom import atom
+from pkgcore.ebuild.restricts import _DepKeyRestriction
+
+demandload(
+    'snakeoil.fileutils:AtomicWriteFile,readlines_ascii',
+    'pkgcore.ebuild.cpv:versioned_CPV',
+    'pkgcore.ebuild.errors:InvalidCPV,MalformedAtom',
+    'pkgcore.log:logger',
+    'pkgcore.restrictions:values',
+    'pkgcore.spawn:atexit_register',
+)
+
+
+_escapes = {'\\': '\\\\', '\t': '\\t', '\n': '\\n'}
+_unescapes = dict((v[1], k) for k, v in _escapes.iteritems())
+_escape_re = re.compile(r'[\\\t\n]')
+_unescape_re = re.compile(r'\\(.)')
+
+
+def _escape(s):
+    return _escape_re.sub(lambda m: _escapes[m.group(0)], s)
+
+
+def _unescape(s):
+    if '\\' not in s:
+        return s
+    return _unescape_re.sub(lambda m: _unescapes[m.group(1)], s)
+
+
+def _mtime(path):
+    try:
+        return repr(os.stat(path).st_mtime)
+    except EnvironmentError:
+        return None
+
+
+class _Index(object):
+
+    """common bits of the on disk vdb indexes"""
+
+    magic = None
+    # what's indexed, for log messages.
+    description = None
+
+    # directories modified this close to a lookup aren't recorded; a
+    # change within the same timestamp granularity would go unnoticed.
+    racy_window = 1
+
+    def __init__(self, path, location):
+        """
+        :param path: location of the index file
+        :param location: base directory of the vdb
+        """
+        self.path = path
+        self.location = location
+        self._dirty = False
+
+    def _open(self):
+        # returns the index file positioned after the magic, or None.
+        try:
+            f = open(self.path)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("failed reading vdb %s index %s: %s",
+                               self.description, self.path, e)
+            return None
+        if f.readline().rstrip('\n') != self.magic:
+            f.close()
+            return None
+        return f
+
+    def _relpath(self, path):
+        return path[len(self.location):].strip(os.path.sep)
+
+    def _racy(self, mtime):
+        return float(mtime) >= time.time() - self.racy_window
+
+    def _mark_dirty(self):
+        if not self._dirty:
+            self._dirty = True
+            atexit_register(self.flush)
+
+    def flush(self):
+        """Write the index if it was modified, logging any failure."""
+        if not self._dirty:
+            return
+        try:
+            self.write()
+        except EnvironmentError as e:
+            # unprivileged users can't update the index, it's merely used.
+            if e.errno in (errno.EACCES, errno.EPERM, errno.EROFS,
+                           errno.ENOENT):
+                log = logger.debug
+            else:
+                log = logger.warning
+            log("failed writing vdb %s index %s: %s",
+                self.description, self.path, e)
+
+    def write(self):
+        """Write the index back to disk."""
+        ensure_dirs(os.path.dirname(self.path), mode=0755)
+        f = AtomicWriteFile(self.path)
+        try:
+            f.write(self.magic + '\n')
+            self._write(f)
+            f.close()
+        except:
+            f.discard()
+            raise
+        self._dirty = False
+
+    def _write(self, f):
+        raise NotImplementedError(self, '_write')
+
+
+class MetadataIndex(_Index):
+
+    """
+    single file index of the metadata of all packages in a vdb
+
+    The index is read on first use; entries updated by lookups are written
+    back at exit (or via :obj:`flush`).
+    """
+
+    magic = 'pkgcore-vdb-metadata-1'
+    description = 'metadata'
+
+    # metadata files stored in the index; others are read from the vdb.
+    keys = frozenset([
+        'CBUILD', 'CHOST', 'CTARGET', 'DEFINED_PHASES', 'DEPEND',
+        'DESCRIPTION', 'EAPI', 'HOMEPAGE', 'INHERITED', 'IUSE',
+        'IUSE_EFFECTIVE', 'KEYWORDS', 'LICENSE', 'PDEPEND', 'PROPERTIES',
+        'PROVIDE', 'RDEPEND', 'REQUIRED_USE', 'RESTRICT', 'SLOT', 'USE',
+        'repository',
+    ])
+
+    def __init__(self, path, location):
+        _Index.__init__(self, path, location)
+        self._entries = None
+        # escaped metadata of the packages validated by this process.
+        self._checked = {}
+
+    @property
+    def entries(self):
+        """mapping of package directory (relative to the vdb) to the
+        (mtime, serialized metadata) recorded for it"""
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self):
+        entries = {}
+        f = self._open()
+        if f is None:
+            return entries
+        with f:
+            for line in f:
+                l = line.rstrip('\n').split('\t')
+                if len(l) % 2 == 0:
+                    entries[l[0]] = (l[1], l[2:])
+        return entries
+
+    def _read(self, path):
+        metadata = {}
+        for key in self.keys:
+            data = readfile(pjoin(path, key), True)
+            if data is not None:
+                metadata[key] = _escape(data)
+        return metadata
+
+    def get(self, path, key):
+        """Return a metadata key of the package stored at path.
+
+        :return: the contents of the key, or None if the package doesn't
+            have it
+        """
+        metadata = self._checked.get(path)
+        if metadata is None:
+            metadata = self._checked[path] = self._lookup(path)
+        val = metadata.get(key)
+        if val is not None:
+            val = _unescape(val)
+        return val
+
+    def _lookup(self, path):
+        # returns the escaped metadata of a package.
+        mtime = _mtime(path)
+        if mtime is None:
+            return {}
+        rel = self._relpath(path)
+        entry = self.entries.get(rel)
+        if entry is not None and entry[0] == mtime:
+            l = entry[1]
+            return dict(zip(l[::2], l[1::2]))
+        metadata = self._read(path)
+        if not self._racy(mtime):
+            self._record(rel, mtime, metadata)
+        return metadata
+
+    def _record(self, rel, mtime, metadata):
+        l = []
+        for key, val in sorted(metadata.iteritems()):
+            l.extend((key, val))
+        self.entries[rel] = (mtime, l)
+        self._mark_dirty()
+
+    def add(self, path):
+        """Record the package stored at path, as installed by a vdb op."""
+        rel = self._relpath(path)
+        mtime = _mtime(path)
+        self._checked.pop(path, None)
+        if mtime is None:
+            self.remove(path)
+        else:
+            self._record(rel, mtime, self._read(path))
+
+    def remove(self, path):
+        """Drop the package stored at path, as removed by a vdb op."""
+        self._checked.pop(path, None)
+        if self.entries.pop(self._relpath(path), None) is not None:
+            self._mark_dirty()
+
+    def _write(self, f):
+        for rel, (mtime, l) in sorted(self.entries.iteritems()):
+            # entries of packages removed behind our back are pruned.
+            if os.path.isdir(pjoin(self.location, rel)):
+                f.write('\t'.join([rel, mtime] + l) + '\n')
+
+
+def _contents_paths(path):
+    """Yield the (type, path) of each entry of a CONTENTS file; see
+    :obj:`pkgcore.vdb.contents.ContentsFile` for the format."""
+    for line in readlines_ascii(path, True, True):
+        kind = line[:3]
+        if kind == 'obj':
+            yield kind, line[4:].rsplit(' ', 2)[0]
+        elif kind == 'sym':
+            yield kind, line[4:].split(' -> ', 1)[0]
+        elif kind in ('dir', 'dev', 'fif'):
+            yield kind, line[4:]
+
+
+def _candidates(evaluate, terms):
+    # turn the package directories matching all answerable terms into the
+    # candidates mapping attr_index users expect.
+    matched = None
+    for term in terms:
+        s = evaluate(term)
+        if s is None:
+            continue
+        if matched is None:
+            matched = s
+        else:
+            matched.intersection_update(s)
+    if matched is None:
+        return None
+    d = {}
+    for rel in matched:
+        try:
+            cpv = versioned_CPV(rel)
+        except InvalidCPV:
+            continue
+        d.setdefault((cpv.category, cpv.package), []).append(cpv.fullver)
+    return dict((k, tuple(v)) for k, v in d.iteritems())
+
+
+class _TableIndex(_Index):
+
+    """
+    index holding a sorted table of tab separated entries derived from the
+    packages of a vdb, each ending with the package directory
+
+    The index is read and validated against the vdb on first use; changes
+    are written back at exit (or via :obj:`flush`).
+    """
+
+    # files besides the package directory whose mtime is part of the stamp
+    # of a package.
+    stamp_files = ()
+
+    def __init__(self, path, location):
+        _Index.__init__(self, path, location)
+        self._stamps = None
+        self._table = None
+        self._validated = False
+
+    @property
+    def table(self):
+        """sorted list of entries"""
+        self._validate()
+        return self._table
+
+    @property
+    def stamps(self):
+        """mapping of package directory (relative to the vdb) to the stamp
+        its entries were recorded with"""
+        self._validate()
+        return self._stamps
+
+    def _entries(self, rel, path):
+        """Yield the entries of the package stored at path, without the
+        trailing package directory."""
+        raise NotImplementedError(self, '_entries')
+
+    def _load(self):
+        self._stamps, self._table = {}, []
+        f = self._open()
+        if f is None:
+            return
+        with f:
+            data = f.read().split('\n')
+        if data[-1] == '':
+            data.pop()
+        try:
+            count = int(data[0])
+            self._stamps = dict(x.split('\t', 1) for x in data[1:count + 1])
+        except ValueError as e:
+            logger.warning("corrupt vdb %s index %s: %s",
+                           self.description, self.path, e)
+            self._stamps = {}
+            return
+        self._table = data[count + 1:]
+
+    def _stamp(self, path, racy=False):
+        """Return the stamp of a package directory, or None if it doesn't
+        exist.
+
+        Unless racy is True, the stamp of a recently modified package is
+        empty.
+        """
+        mtime = _mtime(path)
+        if mtime is None:
+            return None
+        l = [mtime]
+        l.extend(_mtime(pjoin(path, x)) for x in self.stamp_files)
+        if not racy and any(self._racy(x) for x in l if x is not None):
+            return ''
+        return ':'.join(str(x) for x in l)
+
+    def _installed(self):
+        try:
+            cats = [x for x in listdir_dirs(self.location)
+                    if not x.startswith('.')]
+        except EnvironmentError:
+            return
+        for cat in cats:
+            try:
+                pkgs = listdir_dirs(pjoin(self.location, cat))
+            except EnvironmentError:
+                continue
+            for pf in pkgs:
+                if pf.startswith('.tmp.') or pf.endswith('.lockfile') \
+                        or pf.startswith('-MERGING-'):
+                    continue
+                yield '%s/%s' % (cat, pf)
+
+    def _validate(self):
+        if self._validated:
+            return
+        if self._stamps is None:
+            self._load()
+        self._validated = True
+        stamps = self._stamps
+        current = {}
+        for rel in self._installed():
+            current[rel] = self._stamp(pjoin(self.location, rel))
+        # racy entries have an empty stamp and are always read again.
+        stale = set(rel for rel, stamp in stamps.iteritems()
+                    if not stamp or current.get(rel) != stamp)
+        added = [rel for rel, stamp in current.iteritems()
+                 if stamp is not None and (
+                     not stamp or stamps.get(rel) != stamp)]
+        if stale or added:
+            self._update(stale, added, current)
+
+    def _update(self, removed, added, stamps=None):
+        table = self._table
+        if removed:
+            removed = set(removed)
+            table[:] = [x for x in table
+                        if x[x.rindex('\t') + 1:] not in removed]
+            for rel in removed:
+                self._stamps.pop(rel, None)
+        for rel in added:
+            path = pjoin(self.location, rel)
+            if stamps is None:
+                # vdb ops record packages right away, racy or not.
+                stamp = self._stamp(path, racy=True)
+            else:
+                stamp = stamps[rel]
+            if stamp is None:
+                continue
+            table.extend('%s\t%s' % (x, rel) for x in self._entries(rel, path))
+            self._stamps[rel] = stamp
+        table.sort()
+        self._mark_dirty()
+
+    def _iter_prefix(self, prefix):
+        # entries starting with prefix, split into their fields.
+        table = self.table
+        idx = bisect_left(table, prefix)
+        while idx < len(table) and table[idx].startswith(prefix):
+            yield table[idx].split('\t')
+            idx += 1
+
+    def add(self, path):
+        """Record the package stored at path, as installed by a vdb op."""
+        if self._stamps is None:
+            self._load()
+        rel = self._relpath(path)
+        self._update((rel,), (rel,))
+
+    def remove(self, path):
+        """Drop the package stored at path, as removed by a vdb op."""
+        if self._stamps is None:
+            self._load()
+        self._update((self._relpath(path),), ())
+
+    def _evaluate(self, restrict):
+        """Return the package directories a restriction term may match, or
+        None if it can't be answered from the index."""
+        return None
+
+    def candidates(self, repo, terms):
+        """Return the packages that may match a set of ANDed restriction terms.
+
+        :return: dict of (cat, pkg) to a tuple of versions, or None if none
+            of the terms can be answered from the index
+        """
+        return _candidates(self._evaluate, terms)
+
+    def _write(self, f):
+        f.write('%i\n' % (len(self._stamps),))
+        for rel, stamp in sorted(self._stamps.iteritems()):
+            f.write('%s\t%s\n' % (rel, stamp))
+        for entry in self._table:
+            f.write(entry + '\n')
+
+
+class OwnersIndex(_TableIndex):
+
+    """
+    single file index of the paths owned by the packages in a vdb
+
+    The table holds a ``path<TAB>type<TAB>cat/PF`` entry per CONTENTS entry,
+    sorted by path; exact lookups bisect it, regex lookups scan the paths
+    (only those under the literal prefix of an anchored regex).
+
+    It's usable as the ``attr_index`` of a vdb, narrowing restrictions on
+    ``contents`` down to the owning packages.
+    """
+
+    magic = 'pkgcore-vdb-owners-1'
+    description = 'owners'
+    stamp_files = ('CONTENTS',)
+
+    def _entries(self, rel, path):
+        for kind, x in _contents_paths(pjoin(path, 'CONTENTS')):
+            yield '%s\t%s' % (_escape(x), kind)
+
+    def owners(self, paths):
+        """Find the owners of paths.
+
+        :param paths: normalized absolute paths
+        :return: dict mapping each owned path to the set of the package
+            directories (relative to the vdb, so cpvs) owning it
+        """
+        d = {}
+        for path in paths:
+            for _path, _kind, rel in self._iter_prefix(_escape(path) + '\t'):
+                d.setdefault(path, set()).add(rel)
+        return d
+
+    def iter_owners(self, match, prefix=''):
+        """Yield the (path, owners) of the paths a function accepts.
+
+        :param match: callable taking a path
+        :param prefix: only paths starting with this are considered
+        """
+        last, accepted, owners = None, False, None
+        for path, _kind, rel in self._iter_prefix(_escape(prefix)):
+            if path != last:
+                if accepted:
+                    yield _unescape(last), owners
+                last = path
+                accepted = match(_unescape(path))
+                owners = set()
+            if accepted:
+                owners.add(rel)
+        if accepted:
+            yield _unescape(last), owners
+
+    @staticmethod
+    def _regex_prefix(restrict):
+        # literal prefix every path matching an anchored regex starts with.
+        if not isinstance(restrict, values.StrRegex) or restrict.negate \
+                or restrict.flags:
+            return ''
+        regex = restrict.regex
+        if regex.startswith('^'):
+            regex = regex[1:]
+        elif not restrict.ismatch:
+            return ''
+        if '|' in regex:
+            return ''
+        for idx, c in enumerate(regex):
+            if c in '.^$*+?{}[]\\|()':
+                if c in '*?{':
+                    idx -= 1
+                return regex[:max(idx, 0)]
+        return regex
+
+    def _evaluate(self, restrict):
+        if restrict.attr != 'contents' or restrict.negate:
+            return None
+        r = restrict.restriction
+        if isinstance(r, values.ContainmentMatch2) and not r.negate:
+            paths = [getattr(x, 'location', x) for x in r.vals]
+            if not all(isinstance(x, basestring) for x in paths):
+                return None
+            owners = self.owners(paths)
+            if not r.all:
+                return set().union(*owners.values())
+            if len(owners) != len(set(paths)):
+                return set()
+            return set.intersection(*owners.values()) if owners else set()
+        if isinstance(r, values.AnyMatch) and not r.negate:
+            r = r.restriction
+            if isinstance(r, values.GetAttrRestriction) and \
+                    r.attr == 'location' and not r.negate:
+                s = set()
+                for path, owners in self.iter_owners(
+                        r.restriction.match, self._regex_prefix(r.restriction)):
+                    s.update(owners)
+                return s
+        return None
+
+
+class RevdepIndex(_TableIndex):
+
+    """
+    single file index of the dependencies of the packages in a vdb, by the
+    key they depend on
+
+    The table holds a ``key<TAB>attr<TAB>atom<TAB>cat/PF`` entry per atom in
+    the depends, rdepends and post_rdepends of each package, sorted by key,
+    so the dependents of a key are found by bisecting it.
+
+    It's usable as the ``attr_index`` of a vdb, narrowing dependency
+    restrictions on :obj:`pkgcore.ebuild.restricts.DepIntersects` and
+    :obj:`pkgcore.ebuild.restricts.DepMatchesPkgs` (as used by pquery
+    --restrict-revdep and --restrict-revdep-pkgs) down to the dependents.
+    """
+
+    magic = 'pkgcore-vdb-revdeps-1'
+    description = 'reverse dependencies'
+    attrs = ('depends', 'rdepends', 'post_rdepends')
+
+    def __init__(self, path, repo):
+        """
+        :param path: location of the index file
+        :param repo: the vdb
+        """
+        _TableIndex.__init__(self, path, repo.location)
+        self.repo = repo
+
+    def _entries(self, rel, path):
+        try:
+            cpv = versioned_CPV(rel)
+            pkg = self.repo.package_class(
+                cpv.category, cpv.package, cpv.fullver)
+            deps = [(attr, getattr(pkg, attr)) for attr in self.attrs]
+        except compatibility.IGNORED_EXCEPTIONS:
+            raise
+        except Exception as e:
+            # an unparsable package doesn't depend on anything we can tell.
+            logger.warning("failed indexing the dependencies of %s: %s",
+                           rel, e)
+            return
+        for attr, depset in deps:
+            for dep in set(iflatten_instance(depset, atom)):
+                if isinstance(dep, atom):
+                    yield '%s\t%s\t%s' % (dep.key, attr, dep)
+
+    def dependents(self, key):
+        """Find the packages depending on a key.
+
+        :return: list of (package directory, attr, atom string) tuples, the
+            package directories being relative to the vdb, so cpvs
+        """
+        return [(rel, attr, dep) for _key, attr, dep, rel in
+                self._iter_prefix(key + '\t')]
+
+    def _evaluate(self, restrict):
+        if restrict.attr not in self.attrs or restrict.negate:
+            return None
+        r = restrict.restriction
+        if not isinstance(r, values.FlatteningRestriction) or r.negate:
+            return None
+        r = r.restriction
+        if not isinstance(r, values.AnyMatch) or r.negate:
+            return None
+        r = r.restriction
+        if not isinstance(r, _DepKeyRestriction) or r.negate:
+            return None
+        s = set()
+        atoms = {}
+        for key in r.keys:
+            for rel, attr, dep in self.dependents(key):
+                if attr != restrict.attr or rel in s:
+                    continue
+                a = atoms.get(dep)
+                if a is None:
+                    try:
+                        a = atoms[dep] = atom(dep)
+                    except MalformedAtom:
+                        # left for the restriction to decide.
+                        s.add(rel)
+                        continue
+                if r.match(a):
+                    s.add(rel)
+        return s
+
+
+class CombinedIndex(object):
+
+    """``attr_index`` answering restriction terms from any of several
+    indexes"""
+
+    def __init__(self, *indexes):
+        self.indexes = indexes
+
+    def _evaluate(self, restrict):
+        for index in self.indexes:
+            s = index._evaluate(restrict)
+            if s is not None:
+                return s
+        return None
+
+    def candidates(self, repo, terms):
+        """Return the packages that may match a set of ANDed restriction terms.
+
+        :return: dict of (cat, pkg) to a tuple of versions, or None if none
+            of the terms can be answered from the indexes
+        """
+        return _candidates(self._evaluate, terms)
@@ -11,11 +11,13 @@ import stat
 from snakeoil import compatibility, data_source, klass
 from snakeoil.demandload import demandload
 from snakeoil.fileutils import readfile
+from snakeoil.lists import iflatten_instance
 from snakeoil.mappings import IndeterminantDict
-from snakeoil.osutils import listdir_dirs, pjoin
+from snakeoil.osutils import listdir_dirs, normpath, pjoin
 
 from pkgcore.config import ConfigHint
 from pkgcore.ebuild import ebuild_built
+from pkgcore.ebuild.atom import atom
 from pkgcore.ebuild.cpv import versioned_CPV
 from pkgcore.ebuild.errors import InvalidCPV
 from pkgcore.repository import errors, multiplex, prototype
@@ -24,6 +26,7 @@ demandload(
     'pkgcore.log:logger',
     'pkgcore.vdb:repo_ops',
     'pkgcore.vdb.contents:ContentsFile',
+    'pkgcore.vdb.index:CombinedIndex,MetadataIndex,OwnersIndex,RevdepIndex',
 )
 
 
@@ -51,6 +54,18 @@ class tree(prototype.tree):
         elif cache_location is None:
             cache_location = pjoin("/var/cache/edb/dep", location.lstrip("/"))
         self.cache_location = cache_location
+        self.metadata_index = self.owners_index = self.revdep_index = None
+        if cache_location is not None:
+            self.metadata_index = MetadataIndex(
+                pjoin(cache_location, 'pkgcore-metadata'), location)
+            self.owners_index = OwnersIndex(
+                pjoin(cache_location, 'pkgcore-owners'), location)
+            self.revdep_index = RevdepIndex(
+                pjoin(cache_location, 'pkgcore-revdeps'), self)
+            # answers contents and dependency restrictions, as used by
+            # pquery --owns and --restrict-revdep.
+            self.attr_index = CombinedIndex(
+                self.owners_index, self.revdep_index)
         self._versions_tmp_cache = {}
         try:
             st = os.stat(self.location)
@@ -175,11 +190,70 @@ class tree(prototype.tree):
                 if data is None:
                     raise KeyError(key)
         else:
-            data = readfile(pjoin(path, key), True)
+            index = self.metadata_index
+            if index is not None and key in index.keys:
+                data = index.get(path, key)
+            else:
+                data = readfile(pjoin(path, key), True)
             if data is None:
                 raise KeyError((path, key))
         return data
 
+    def owners(self, paths):
+        """Find the installed packages owning paths.
+
+        This is answered from the owners index if the vdb has one, else by
+        scanning the CONTENTS of every installed package.
+
+        :param paths: iterable of absolute paths
+        :return: dict mapping each owned path (normalized) to a list of the
+            packages owning it
+        """
+        paths = set(normpath(x) for x in paths)
+        d = {}
+        index = self.owners_index
+        if index is None:
+            for pkg in self:
+                contents = pkg.contents
+                for path in paths:
+                    if path in contents:
+                        d.setdefault(path, []).append(pkg)
+            return d
+        for path, rels in index.owners(paths).iteritems():
+            l = []
+            for rel in sorted(rels):
+                l.extend(self.match(atom('=' + rel)))
+            if l:
+                d[path] = l
+        return d
+
+    def dependents(self, key):
+        """Find the installed packages depending on a package key.
+
+        This is answered from the reverse dependencies index if the vdb has
+        one, else by loading the dependencies of every installed package.
+
+        :param key: category/package string
+        :return: list of (pkg, attr, atom) tuples, attr being the dependency
+            attribute (depends, rdepends or post_rdepends) holding the atom
+        """
+        l = []
+        index = self.revdep_index
+        if index is None:
+            for pkg in self:
+                for attr in RevdepIndex.attrs:
+                    for dep in set(iflatten_instance(getattr(pkg, attr), atom)):
+                        if isinstance(dep, atom) and dep.key == key:
+                            l.append((pkg, attr, dep))
+            return l
+        pkgs = {}
+        for rel, attr, dep in index.dependents(key):
+            if rel not in pkgs:
+                pkgs[rel] = self.match(atom('=' + rel))
+            for pkg in pkgs[rel]:
+                l.append((pkg, attr, atom(dep)))
+        return l
+
     def notify_remove_package(self, pkg):
         remove_it = len(self.packages[pkg.category]) == 1
         prototype.tree.notify_remove_package(self, pkg)
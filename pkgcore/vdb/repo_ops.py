@@ -32,6 +32,19 @@ def update_mtime(path, timestamp=None):
         logger.error("failed updated vdb timestamp for %r: %s", path, e)
 
 
+def update_indexes(repo, added=(), removed=()):
+    """Bring the indexes of a vdb in sync with installed/removed entries."""
+    for attr in ('metadata_index', 'owners_index', 'revdep_index'):
+        index = getattr(repo, attr, None)
+        if index is None:
+            continue
+        for path in removed:
+            index.remove(path)
+        for path in added:
+            index.add(path)
+        index.flush()
+
+
 class install(repo_ops.install):
 
     def __init__(self, repo, newpkg, observer):
@@ -119,9 +132,13 @@ class install(repo_ops.install):
         return True
 
     def finalize_data(self):
+        self._finalize_install()
+        update_indexes(self.repo, added=(self.install_path,))
+        return True
+
+    def _finalize_install(self):
         os.rename(self.tmp_write_path, self.install_path)
         update_mtime(self.repo.location)
-        return True
 
 
 class uninstall(repo_ops.uninstall):
@@ -135,10 +152,14 @@ class uninstall(repo_ops.uninstall):
         return True
 
     def finalize_data(self):
+        self._finalize_uninstall()
+        update_indexes(self.repo, removed=(self.remove_path,))
+        return True
+
+    def _finalize_uninstall(self):
         update_mtime(self.repo.location)
         shutil.rmtree(self.remove_path)
         update_mtime(self.repo.location)
-        return True
 
 
 # should convert these to mixins.
@@ -159,8 +180,10 @@ class replace(repo_ops.replace, install, uninstall):
         # literal same fullver replacements), then wipe the unmerge
         # that minimizes the window for races, and gets the data in place
         # should unmerge somehow die.
-        uninstall.finalize_data(self)
-        install.finalize_data(self)
+        self._finalize_uninstall()
+        self._finalize_install()
+        update_indexes(self.repo, added=(self.install_path,),
+                       removed=(self.remove_path,))
         return True
 
 